@@ -0,0 +1,541 @@
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import tempfile
+import time
+import tracemalloc
+from xml.sax.saxutils import escape
+
+import gazetteer_snapshot
+import parse_hocr_files
+import placename_matcher
+import placename_service
+import process_charter_books
+from fuzzy_matcher import FuzzyMatcher
+
+try:
+    from openpyxl import Workbook
+except ImportError:
+    # only needed to save the synthetic gazetteer as an Excel file
+    Workbook = None
+
+
+# Increase when the synthetic data or the timed stages change, as results of
+# different suite versions can't be compared.
+SUITE_VERSION = 2
+
+# Layout of the synthetic pages, in pixels, roughly that of the OHZ scans. Odd and even pages
+# have their text area shifted to the outer side, with line numbers in the outer margin.
+PAGE_WIDTH = 2000
+PAGE_HEIGHT = 3000
+CAREA_WIDTH = 1600
+CHAR_WIDTH = 20
+LINE_HEIGHT = 30
+LINE_STEP = 40
+PARAGRAPH_SKIP = 30
+LINES_PER_PAGE = 60
+
+LATIN_WORDS = [
+    "in", "nomine", "domini", "amen", "nos", "comes", "hollandie", "notum", "facimus", "universis",
+    "presentes", "litteras", "inspecturis", "quod", "ecclesie", "terram", "apud", "dedimus", "concessimus",
+    "fratribus", "monasterii", "perpetuo", "possidendam", "testes", "sunt", "datum", "anno", "incarnationis",
+    "dominice", "millesimo", "ducentesimo", "sigilli", "nostri", "munimine", "roboratas", "decima", "mansos",
+    "cum", "omnibus", "pertinentiis", "suis", "salutem", "in", "perpetuum", "et", "de", "ad", "per",
+]
+PERSON_NAMES = ["Florentius", "Willelmus", "Theodericus", "Ada", "Johannes", "Godefridus", "Hugo", "Aleidis"]
+PLACE_PREFIXES = [
+    "Haar", "Heem", "Lei", "Rijn", "Zand", "Oost", "West", "Noord", "Zuid", "Berg", "Bever", "Assen", "Mid",
+    "Vlaar", "Delf", "Alk", "Wijk", "Kat", "Schie", "Vlie", "Hil", "Egmond", "Grave", "Rot", "Dor", "Goud",
+    "Brie", "Kij", "Voor", "Wassen", "Loos", "Naal", "Mon", "Lis", "Ter", "Vlaer", "Zier", "Goes", "Rei",
+]
+PLACE_SUFFIXES = [
+    "lem", "dam", "wijk", "burg", "land", "dorp", "veen", "hout", "kerk", "sande", "mond", "zand", "loo",
+    "hem", "recht", "sloot", "ambacht", "velde", "stede", "gouw", "hoven", "huizen", "duin", "broek",
+]
+# spelling variation as found in the charters, applied to make variants of a placename
+VARIANT_RULES = [("ij", "y"), ("k", "c"), ("aa", "ae"), ("oo", "oe"), ("u", "v"), ("ee", "e"), ("z", "s"), ("w", "uu")]
+LATIN_SUFFIXES = ["um", "a", "e"]
+MONTHS = ["jan.", "febr.", "mrt.", "apr.", "mei", "juni", "juli", "aug.", "sept.", "okt.", "nov.", "dec."]
+RUNNING_HEAD = ["OORKONDENBOEK", "VAN", "HOLLAND", "EN", "ZEELAND"]
+
+
+###############################
+# Synthetic gazetteer         #
+###############################
+
+def make_placename_variants(placename, rng, max_variants=3):
+    variants = []
+    for rule_from, rule_to in rng.sample(VARIANT_RULES, len(VARIANT_RULES)):
+        if len(variants) >= max_variants:
+            break
+        if rule_from in placename.lower():
+            variant = re.sub(rule_from, rule_to, placename, count=1, flags=re.IGNORECASE)
+            variants += [variant[0].upper() + variant[1:]]
+    if len(variants) < max_variants:
+        variants += [placename + rng.choice(LATIN_SUFFIXES)]
+    if len(variants) < max_variants and rng.random() < 0.2:
+        # incomplete variant, with the uncertain part between square brackets
+        split = rng.randint(1, len(placename) - 1)
+        variants += [placename[:split] + "[" + placename[split:] + "]"]
+    return [variant for variant in variants if variant != placename]
+
+def make_synthetic_gazetteer(num_places=1000, max_variants=3, seed=0):
+    """
+    Returns the rows of a synthetic gazetteer in the layout of the placename Excel file:
+    (ID, placename, country, note) rows, with the preferred placename of each place followed by
+    its variants, and an empty row between places. The same seed always gives the same rows.
+    """
+    if num_places > len(PLACE_PREFIXES) * len(PLACE_SUFFIXES) * 3:
+        raise ValueError("Too many places for the synthetic placename parts: {n}".format(n=num_places))
+    rng = random.Random(seed)
+    rows = [(None, "Plaatsnaam", "Land", "Opmerking")]
+    placenames = set()
+    placename_id = 0
+    while len(placenames) < num_places:
+        placename = rng.choice(PLACE_PREFIXES) + rng.choice(PLACE_SUFFIXES)
+        if len(placenames) >= len(PLACE_PREFIXES) * len(PLACE_SUFFIXES) // 2:
+            # the combinations run out for large gazetteers, add a distinguishing part
+            placename += " " + rng.choice(["aan Zee", "Binnen", "Buiten", "Ambacht", "Oost", "West"])
+        if placename in placenames:
+            continue
+        placenames.add(placename)
+        placename_id += 1
+        rows += [(placename_id, placename, rng.choice(["NL", "NL", "NL", "BE", "DE"]), None)]
+        for variant in make_placename_variants(placename, rng, max_variants=rng.randint(0, max_variants)):
+            rows += [(placename_id, variant, None, None)]
+        rows += [(None, None, None, None)]
+    return rows
+
+def get_variant_index(gazetteer_rows):
+    # variant -> {preferred placename: ID}, in the same way as index_row in the notebook builds is_variant_of
+    is_variant_of = {}
+    preferred_placename = None
+    for placename_id, placename, country, note in gazetteer_rows:
+        if placename == "Plaatsnaam" or not placename:
+            preferred_placename = None
+            continue
+        if not preferred_placename:
+            preferred_placename = placename
+        is_variant_of.setdefault(placename, {})[preferred_placename] = placename_id
+    return is_variant_of
+
+def save_gazetteer_workbook(gazetteer_rows, excel_file):
+    if Workbook is None:
+        raise ImportError("openpyxl is needed to save the gazetteer as an Excel file")
+    workbook = Workbook()
+    worksheet = workbook.active
+    for row in gazetteer_rows:
+        worksheet.append(list(row))
+    workbook.save(excel_file)
+
+
+###############################
+# Synthetic hOCR pages        #
+###############################
+
+def make_ocr_noise(word, rng):
+    # a single character substitution or deletion, as in OCR errors
+    if len(word) < 4:
+        return word
+    position = rng.randint(1, len(word) - 2)
+    if rng.random() < 0.5:
+        return word[:position] + word[position+1:]
+    return word[:position] + rng.choice("ilnrtce") + word[position+1:]
+
+def make_body_words(rng, placenames, num_words):
+    words = []
+    for _ in range(num_words):
+        draw = rng.random()
+        if draw < 0.06 and placenames:
+            placename = rng.choice(placenames)
+            if rng.random() < 0.3:
+                placename = make_ocr_noise(placename, rng)
+            words += placename.split(" ")
+        elif draw < 0.1:
+            words += [rng.choice(PERSON_NAMES)]
+        else:
+            words += [rng.choice(LATIN_WORDS)]
+    return words
+
+def make_line_boxes(words, left, top):
+    # word boxes for a line of words starting at the left position, with single spaces
+    boxes = []
+    x = left
+    for word in words:
+        boxes += [(x, top, x + len(word) * CHAR_WIDTH, top + LINE_HEIGHT, word)]
+        x += (len(word) + 1) * CHAR_WIDTH
+    return boxes
+
+def make_body_lines(rng, placenames, num_lines, carea_left, max_chars):
+    """
+    Returns the word boxes of the lines of a paragraph of charter text, with an indented
+    first line and words at the end of a line that are hyphenated over two lines.
+    """
+    words = make_body_words(rng, placenames, num_lines * 12)
+    lines = []
+    line = []
+    indent = 3
+    carry = None
+    while len(lines) < num_lines:
+        if carry:
+            line, carry = [carry], None
+        while words:
+            word = words[0]
+            line_length = indent + sum([len(line_word) + 1 for line_word in line])
+            if line_length + len(word) <= max_chars:
+                line += [words.pop(0)]
+                continue
+            space_left = max_chars - line_length
+            if space_left >= 4 and len(word) >= 7 and len(lines) < num_lines - 1:
+                split = min(space_left - 1, len(word) - 3)
+                line += [word[:split] + "-"]
+                carry = word[split:]
+                words.pop(0)
+            break
+        if not words:
+            words = make_body_words(rng, placenames, 12)
+        lines += [make_line_boxes(line, carea_left + indent * CHAR_WIDTH, 0)]
+        line = []
+        indent = 0
+    return lines
+
+def make_title_line(rng, charter_num, carea_left, placenames):
+    # a charter title: the date on the left, the charter number centred and the place of issue on the right
+    date_words = [str(rng.randint(1100, 1299)), rng.choice(MONTHS), "{d}.".format(d=rng.randint(1, 28))]
+    boxes = make_line_boxes(date_words, carea_left + CHAR_WIDTH, 0)
+    number = str(charter_num)
+    center = carea_left + CAREA_WIDTH // 2
+    left = center - len(number) * CHAR_WIDTH // 2
+    boxes += [(left, 0, left + len(number) * CHAR_WIDTH, LINE_HEIGHT, number)]
+    if placenames and rng.random() < 0.7:
+        place_words = rng.choice(placenames).split(" ")
+        place_width = (sum([len(word) + 1 for word in place_words]) - 1) * CHAR_WIDTH
+        boxes += make_line_boxes(place_words, carea_left + CAREA_WIDTH - place_width - CHAR_WIDTH, 0)
+    return boxes
+
+def add_margin_line_numbers(lines, page_num, carea_left, carea_right):
+    # line numbers every 5 lines, in the outer margin: on the left of odd pages, on the right of even pages
+    for line_index, line in enumerate(lines):
+        if line_index == 0 or line_index % 5 != 0 or len(line) == 0:
+            continue
+        number = str(line_index)
+        width = len(number) * CHAR_WIDTH
+        top = line[0][1]
+        if page_num % 2 == 1:
+            line.insert(0, (carea_left - 80, top, carea_left - 80 + width, top + LINE_HEIGHT, number))
+        else:
+            line.append((carea_right + 80 - width, top, carea_right + 80, top + LINE_HEIGHT, number))
+
+def get_hocr_bbox_string(bbox):
+    return "bbox {l} {t} {r} {b}".format(l=bbox[0], t=bbox[1], r=bbox[2], b=bbox[3])
+
+def make_hocr_document(page_num, lines, carea):
+    out = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" '
+        '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">',
+        '<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">',
+        '<head>',
+        '<title></title>',
+        '<meta http-equiv="Content-Type" content="text/html;charset=utf-8" />',
+        "<meta name='ocr-system' content='synthetic' />",
+        '</head>',
+        '<body>',
+        "  <div class='ocr_page' id='page_1' title='image \"page_{p}.png\"; {b}; ppageno 0'>".format(
+            p=page_num, b=get_hocr_bbox_string((0, 0, PAGE_WIDTH, PAGE_HEIGHT))),
+        "   <div class='ocr_carea' id='block_1_1' title=\"{b}\">".format(b=get_hocr_bbox_string(carea)),
+        "    <p class='ocr_par' id='par_1_1' lang='lat' title=\"{b}\">".format(b=get_hocr_bbox_string(carea)),
+    ]
+    word_num = 0
+    for line_num, line in enumerate(lines):
+        line_bbox = (min([box[0] for box in line]), min([box[1] for box in line]),
+                     max([box[2] for box in line]), max([box[3] for box in line]))
+        out += ["     <span class='ocr_line' id='line_1_{n}' title=\"{b}; baseline 0 -6; x_size 30\">".format(
+            n=line_num + 1, b=get_hocr_bbox_string(line_bbox))]
+        for box in line:
+            word_num += 1
+            out += ["      <span class='ocrx_word' id='word_1_{n}' title='{b}; x_wconf {c}'>{w}</span>".format(
+                n=word_num, b=get_hocr_bbox_string(box), c=90, w=escape(box[4]))]
+        out += ["     </span>"]
+    out += ["    </p>", "   </div>", "  </div>", " </body>", "</html>"]
+    return "\n".join(out) + "\n"
+
+def make_synthetic_page(page_num, first_charter_num, placenames=None, seed=0):
+    """
+    Returns the hOCR document of a synthetic charter book page and the charter numbers of the
+    titles on the page. A page has a header, charter titles with centred numbers followed by
+    paragraphs of charter text with hyphenated line breaks, line numbers every 5 lines in the
+    outer margin and a footer with the page number. The same arguments always give the same page.
+    """
+    rng = random.Random(seed * 1000003 + page_num)
+    placenames = placenames or []
+    carea_left = 260 if page_num % 2 == 1 else 140
+    carea_right = carea_left + CAREA_WIDTH
+    max_chars = CAREA_WIDTH // CHAR_WIDTH - 2
+    # lines as (list of word boxes, skip before the line)
+    page_lines = [(make_line_boxes(RUNNING_HEAD, carea_left + 20 * CHAR_WIDTH, 0), 0)]
+    charter_nums = []
+    charter_num = first_charter_num
+    while len(page_lines) < LINES_PER_PAGE - 4:
+        if rng.random() < 0.35 or len(page_lines) == 1:
+            page_lines += [(make_title_line(rng, charter_num, carea_left, placenames), PARAGRAPH_SKIP)]
+            charter_nums += [charter_num]
+            charter_num += 1
+        num_lines = min(rng.randint(2, 9), LINES_PER_PAGE - 3 - len(page_lines))
+        for line_index, line in enumerate(make_body_lines(rng, placenames, num_lines, carea_left, max_chars)):
+            page_lines += [(line, PARAGRAPH_SKIP if line_index == 0 else 0)]
+    page_lines += [(make_line_boxes(["-", str(page_num), "-"], carea_left + CAREA_WIDTH // 2 - 60, 0), PARAGRAPH_SKIP)]
+    lines = []
+    top = 150
+    for line, skip in page_lines:
+        top += skip
+        lines += [[(left, top, right, top + LINE_HEIGHT, word) for left, _, right, _, word in line]]
+        top += LINE_STEP
+    add_margin_line_numbers(lines[:-1], page_num, carea_left, carea_right)
+    carea = (carea_left, 150, carea_right, top)
+    return make_hocr_document(page_num, lines, carea), charter_nums
+
+def write_synthetic_book(hocr_dir, num_pages, first_charter_num=1, placenames=None, seed=0):
+    """
+    Writes num_pages synthetic hOCR pages to hocr_dir, named so that get_hocr_files finds them
+    in page order. Returns a dict with the charter numbers of the titles on each page.
+    """
+    if not os.path.exists(hocr_dir):
+        os.makedirs(hocr_dir)
+    page_charters = {}
+    charter_num = first_charter_num
+    for page_num in range(1, num_pages + 1):
+        hocr_document, charter_nums = make_synthetic_page(page_num, charter_num, placenames, seed)
+        with open(os.path.join(hocr_dir, "synthetic_{p:04d}.hocr".format(p=page_num)), 'wt') as fh:
+            fh.write(hocr_document)
+        page_charters[page_num] = charter_nums
+        charter_num += len(charter_nums)
+    return page_charters
+
+
+###############################
+# Timed stages                #
+###############################
+
+def measure(prepare, run, repeat=3):
+    """
+    Runs run(prepare()) repeat times to take the best time, and once more with tracemalloc to
+    measure the peak memory allocated during the run, as tracing allocations slows down the
+    timed runs. The inputs are prepared before each run, as some stages change them. Returns
+    the seconds, the peak memory in bytes and the return value of the last timed run.
+    """
+    seconds = None
+    for _ in range(repeat):
+        inputs = prepare()
+        start = time.perf_counter()
+        output = run(inputs)
+        run_seconds = time.perf_counter() - start
+        seconds = run_seconds if seconds is None else min(seconds, run_seconds)
+    inputs = prepare()
+    tracemalloc.start()
+    run(inputs)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak_memory, output
+
+def make_stage_result(seconds, peak_memory, items):
+    return {
+        "seconds": seconds,
+        "items": items,
+        "items_per_second": items / seconds if seconds > 0 else None,
+        "peak_memory_bytes": peak_memory,
+    }
+
+def parse_pages(hocr_files, parser):
+    return [parse_hocr_files.parse_hocr_page(filepath, page_num, parser=parser) for filepath, page_num in hocr_files]
+
+def remove_line_numbers(hocr_pages):
+    for hocr_page in hocr_pages:
+        hocr_page.remove_line_numbers()
+    return hocr_pages
+
+def set_paragraphs(hocr_pages):
+    for hocr_page in hocr_pages:
+        hocr_page.set_paragraphs()
+        hocr_page.merge_paragraph_lines()
+    return hocr_pages
+
+def get_body_paragraphs(hocr_pages):
+    # all paragraphs except the page header and footer
+    return [paragraph for hocr_page in hocr_pages for paragraph in hocr_page.paragraphs[1:-1]]
+
+def find_candidates(fuzzy_matcher, texts, keywords):
+    return [fuzzy_matcher.find_candidates(text, keyword) for text in texts for keyword in keywords]
+
+def rank_candidates(fuzzy_matcher, keyword_candidates):
+    return [fuzzy_matcher.rank_candidates(candidates, keyword) for keyword, candidates in keyword_candidates]
+
+def make_charters(hocr_pages):
+    # one charter per page, with the body paragraphs in the layout of parse_paragraphs in the notebook
+    charters = []
+    for hocr_page in hocr_pages:
+        paragraphs = [{"lines": paragraph["line_texts"], "line_numbers": paragraph["line_numbers"],
+                       "merged_text": paragraph["merged_text"]} for paragraph in hocr_page.paragraphs[1:-1]]
+        charters += [{"paragraphs": paragraphs}]
+    return charters
+
+def make_place_matchers(gazetteer_rows, snapshot_file):
+    # the exact matcher of the notebook and the compiled gazetteer that the fuzzy matching uses
+    gazetteer_snapshot.compile_gazetteer(gazetteer_rows, snapshot_file)
+    return placename_matcher.PlacenameMatcher(get_variant_index(gazetteer_rows))
+
+def make_place_resolver(snapshot_file):
+    # a resolver with the thresholds of the notebook, with empty caches so runs don't speed up the next
+    fuzzy_matcher = FuzzyMatcher(char_match_threshold=0.7, ngram_threshold=0.5, levenshtein_threshold=0.8)
+    return placename_service.PlacenameResolver(gazetteer_snapshot.GazetteerSnapshot(snapshot_file), fuzzy_matcher)
+
+def match_places(charters, place_matcher, resolver):
+    """
+    The place matching stage of the notebook: exact matches of all placenames in each charter
+    with the PlacenameMatcher, and fuzzy matches for the candidate strings of each line with
+    PlacenameResolver, which shares the notebook's fuzzy matching steps.
+    Returns the number of exact and fuzzy matches.
+    """
+    num_exact, num_fuzzy = 0, 0
+    for charter in charters:
+        charter_text = " ".join([paragraph["merged_text"] for paragraph in charter["paragraphs"]])
+        num_exact += len(place_matcher.match_charter(charter, charter_text))
+        # as fuzzy_lookup_place_in_paragraph, per line of each paragraph
+        results, num_candidates = resolver.resolve_batch([{"paragraphs": [paragraph["lines"]
+                                                                          for paragraph in charter["paragraphs"]]}])
+        num_fuzzy += len([match for paragraph_matches in results[0] for line_matches in paragraph_matches
+                          for match in line_matches if match["match_type"] == "fuzzy"])
+    resolver.placename_index.close()
+    return {"exact_matches": num_exact, "fuzzy_matches": num_fuzzy}
+
+def benchmark_corpus(hocr_files, gazetteer_rows, keywords, snapshot_file, parser="stream"):
+    """
+    Times each stage on the given (filepath, page_num) pairs. Returns per stage the seconds,
+    the number of items (pages, paragraph-keyword pairs or charters), the throughput and
+    the peak memory allocated during the stage. The gazetteer is compiled to snapshot_file.
+    """
+    results = {}
+    num_pages = len(hocr_files)
+    seconds, peak_memory, hocr_pages = measure(
+        lambda: hocr_files,
+        lambda files: [parse_hocr_files.make_hocr_page(filepath, page_num, remove_line_numbers=True, parser=parser)
+                       for filepath, page_num in files])
+    results["make_hocr_page"] = make_stage_result(seconds, peak_memory, num_pages)
+    seconds, peak_memory, _ = measure(lambda: parse_pages(hocr_files, parser), remove_line_numbers)
+    results["remove_line_numbers"] = make_stage_result(seconds, peak_memory, num_pages)
+    seconds, peak_memory, _ = measure(lambda: remove_line_numbers(parse_pages(hocr_files, parser)), set_paragraphs)
+    results["set_paragraphs"] = make_stage_result(seconds, peak_memory, num_pages)
+    texts = [paragraph["merged_text"] for paragraph in get_body_paragraphs(hocr_pages)]
+    # a new fuzzy matcher for each run, so scores cached in one run don't speed up the next
+    seconds, peak_memory, candidates = measure(lambda: FuzzyMatcher(),
+                                               lambda fuzzy_matcher: find_candidates(fuzzy_matcher, texts, keywords))
+    results["find_candidates"] = make_stage_result(seconds, peak_memory, len(texts) * len(keywords))
+    keyword_candidates = list(zip([keyword for text in texts for keyword in keywords], candidates))
+    seconds, peak_memory, _ = measure(lambda: FuzzyMatcher(),
+                                      lambda fuzzy_matcher: rank_candidates(fuzzy_matcher, keyword_candidates))
+    results["rank_candidates"] = make_stage_result(seconds, peak_memory, len(keyword_candidates))
+    results["rank_candidates"]["candidates"] = sum([len(candidates) for keyword, candidates in keyword_candidates])
+    seconds, peak_memory, place_matcher = measure(lambda: gazetteer_rows,
+                                                  lambda rows: make_place_matchers(rows, snapshot_file))
+    results["build_place_matchers"] = make_stage_result(seconds, peak_memory, len(gazetteer_rows) - 1)
+    charters = make_charters(hocr_pages)
+    seconds, peak_memory, matches = measure(lambda: make_place_resolver(snapshot_file),
+                                            lambda resolver: match_places(charters, place_matcher, resolver))
+    results["place_matching"] = make_stage_result(seconds, peak_memory, len(charters))
+    results["place_matching"].update(matches)
+    return results
+
+def run_benchmarks(work_dir=None, corpus_sizes=(10, 50, 200), num_places=1000, num_keywords=20, parser="stream",
+                   seed=0):
+    """
+    Generates a synthetic gazetteer and a synthetic book for each corpus size (in pages)
+    and times all stages on each. The data only depends on the seed and the sizes, so
+    results of different versions of the code are comparable (see compare_results).
+    Without a work_dir, the synthetic books are written to a temporary directory,
+    which is removed afterwards.
+    """
+    if work_dir is None:
+        with tempfile.TemporaryDirectory(prefix="ohz-benchmark-") as tmp_dir:
+            return run_benchmarks(tmp_dir, corpus_sizes, num_places, num_keywords, parser, seed)
+    gazetteer_rows = make_synthetic_gazetteer(num_places, seed=seed)
+    is_variant_of = get_variant_index(gazetteer_rows)
+    preferred_placenames = [row[1] for row in gazetteer_rows[1:] if row[2] is not None]
+    keywords = random.Random(seed).sample(preferred_placenames, min(num_keywords, len(preferred_placenames)))
+    results = {
+        "suite_version": SUITE_VERSION,
+        "parser_version": parse_hocr_files.PARSER_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {"num_places": num_places, "num_variants": len(is_variant_of), "num_keywords": len(keywords),
+                     "parser": parser, "seed": seed},
+        "corpus_sizes": {},
+    }
+    for num_pages in corpus_sizes:
+        hocr_dir = os.path.join(work_dir, "synthetic-{s}-{n}".format(s=seed, n=num_pages))
+        page_charters = write_synthetic_book(hocr_dir, num_pages, placenames=preferred_placenames, seed=seed)
+        hocr_files = list(parse_hocr_files.get_hocr_files(hocr_dir))
+        # pages must survive being sent from the worker processes of process_books
+        if process_charter_books.check_pool_round_trip(hocr_files[:4], remove_line_numbers=True, parser=parser):
+            raise ValueError("Pages parsed in worker processes differ from pages parsed in this process")
+        print("Benchmarking {n} pages with {c} charters".format(n=num_pages, c=sum(map(len, page_charters.values()))))
+        snapshot_file = os.path.join(work_dir, "synthetic-{s}.snapshot".format(s=seed))
+        results["corpus_sizes"][str(num_pages)] = benchmark_corpus(hocr_files, gazetteer_rows, keywords, snapshot_file,
+                                                                   parser)
+    return results
+
+def save_results(results, results_file):
+    with open(results_file, 'wt') as fh:
+        json.dump(results, fh, indent=4)
+
+def load_results(results_file):
+    with open(results_file, 'rt') as fh:
+        return json.load(fh)
+
+def compare_results(baseline, results, max_slowdown=0.2, max_memory_growth=0.2):
+    """
+    Returns the regressions of results compared to baseline results: stages of the same corpus
+    size whose throughput dropped by more than max_slowdown, or whose peak memory grew by more
+    than max_memory_growth (both as a fraction of the baseline).
+    """
+    if baseline["suite_version"] != results["suite_version"] or baseline["settings"] != results["settings"]:
+        raise ValueError("Benchmark results were made with a different suite version or settings")
+    regressions = []
+    for corpus_size, stages in results["corpus_sizes"].items():
+        for stage, stage_result in stages.items():
+            baseline_result = baseline["corpus_sizes"].get(corpus_size, {}).get(stage)
+            if not baseline_result:
+                continue
+            if baseline_result["items_per_second"] and stage_result["items_per_second"]:
+                change = stage_result["items_per_second"] / baseline_result["items_per_second"] - 1
+                if change < -max_slowdown:
+                    regressions += [{"corpus_size": corpus_size, "stage": stage, "measure": "items_per_second",
+                                     "baseline": baseline_result["items_per_second"],
+                                     "result": stage_result["items_per_second"], "change": change}]
+            if baseline_result["peak_memory_bytes"] > 0:
+                change = stage_result["peak_memory_bytes"] / baseline_result["peak_memory_bytes"] - 1
+                if change > max_memory_growth:
+                    regressions += [{"corpus_size": corpus_size, "stage": stage, "measure": "peak_memory_bytes",
+                                     "baseline": baseline_result["peak_memory_bytes"],
+                                     "result": stage_result["peak_memory_bytes"], "change": change}]
+    return regressions
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="Benchmark the charter pipeline on synthetic charter books")
+    argument_parser.add_argument("results_file", help="JSON file to write the results to")
+    argument_parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 200], help="corpus sizes in pages")
+    argument_parser.add_argument("--places", type=int, default=1000, help="number of places in the gazetteer")
+    argument_parser.add_argument("--parser", default="stream", choices=parse_hocr_files.PARSER_BACKENDS)
+    argument_parser.add_argument("--seed", type=int, default=0)
+    argument_parser.add_argument("--work-dir", help="directory for the synthetic books, default a temporary directory")
+    argument_parser.add_argument("--baseline", help="JSON file with earlier results to check for regressions")
+    args = argument_parser.parse_args()
+    benchmark_results = run_benchmarks(args.work_dir, args.sizes, args.places, parser=args.parser, seed=args.seed)
+    save_results(benchmark_results, args.results_file)
+    if args.baseline:
+        for regression in compare_results(load_results(args.baseline), benchmark_results):
+            print("Regression:", regression)
@@ -0,0 +1,278 @@
+import copy
+import re
+import time
+from datetime import date as to_date
+
+
+MINIMUM_YEAR = 719
+MAXIMUM_YEAR = 1299
+
+MONTHS = ["jan.", "feb.", "mrt.", "apr.", "mei", "juni", "juli", "aug.", "sept.", "okt.", "nov.", "dec."]
+
+# Compiled patterns of the normalising steps for charter date strings, see normalize_date_string.
+month_name_pattern = re.compile(r"januari|februari|febr|maart|april|augustus|september|oktober|november|december")
+month_names = {
+    "januari": "jan", "februari": "feb", "febr": "feb", "maart": "mrt", "april": "apr",
+    "augustus": "aug", "september": "sept", "oktober": "okt", "november": "nov", "december": "dec"
+}
+month_abbreviation_pattern = re.compile(r"\b(jan|feb|mrt|apr|aug|sept|okt|nov|dec)(:|(?= )|$)")
+initial_digit_pattern = re.compile(r"^[0-9gioz] {2,}(?=[0-9gioz])")
+year_comma_pattern = re.compile(r"([0-9gioz]{3,4}),")
+uncertainty_term_patterns = [
+    re.compile(r"\b(vermoedelijk|verm.|waarschijnlijk|ws.) "),
+    re.compile(r" (vermoedelijk|verm.|waarschijnlijk|ws.)\b"),
+]
+modifier_patterns = [
+    (re.compile(r"\b(c.|ca.|circa) "), "circa"),
+    (re.compile(r"\b(enige tijd voor|kort voor|uiterlijk|voor) "), "earlier"),
+    (re.compile(r"\b(kort na|na) "), "later"),
+    (re.compile(r" of kort daarna"), "or_later"),
+    (re.compile(r" of kort daarvoor"), "or_earlier"),
+]
+or_pattern = re.compile(r" of ")
+
+# Date grammar: each form is a sequence of YEAR, MONTH, DAY and SEP (range separator) tokens.
+# All forms are combined in a single anchored pattern that is tried in the order below,
+# the order of the original cascade of date functions.
+date_token_patterns = {
+    "YEAR": r"[0-9gioz]{3,4}",
+    "MONTH": r"jan\.|feb\.|febr\.|mrt\.|apr\.|mei|juni|juli|aug\.|sept\.|okt\.|nov\.|dec\.",
+    "DAY": r"[0-9gioz]{1,2}",
+    "SEP": r"-|\?|-\?| \?|\? | \? ",
+}
+date_forms = [
+    # name, tokens, date specificity
+    ("specific_date", "YEAR MONTH DAY", "specific_date"),
+    ("full_date_range", "YEAR MONTH DAY SEP YEAR MONTH DAY", "range_date"),
+    ("year_and_date_range", "YEAR MONTH DAY SEP MONTH DAY", "specific_year_range_month_day"),
+    ("year_month_and_day_range", "YEAR MONTH DAY SEP DAY", "specifc_year_month_range_day"),
+    ("year_range_and_date", "YEAR SEP YEAR MONTH DAY", "range_year_specific_month_day"),
+    ("year_month_and_full_date", "YEAR MONTH SEP YEAR MONTH DAY", "specific_year_month_range_date"),
+    ("year_month_year_month", "YEAR MONTH SEP YEAR MONTH", "range_year_month"),
+    ("year_month_month_day", "YEAR MONTH SEP MONTH DAY", "specific_year_range_month_day"),
+    ("year_month", "YEAR MONTH", "specific_year_month"),
+]
+# These two forms are matched after deconfusing the whole date string.
+year_forms = [
+    ("specific_year", "YEAR", "specific_year"),
+    ("year_range", "YEAR - YEAR", "range_year"),
+]
+
+
+def make_form_pattern(form_name, form_tokens):
+    # e.g. "YEAR MONTH" -> (?P<year_month__0>[0-9gioz]{3,4}) (?P<year_month__1>jan\.|...)
+    # SEP and - tokens are joined without spaces, as the separators include their own spaces.
+    form_pattern = ""
+    token_index = 0
+    previous_token = None
+    for token in form_tokens.split(" "):
+        if previous_token and previous_token not in ["SEP", "-"] and token not in ["SEP", "-"]:
+            form_pattern += " "
+        if token == "-":
+            form_pattern += "-"
+        else:
+            form_pattern += "(?P<{f}__{i}>{p})".format(f=form_name, i=token_index, p=date_token_patterns[token])
+            token_index += 1
+        previous_token = token
+    return "(?P<{f}>{p})".format(f=form_name, p=form_pattern)
+
+def make_grammar_pattern(forms):
+    return re.compile("^(?:" + "|".join([make_form_pattern(name, tokens) for name, tokens, specificity in forms]) + ")$")
+
+date_grammar = make_grammar_pattern(date_forms)
+year_grammar = make_grammar_pattern(year_forms)
+# re.IGNORECASE also matches the Turkish dotted and dotless i to i
+deconfuse_table = str.maketrans("iIİızZgGoO", "1111229900")
+deconfuse_u_pattern = re.compile(r"u(\d+)", re.IGNORECASE)
+
+
+def deconfuse(text):
+    # same as the notebook's deconfuse for charter numbers and dates
+    return deconfuse_u_pattern.sub(r"11\1", text.translate(deconfuse_table))
+
+def normalize_months(date_string):
+    date_string = month_name_pattern.sub(lambda match: month_names[match.group(0)], date_string)
+    return month_abbreviation_pattern.sub(r"\1.", date_string)
+
+def normalize_date_string(date_string):
+    """
+    Returns the normalised date string, with its certainty and modifier, after removing
+    falseness, uncertainty, circa, earlier and later indicators.
+    """
+    date_string = date_string.lower()
+    date_certainty = "certain"
+    date_modifier = ""
+    date_string = date_string.replace(";", "]").replace("v??r", "voor")
+    # remove initial single digit, e.g. "1   1299 okt. 12"
+    date_string = initial_digit_pattern.sub("", date_string)
+    # remove comma after year, e.g. "1299, "
+    date_string = year_comma_pattern.sub(r"\1", date_string)
+    # remove falseness indicator
+    if "<" in date_string and ">" in date_string:
+        date_string = date_string.replace("<", "").replace(">", "")
+        date_certainty = "unreliable"
+    # remove uncertainty indicator
+    if "[" in date_string and "]" in date_string:
+        date_string = date_string.replace("[", "").replace("]", "")
+        date_certainty = "uncertain"
+    if date_string[:1] == "[":
+        date_string = date_string[1:]
+        date_certainty = "uncertain"
+    # remove uncertainty terms, e.g. "vermoedelijk|verm.|waarschijnlijk|ws."
+    for uncertainty_term_pattern in uncertainty_term_patterns:
+        date_string, num_subs = uncertainty_term_pattern.subn("", date_string)
+        if num_subs:
+            date_certainty = "uncertain"
+    # remove circa, earlier and later indicators
+    for modifier_pattern, modifier in modifier_patterns:
+        date_string, num_subs = modifier_pattern.subn("", date_string)
+        if num_subs:
+            date_modifier = modifier
+    # replace or indicator with start-end indicator
+    date_string, num_subs = or_pattern.subn("-", date_string)
+    if num_subs:
+        date_modifier = date_modifier + "_or_dates" if len(date_modifier) > 0 else "or_dates"
+    return normalize_months(date_string), date_certainty, date_modifier
+
+def get_form_values(match, form_name, form_tokens):
+    # the matched text of each token of the form, except the literal - tokens
+    num_values = len([token for token in form_tokens.split(" ") if token != "-"])
+    return [match.group("{f}__{i}".format(f=form_name, i=token_index)) for token_index in range(num_values)]
+
+def make_date_tuples(form_name, form_tokens, values):
+    # Splits the token values in a start and end date tuple of (year, month, day) parts,
+    # with missing parts of the end date (e.g. the year in YEAR MONTH DAY SEP DAY) taken from the start.
+    start, end = {}, {}
+    current = start
+    for token in form_tokens.split(" "):
+        if token == "-":
+            current = end
+            continue
+        value = values.pop(0)
+        if token == "SEP":
+            current = end
+        elif token == "MONTH":
+            current[token] = MONTHS.index("feb." if value == "febr." else value) + 1
+        else:
+            current[token] = int(deconfuse(value))
+    if form_name == "year_range_and_date":
+        # the month and day apply to both years
+        start["MONTH"], start["DAY"] = end["MONTH"], end["DAY"]
+    start_tuple = tuple([start[part] for part in ["YEAR", "MONTH", "DAY"] if part in start])
+    if not end:
+        return start_tuple, start_tuple
+    end_parts = dict(start)
+    end_parts.update(end)
+    end_tuple = tuple([end_parts[part] for part in ["YEAR", "MONTH", "DAY"] if part in end_parts])
+    return start_tuple, end_tuple
+
+def is_valid_date_tuple(date_tuple):
+    if date_tuple[0] < MINIMUM_YEAR or date_tuple[0] > MAXIMUM_YEAR:
+        return False
+    if len(date_tuple) == 3 and date_tuple[2] > 31:
+        return False
+    return True
+
+def make_proper_date(date_tuple):
+    # if there's only a year and month, assume first day of the month.
+    # if there's only a year, assume first day of january.
+    if len(date_tuple) == 1:
+        return to_date(date_tuple[0], 1, 1)
+    if len(date_tuple) == 2:
+        return to_date(date_tuple[0], date_tuple[1], 1)
+    return to_date(date_tuple[0], date_tuple[1], date_tuple[2])
+
+def match_date_grammar(date_string):
+    # returns the matched form and its start and end date tuples, or None
+    for grammar, forms, match_string in [(date_grammar, date_forms, date_string),
+                                         (year_grammar, year_forms, deconfuse(date_string))]:
+        match = grammar.match(match_string)
+        if not match:
+            continue
+        for form_name, form_tokens, date_specificity in forms:
+            if match.group(form_name) is not None:
+                values = get_form_values(match, form_name, form_tokens)
+                start_tuple, end_tuple = make_date_tuples(form_name, form_tokens, values)
+                if not is_valid_date_tuple(start_tuple) or not is_valid_date_tuple(end_tuple):
+                    return None
+                return date_specificity, start_tuple, end_tuple
+    return None
+
+def parse_date_string(date_string):
+    """
+    Single pass date parser for charter titles. Returns the date info (sort, start and end years and
+    dates, date specificity, certainty, modifier and the normalised date string) or None if the
+    date string can't be parsed. Gives the same date info as the notebook's parse_date_string.
+    """
+    if len(date_string) == 0:
+        return None
+    date_string, date_certainty, date_modifier = normalize_date_string(date_string)
+    grammar_match = match_date_grammar(date_string)
+    if not grammar_match:
+        return None
+    date_specificity, start_tuple, end_tuple = grammar_match
+    date_info = {
+        "sort_year": start_tuple[0],
+        "start_year": start_tuple[0],
+        "end_year": end_tuple[0],
+        "sort_date": make_proper_date(start_tuple),
+        "start_date": make_proper_date(start_tuple),
+        "end_date": make_proper_date(end_tuple),
+        "date_specificity": date_specificity,
+        "date_certainty": date_certainty,
+        "date_string": date_string,
+        "date_modifier": date_modifier,
+    }
+    return date_info
+
+def make_unknown_date_info(date_string):
+    return {
+        "sort_year": None, "start_year": None, "end_year": None,
+        "sort_date": None, "start_date": None, "end_date": None,
+        "date_specificity": "unknown", "date_certainty": "unknown",
+        "date_modifier": "unknown", "date_string": date_string,
+    }
+
+def parse_charter_dates(date_strings, exceptions=None):
+    """
+    Batch parses the date strings of charter titles, given as a dict of charter number to date string.
+    Charters in exceptions get a copy of their exception date info instead. Returns a dict of
+    charter number to date info, with the unknown date info for date strings that can't be parsed.
+    """
+    charter_dates = {}
+    for charter_num, date_string in date_strings.items():
+        if exceptions and charter_num in exceptions:
+            charter_dates[charter_num] = copy.deepcopy(exceptions[charter_num])
+            continue
+        date_info = parse_date_string(date_string)
+        if date_info:
+            # keep the original date string, as the charter stage does
+            date_info["date_string"] = date_string
+        else:
+            date_info = make_unknown_date_info(date_string)
+        charter_dates[charter_num] = date_info
+    return charter_dates
+
+def compare_date_parsers(date_strings, reference_parse_date_string):
+    """
+    Compares parse_date_string with a reference parser, e.g. the notebook's parse_date_string(date_string,
+    charter_num), on the given dict of charter number to date string. Returns the number of date strings,
+    the seconds per parser and the charters for which the date info differs.
+    """
+    report = {"date_strings": len(date_strings), "seconds": {}, "differences": []}
+    start = time.time()
+    reference_dates = {charter_num: reference_parse_date_string(copy.copy(date_string), charter_num)
+                       for charter_num, date_string in date_strings.items()}
+    report["seconds"]["reference"] = time.time() - start
+    start = time.time()
+    charter_dates = {charter_num: parse_date_string(date_string) for charter_num, date_string in date_strings.items()}
+    report["seconds"]["single_pass"] = time.time() - start
+    for charter_num in date_strings:
+        if reference_dates[charter_num] != charter_dates[charter_num]:
+            report["differences"] += [{
+                "charter_num": charter_num,
+                "date_string": date_strings[charter_num],
+                "reference": reference_dates[charter_num],
+                "single_pass": charter_dates[charter_num],
+            }]
+    return report
@@ -0,0 +1,186 @@
+import re
+
+import charter_dates
+
+
+# Detector for charter titles, with the same results as the regular expressions of the
+# notebook's check_paragraph. Instead of building and running up to ten patterns for each
+# line and each expected charter number, each line is tokenised once into space separated
+# tokens with their column offset and the whitespace runs around them. From the tokens, a
+# line table lists which numbers would be accepted by which rule, so checking a line
+# against an expected number is a few dict lookups.
+token_pattern = re.compile(r"[^ ]+")
+ascii_number_pattern = re.compile(r"[0-9]+")
+# same as \d in the original patterns, i.e. including non-ASCII digits
+digit_run_pattern = re.compile(r"\d+")
+# character columns of the centre of a title line in the OHZ books, as in check_paragraph
+CENTER_COLUMNS = (34, 48)
+
+
+def tokenize_line(line):
+    # returns a list of (column offset, whitespace before, token, whitespace after) tuples
+    matches = list(token_pattern.finditer(line))
+    tokens = []
+    previous_end = 0
+    for index, match in enumerate(matches):
+        next_start = matches[index+1].start() if index+1 < len(matches) else len(line)
+        tokens += [(match.start(), match.start() - previous_end, match.group(), next_start - match.end())]
+        previous_end = match.end()
+    return tokens
+
+def get_hyphen_numbers(token):
+    # All numbers that the pattern (\d+-)+N matches at the start of the token, e.g. "2597-2598-2599"
+    # gives 2598 and 2599 and their prefixes, as N only has to be at the start of what follows a hyphen.
+    hyphen_numbers = set()
+    position = 0
+    while True:
+        match = digit_run_pattern.match(token, position)
+        if not match or token[match.end():match.end()+1] != "-":
+            return hyphen_numbers
+        position = match.end() + 1
+        number_match = digit_run_pattern.match(token, position)
+        if number_match:
+            number = number_match.group()
+            hyphen_numbers.update([number[:length] for length in range(1, len(number)+1)])
+
+def make_line_table(line, center_columns=CENTER_COLUMNS):
+    """
+    Returns the numbers that the rules of check_paragraph accept in a line, as strings:
+    - numbers: numbers accepted for any expected number
+    - large_numbers: numbers only accepted for expected numbers above 2000
+    - ranges: the start number of ranges, e.g. 2599-2608, with the end number in range_ends
+    - hyphen_numbers: numbers in a title with several numbers separated by hyphens
+    and the text at the centre of the line, for titles without whitespace around the number.
+    """
+    line_table = {
+        "numbers": set(),
+        "large_numbers": set(),
+        "ranges": set(),
+        "range_ends": {},
+        "hyphen_numbers": set(),
+        "center_chars": None,
+        "center_text": None,
+    }
+    tokens = tokenize_line(line)
+    for index, (offset, space_before, token, space_after) in enumerate(tokens):
+        is_last = index == len(tokens) - 1
+        # .{20,}  N  (only used for numbers above 2000)
+        if space_before >= 2 and offset >= 22 and space_after >= 1:
+            line_table["large_numbers"].add(token)
+        # .{10,} {3,}N {4,}  (only used for numbers above 2000)
+        if space_before >= 3 and offset >= 13 and space_after >= 4:
+            line_table["large_numbers"].add(token)
+        # .{20,} N-1 N {2,}
+        if index > 0 and space_before == 1 and space_after >= 2 and ascii_number_pattern.fullmatch(token):
+            previous_offset, previous_space, previous_token, _ = tokens[index-1]
+            if previous_space >= 1 and previous_offset >= 21 and previous_token == str(int(token) - 1):
+                line_table["numbers"].add(token)
+        # .{10,} {4,}N {4,}
+        if space_before >= 4 and offset >= 14 and space_after >= 4:
+            line_table["numbers"].add(token)
+        # .{20,} {2,}N {2,}
+        if space_before >= 2 and offset >= 22 and space_after >= 2:
+            line_table["numbers"].add(token)
+        # .{20,} {2,}N$
+        if space_before >= 2 and offset >= 22 and is_last and space_after == 0:
+            line_table["numbers"].add(token)
+        if space_before < 2 or "-" not in token:
+            continue
+        # .{20,} {2,}N-\d+, the end number is taken from the first range anywhere in the line
+        start_number, _, rest = token.partition("-")
+        end_match = digit_run_pattern.match(rest)
+        if end_match:
+            if start_number not in line_table["range_ends"]:
+                line_table["range_ends"][start_number] = int(end_match.group())
+            if offset >= 22:
+                line_table["ranges"].add(start_number)
+        # .{20,} {2,}(\d+-)+N, which also covers .{20,} {2,}\d+-N-\d+
+        if offset >= 22:
+            line_table["hyphen_numbers"].update(get_hyphen_numbers(token))
+    center_string = line[center_columns[0]:center_columns[1]]
+    if len(center_string) > 0:
+        line_table["center_chars"] = len(center_string.replace(" ", ""))
+        center_text = charter_dates.deconfuse(center_string.strip())
+        if center_text.isdigit():
+            line_table["center_text"] = center_text
+    return line_table
+
+def check_line_table(line_table, next_number, lookup_number):
+    # returns the candidate for a line in the same way as check_paragraph, or None
+    number = str(lookup_number)
+    if number in line_table["numbers"] or (lookup_number > 2000 and number in line_table["large_numbers"]):
+        return next_number
+    if number in line_table["ranges"]:
+        return (next_number, line_table["range_ends"][number])
+    if number in line_table["hyphen_numbers"]:
+        return next_number
+    # If none of the rules hold, look for the charter number at the centre of the line.
+    if line_table["center_chars"] is None or line_table["center_chars"] > len(number) + 1:
+        return None
+    if line_table["center_text"] is not None:
+        return int(line_table["center_text"])
+    return None
+
+
+class CharterTitleDetector(object):
+
+    def __init__(self, known_ocr_errors, reference_check_paragraph=None, center_columns=CENTER_COLUMNS):
+        """
+        Action: checks whether paragraphs are charter titles with the expected charter number
+        Input: the mapping of charter numbers to their OCR'ed number, optionally a reference
+        check_paragraph(paragraph, next_number) to compare each result with, and the character
+        columns of the centre of a title line
+        Output: a CharterTitleDetector object
+
+        Differences with the reference are collected in differences, so a run over all books
+        with a reference shows whether both give the same charter titles. For books with a
+        different layout, pass the center_columns of a page made with estimate_layout (see
+        make_hocr_page) to make_paragraph_table and check_paragraph to use the centre
+        columns of that page instead.
+        """
+        self.known_ocr_errors = known_ocr_errors
+        self.center_columns = center_columns
+        self.reference_check_paragraph = reference_check_paragraph
+        self.differences = []
+
+    def make_paragraph_table(self, paragraph, center_columns=None):
+        """
+        Returns the line tables of a paragraph, or None if the paragraph can't be a charter title,
+        i.e. it has more than 3 lines or a line with more than 60 characters. The table only
+        depends on the paragraph, so it can be reused to check the paragraph for successive numbers.
+        Without center_columns, the centre columns of the detector are used.
+        """
+        if len(paragraph["line_texts"]) > 3:
+            return None
+        most_chars_per_line = max([len(line.replace(" ", "")) for line in paragraph["line_texts"]])
+        if most_chars_per_line > 60:
+            return None
+        if center_columns is None:
+            center_columns = self.center_columns
+        return [make_line_table(line, center_columns) for line in paragraph["line_texts"]]
+
+    def check_paragraph(self, paragraph, next_number, paragraph_table=None, center_columns=None):
+        """
+        Same as the notebook's check_paragraph: returns the charter number if the paragraph is a
+        charter title, a (start, end) tuple for a title with a range of numbers, and False otherwise.
+        """
+        if paragraph_table is None:
+            paragraph_table = self.make_paragraph_table(paragraph, center_columns)
+        candidate = False
+        if paragraph_table is not None:
+            lookup_number = self.known_ocr_errors.get(next_number, next_number)
+            for line_table in paragraph_table:
+                line_candidate = check_line_table(line_table, next_number, lookup_number)
+                if line_candidate is not None:
+                    candidate = line_candidate
+                    break
+        if self.reference_check_paragraph:
+            reference_candidate = self.reference_check_paragraph(paragraph, next_number)
+            if reference_candidate != candidate or type(reference_candidate) != type(candidate):
+                self.differences += [{
+                    "line_texts": paragraph["line_texts"],
+                    "next_number": next_number,
+                    "reference": reference_candidate,
+                    "candidate": candidate,
+                }]
+        return candidate
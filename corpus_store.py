@@ -0,0 +1,438 @@
+import bisect
+import json
+import mmap
+import os
+import struct
+from array import array
+
+import parse_hocr_files
+
+
+# file format identifier, followed by the length of the JSON header
+MAGIC = b"OHZCS001"
+HEADER_STRUCT = struct.Struct("<8sI")
+# columns are aligned to this number of bytes
+ALIGNMENT = 8
+# a page number below this factor, see get_page_key
+PAGE_KEY_FACTOR = 100000
+
+# name -> typecode of the columns, grouped per table. Columns ending in _end hold the cumulative
+# end offsets of variable length rows in another column or text buffer, e.g. the words of line i
+# are word rows line_word_end[i-1] (or 0) to line_word_end[i].
+PAGE_COLUMNS = [
+    ("page_key", "q"), ("page_book", "i"), ("page_num", "i"), ("page_carea_bbox", "i"), ("page_flags", "i"),
+    ("page_line_end", "q"), ("page_paragraph_end", "q"),
+]
+LINE_COLUMNS = [
+    ("line_bbox", "i"), ("line_word_end", "q"), ("line_text_end", "q"), ("spaced_text_end", "q"),
+    ("clean_text_end", "q"),
+]
+WORD_COLUMNS = [
+    ("word_bbox", "i"), ("word_conf", "i"), ("word_text_end", "q"),
+]
+PARAGRAPH_COLUMNS = [
+    ("paragraph_page", "q"), ("paragraph_num", "i"), ("paragraph_type", "i"), ("paragraph_flags", "i"),
+    ("paragraph_line_end", "q"), ("paragraph_lines", "q"), ("paragraph_text_end", "q"),
+    ("paragraph_charter_end", "q"), ("paragraph_charters", "i"),
+]
+CHARTER_COLUMNS = [
+    ("charter_num", "i"), ("charter_paragraph_end", "q"), ("charter_paragraphs", "q"),
+]
+COLUMNS = PAGE_COLUMNS + LINE_COLUMNS + WORD_COLUMNS + PARAGRAPH_COLUMNS + CHARTER_COLUMNS
+TEXT_BUFFERS = ["line_text", "spaced_text", "clean_text", "word_text", "paragraph_text"]
+
+# page flags
+HAS_CLEAN_TEXT = 1
+# paragraph flags
+HAS_CHARTER_NUMBER = 1
+HAS_PAGE_NUM = 2
+
+
+def get_page_key(book_num, page_num):
+    # pages are stored in book and page order, so a page can be found by bisecting the page keys
+    return book_num * PAGE_KEY_FACTOR + page_num
+
+def get_row_range(end_column, row):
+    return (end_column[row-1] if row > 0 else 0), end_column[row]
+
+
+class PageColumns(object):
+
+    def __init__(self, hocr_page, book_num, paragraph_types):
+        """
+        The columns of a single page, with row offsets that are local to the page.
+        They are combined in page order when the corpus store is written.
+        """
+        self.book_num = book_num
+        self.page_num = hocr_page.page_num
+        self.carea_bbox = list(hocr_page.carea["bbox"])
+        self.has_clean_text = len(hocr_page.lines) > 0 and all(["clean_line_text" in line for line in hocr_page.lines])
+        self.columns = {column: array(typecode) for column, typecode in LINE_COLUMNS + WORD_COLUMNS + PARAGRAPH_COLUMNS}
+        self.texts = {text_buffer: bytearray() for text_buffer in TEXT_BUFFERS}
+        for line in hocr_page.lines:
+            self.add_line(line)
+        for paragraph in hocr_page.paragraphs:
+            self.add_paragraph(paragraph, hocr_page.lines, paragraph_types)
+
+    def add_text(self, text_buffer, text, end_column):
+        self.texts[text_buffer] += text.encode("utf-8")
+        self.columns[end_column].append(len(self.texts[text_buffer]))
+
+    def add_line(self, line):
+        self.columns["line_bbox"].extend(line["bbox"])
+        self.add_text("line_text", line["line_text"], "line_text_end")
+        self.add_text("spaced_text", line["spaced_line_text"], "spaced_text_end")
+        self.add_text("clean_text", line["clean_line_text"] if self.has_clean_text else "", "clean_text_end")
+        for word in line["words"]:
+            self.columns["word_bbox"].extend(word["bbox"])
+            # -1 for words without a confidence score
+            self.columns["word_conf"].append(-1 if word["word_conf"] is None else word["word_conf"])
+            self.add_text("word_text", word["word_text"], "word_text_end")
+        self.columns["line_word_end"].append(len(self.columns["word_conf"]))
+
+    def add_paragraph(self, paragraph, lines, paragraph_types):
+        line_texts = [lines[line_index]["clean_line_text" if self.has_clean_text else "spaced_line_text"]
+                      for line_index in paragraph["line_numbers"]]
+        if line_texts != paragraph["line_texts"]:
+            # the line texts are not stored separately, but taken from the lines of the page
+            raise ValueError("Line texts of paragraph {p} on page {n} differ from the page lines".format(
+                p=paragraph.get("paragraph_num"), n=self.page_num))
+        if paragraph["type"] not in paragraph_types:
+            paragraph_types.append(paragraph["type"])
+        flags = HAS_CHARTER_NUMBER if "charter_number" in paragraph else 0
+        flags |= HAS_PAGE_NUM if "page_num" in paragraph else 0
+        self.columns["paragraph_num"].append(paragraph.get("paragraph_num", -1))
+        self.columns["paragraph_type"].append(paragraph_types.index(paragraph["type"]))
+        self.columns["paragraph_flags"].append(flags)
+        self.columns["paragraph_lines"].extend(paragraph["line_numbers"])
+        self.columns["paragraph_line_end"].append(len(self.columns["paragraph_lines"]))
+        self.add_text("paragraph_text", paragraph.get("merged_text", ""), "paragraph_text_end")
+        self.columns["paragraph_charters"].extend(paragraph.get("charter_number", []))
+        self.columns["paragraph_charter_end"].append(len(self.columns["paragraph_charters"]))
+
+
+class StoredPage(object):
+
+    def __init__(self, page_num, carea, lines, paragraphs):
+        # the parts of a HOCRPage that are kept in the corpus store
+        self.page_num = page_num
+        self.carea = carea
+        self.lines = lines
+        self.paragraphs = paragraphs
+
+
+class CorpusWriter(object):
+
+    def __init__(self, store_file):
+        """
+        Action: writes the pages made by make_hocr_page to a columnar corpus store file
+        Input: the file to write the store to
+        Output: a CorpusWriter object
+
+        Pages can be added in any order, e.g. interleaved pages of different books, and are
+        stored in book and page order. Each page is converted to compact columns when it is
+        added. The store is written when the writer is closed (or used as a context manager),
+        to a temporary file first, so readers never see a partial store.
+        """
+        self.store_file = store_file
+        # type names of paragraphs, e.g. header, main_text, charter_title, footer
+        self.paragraph_types = []
+        self.pages = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def add_page(self, hocr_page, book_num):
+        page_key = get_page_key(book_num, hocr_page.page_num)
+        self.pages[page_key] = PageColumns(hocr_page, book_num, self.paragraph_types)
+
+    def add_missing_pages(self, corpus_store):
+        """
+        Adds the pages of an existing store that have not been added, e.g. to combine
+        the changed pages of an incremental run with the other pages of the previous run.
+        """
+        for book_num, page_num in corpus_store.get_page_keys():
+            if get_page_key(book_num, page_num) not in self.pages:
+                self.add_page(corpus_store.get_hocr_page(book_num, page_num), book_num)
+
+    def close(self):
+        columns, texts = self.combine_pages()
+        tmp_file = "{f}.{p}.tmp".format(f=self.store_file, p=os.getpid())
+        write_store(tmp_file, columns, texts, self.paragraph_types)
+        os.replace(tmp_file, self.store_file)
+
+    def combine_pages(self):
+        # concatenate the page columns in page order, shifting the local offsets of each page
+        columns = {column: array(typecode) for column, typecode in COLUMNS}
+        texts = {text_buffer: bytearray() for text_buffer in TEXT_BUFFERS}
+        charter_paragraphs = {}
+        for page_key in sorted(self.pages.keys()):
+            page = self.pages[page_key]
+            line_offset = len(columns["line_word_end"])
+            word_offset = len(columns["word_conf"])
+            paragraph_offset = len(columns["paragraph_num"])
+            paragraph_line_offset = len(columns["paragraph_lines"])
+            paragraph_charter_offset = len(columns["paragraph_charters"])
+            text_offsets = {text_buffer: len(texts[text_buffer]) for text_buffer in TEXT_BUFFERS}
+            page_columns = page.columns
+            columns["line_bbox"].extend(page_columns["line_bbox"])
+            columns["line_word_end"].extend([end + word_offset for end in page_columns["line_word_end"]])
+            for text_buffer, end_column in [("line_text", "line_text_end"), ("spaced_text", "spaced_text_end"),
+                                            ("clean_text", "clean_text_end"), ("word_text", "word_text_end"),
+                                            ("paragraph_text", "paragraph_text_end")]:
+                columns[end_column].extend([end + text_offsets[text_buffer] for end in page_columns[end_column]])
+                texts[text_buffer] += page.texts[text_buffer]
+            columns["word_bbox"].extend(page_columns["word_bbox"])
+            columns["word_conf"].extend(page_columns["word_conf"])
+            page_row = len(columns["page_key"])
+            num_paragraphs = len(page_columns["paragraph_num"])
+            columns["paragraph_page"].extend([page_row] * num_paragraphs)
+            for column in ["paragraph_num", "paragraph_type", "paragraph_flags"]:
+                columns[column].extend(page_columns[column])
+            # paragraph lines are stored as rows of the line table
+            columns["paragraph_lines"].extend([line_index + line_offset for line_index in page_columns["paragraph_lines"]])
+            columns["paragraph_line_end"].extend([end + paragraph_line_offset for end in page_columns["paragraph_line_end"]])
+            columns["paragraph_charters"].extend(page_columns["paragraph_charters"])
+            columns["paragraph_charter_end"].extend([end + paragraph_charter_offset
+                                                     for end in page_columns["paragraph_charter_end"]])
+            for paragraph_index in range(num_paragraphs):
+                start, end = get_row_range(page_columns["paragraph_charter_end"], paragraph_index)
+                for charter_num in page_columns["paragraph_charters"][start:end]:
+                    charter_paragraphs.setdefault(charter_num, []).append(paragraph_offset + paragraph_index)
+            columns["page_key"].append(page_key)
+            columns["page_book"].append(page.book_num)
+            columns["page_num"].append(page.page_num)
+            columns["page_carea_bbox"].extend(page.carea_bbox)
+            columns["page_flags"].append(HAS_CLEAN_TEXT if page.has_clean_text else 0)
+            columns["page_line_end"].append(len(columns["line_word_end"]))
+            columns["page_paragraph_end"].append(len(columns["paragraph_num"]))
+        for charter_num in sorted(charter_paragraphs.keys()):
+            columns["charter_num"].append(charter_num)
+            columns["charter_paragraphs"].extend(charter_paragraphs[charter_num])
+            columns["charter_paragraph_end"].append(len(columns["charter_paragraphs"]))
+        return columns, texts
+
+
+def write_store(store_file, columns, texts, paragraph_types):
+    # header with the byte offset and length of each column and text buffer, relative to the data start
+    header = {"paragraph_types": paragraph_types, "columns": {}, "texts": {}}
+    offset = 0
+    for column, typecode in COLUMNS:
+        header["columns"][column] = [offset, len(columns[column]), typecode]
+        offset += len(columns[column]) * columns[column].itemsize
+        offset += -offset % ALIGNMENT
+    for text_buffer in TEXT_BUFFERS:
+        header["texts"][text_buffer] = [offset, len(texts[text_buffer])]
+        offset += len(texts[text_buffer])
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = HEADER_STRUCT.size + len(header_bytes)
+    data_start += -data_start % ALIGNMENT
+    with open(store_file, 'wb') as fh:
+        fh.write(HEADER_STRUCT.pack(MAGIC, len(header_bytes)))
+        fh.write(header_bytes)
+        fh.write(b"\0" * (data_start - fh.tell()))
+        for column, typecode in COLUMNS:
+            fh.write(columns[column].tobytes())
+            fh.write(b"\0" * (-fh.tell() % ALIGNMENT))
+        for text_buffer in TEXT_BUFFERS:
+            fh.write(texts[text_buffer])
+
+
+class CorpusStore(object):
+
+    def __init__(self, store_file):
+        """
+        Action: memory-mapped reader of a corpus store written by CorpusWriter
+        Input: the corpus store file
+        Output: a CorpusStore object with random access to pages, lines, words,
+        paragraphs and the paragraphs of each charter
+
+        Columns are memoryviews on the memory-mapped file, so nothing is read until
+        it is accessed, and only the accessed rows are turned into Python objects.
+        get_paragraphs and get_charter_numbers work like those of CharterParagraphs,
+        so the charter stage can run directly off the store instead of re-parsing.
+        Close the store (or use it as a context manager) to release the file.
+        """
+        self.store_file = store_file
+        self.fh = open(store_file, 'rb')
+        self.mmap = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = memoryview(self.mmap)
+        magic, header_length = HEADER_STRUCT.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError("Invalid corpus store file: {f}".format(f=store_file))
+        header = json.loads(bytes(self.data[HEADER_STRUCT.size:HEADER_STRUCT.size + header_length]).decode("utf-8"))
+        data_start = HEADER_STRUCT.size + header_length
+        data_start += -data_start % ALIGNMENT
+        self.paragraph_types = header["paragraph_types"]
+        self.columns = {}
+        for column, (offset, length, typecode) in header["columns"].items():
+            start = data_start + offset
+            self.columns[column] = self.data[start:start + length * struct.calcsize(typecode)].cast(typecode)
+        self.texts = {}
+        for text_buffer, (offset, length) in header["texts"].items():
+            self.texts[text_buffer] = self.data[data_start + offset:data_start + offset + length]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        # all views on the memory map have to be released before it can be closed
+        for view in list(self.columns.values()) + list(self.texts.values()):
+            view.release()
+        self.columns, self.texts = {}, {}
+        self.data.release()
+        self.mmap.close()
+        self.fh.close()
+
+    def get_text(self, text_buffer, end_column, row):
+        start, end = get_row_range(self.columns[end_column], row)
+        return str(self.texts[text_buffer][start:end], "utf-8")
+
+    ####################
+    # Page access      #
+    ####################
+
+    def get_num_pages(self):
+        return len(self.columns["page_key"])
+
+    def get_page_keys(self):
+        # (book_num, page_num) of all pages, in book and page order
+        return list(zip(self.columns["page_book"], self.columns["page_num"]))
+
+    def get_book_nums(self):
+        return sorted(set(self.columns["page_book"]))
+
+    def get_page_nums(self, book_num):
+        first_row, last_row = self.get_book_rows(book_num)
+        return list(self.columns["page_num"][first_row:last_row])
+
+    def get_book_rows(self, book_num):
+        # the range of page rows of a book
+        page_keys = self.columns["page_key"]
+        return (bisect.bisect_left(page_keys, get_page_key(book_num, 0)),
+                bisect.bisect_left(page_keys, get_page_key(book_num + 1, 0)))
+
+    def find_page_row(self, book_num, page_num):
+        # returns None if the page is not in the store
+        page_key = get_page_key(book_num, page_num)
+        page_row = bisect.bisect_left(self.columns["page_key"], page_key)
+        if page_row < self.get_num_pages() and self.columns["page_key"][page_row] == page_key:
+            return page_row
+        return None
+
+    def get_page_line_rows(self, page_row):
+        return range(*get_row_range(self.columns["page_line_end"], page_row))
+
+    def get_page_paragraph_rows(self, page_row):
+        return range(*get_row_range(self.columns["page_paragraph_end"], page_row))
+
+    def get_page(self, book_num, page_num):
+        """
+        Returns the page as a dict with book_num, page_num, lines and paragraphs, where lines and
+        paragraphs are the same as those of the HOCRPage made by make_hocr_page, or None.
+        """
+        page_row = self.find_page_row(book_num, page_num)
+        if page_row is None:
+            return None
+        return {
+            "book_num": book_num,
+            "page_num": page_num,
+            "lines": [self.get_line(line_row) for line_row in self.get_page_line_rows(page_row)],
+            "paragraphs": [self.get_paragraph(paragraph_row) for paragraph_row in self.get_page_paragraph_rows(page_row)],
+        }
+
+    def get_hocr_page(self, book_num, page_num):
+        # the page as a StoredPage, e.g. to add it to a CorpusWriter
+        page_row = self.find_page_row(book_num, page_num)
+        page = self.get_page(book_num, page_num)
+        carea = parse_hocr_files.make_hocr_box(list(self.columns["page_carea_bbox"][page_row*4:page_row*4+4]))
+        return StoredPage(page_num, carea, page["lines"], page["paragraphs"])
+
+    ####################
+    # Line access      #
+    ####################
+
+    def get_line_page_row(self, line_row):
+        return bisect.bisect_right(self.columns["page_line_end"], line_row)
+
+    def get_line(self, line_row):
+        line = parse_hocr_files.make_hocr_box(list(self.columns["line_bbox"][line_row*4:line_row*4+4]))
+        line["line_text"] = self.get_text("line_text", "line_text_end", line_row)
+        line["words"] = self.get_words(line_row)
+        line["spaced_line_text"] = self.get_text("spaced_text", "spaced_text_end", line_row)
+        if self.columns["page_flags"][self.get_line_page_row(line_row)] & HAS_CLEAN_TEXT:
+            line["clean_line_text"] = self.get_text("clean_text", "clean_text_end", line_row)
+        return line
+
+    def get_line_text(self, line_row):
+        # the text of a paragraph line: the text without line number if it was removed
+        if self.columns["page_flags"][self.get_line_page_row(line_row)] & HAS_CLEAN_TEXT:
+            return self.get_text("clean_text", "clean_text_end", line_row)
+        return self.get_text("spaced_text", "spaced_text_end", line_row)
+
+    def get_words(self, line_row):
+        return [self.get_word(word_row) for word_row in range(*get_row_range(self.columns["line_word_end"], line_row))]
+
+    def get_word(self, word_row):
+        word = parse_hocr_files.make_hocr_box(list(self.columns["word_bbox"][word_row*4:word_row*4+4]))
+        word["word_text"] = self.get_text("word_text", "word_text_end", word_row)
+        word_conf = self.columns["word_conf"][word_row]
+        word["word_conf"] = None if word_conf == -1 else word_conf
+        return word
+
+    ####################
+    # Paragraph access #
+    ####################
+
+    def get_paragraph(self, paragraph_row):
+        """
+        Returns the paragraph as made by set_paragraphs and merge_paragraph_lines, with its type and
+        charter number(s), and with the book_num as added by CharterParagraphs.
+        """
+        columns = self.columns
+        page_row = columns["paragraph_page"][paragraph_row]
+        first_line_row = columns["page_line_end"][page_row-1] if page_row > 0 else 0
+        line_rows = columns["paragraph_lines"][slice(*get_row_range(columns["paragraph_line_end"], paragraph_row))]
+        flags = columns["paragraph_flags"][paragraph_row]
+        paragraph = {
+            "type": self.paragraph_types[columns["paragraph_type"][paragraph_row]],
+            "line_texts": [self.get_line_text(line_row) for line_row in line_rows],
+            "line_numbers": [line_row - first_line_row for line_row in line_rows],
+        }
+        if flags & HAS_PAGE_NUM:
+            paragraph["page_num"] = columns["page_num"][page_row]
+            paragraph["paragraph_num"] = columns["paragraph_num"][paragraph_row]
+        paragraph["merged_text"] = self.get_text("paragraph_text", "paragraph_text_end", paragraph_row)
+        if flags & HAS_CHARTER_NUMBER:
+            start, end = get_row_range(columns["paragraph_charter_end"], paragraph_row)
+            paragraph["charter_number"] = list(columns["paragraph_charters"][start:end])
+        paragraph["book_num"] = columns["page_book"][page_row]
+        return paragraph
+
+    def get_page_paragraphs(self, book_num, page_num):
+        page_row = self.find_page_row(book_num, page_num)
+        if page_row is None:
+            return []
+        return [self.get_paragraph(paragraph_row) for paragraph_row in self.get_page_paragraph_rows(page_row)]
+
+    ####################
+    # Charter access   #
+    ####################
+
+    def get_charter_numbers(self):
+        return list(self.columns["charter_num"])
+
+    def get_paragraphs(self, charter_num):
+        # the paragraphs of a charter in book, page and paragraph order, as CharterParagraphs.get_paragraphs
+        charter_row = bisect.bisect_left(self.columns["charter_num"], charter_num)
+        if charter_row == len(self.columns["charter_num"]) or self.columns["charter_num"][charter_row] != charter_num:
+            return []
+        start, end = get_row_range(self.columns["charter_paragraph_end"], charter_row)
+        return [self.get_paragraph(paragraph_row) for paragraph_row in self.columns["charter_paragraphs"][start:end]]
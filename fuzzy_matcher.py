@@ -1,13 +1,26 @@
 import re
+import time
+from collections import Counter
+from collections import OrderedDict
+from functools import lru_cache
+
+import pipeline_stats
 
 class FuzzyMatcher(object):
     
-    def __init__(self, char_match_threshold=0.5, ngram_threshold=0.5, levenshtein_threshold=0.5, max_length_variance=1):
+    def __init__(self, char_match_threshold=0.5, ngram_threshold=0.5, levenshtein_threshold=0.5, max_length_variance=1,
+                 max_cached_scores=100000):
         self.char_match_threshold = char_match_threshold
         self.ngram_threshold = ngram_threshold
         self.levenshtein_threshold = levenshtein_threshold
         self.perform_strip_suffix = True
         self.max_length_variance = max_length_variance
+        # Memo of similarity scores per (candidate string, keyword) pair, shared by the
+        # filtering and ranking functions. Least recently used pairs are evicted first.
+        self.max_cached_scores = max_cached_scores
+        self.pair_scores = OrderedDict()
+        self.pair_score_hits = 0
+        self.pair_score_misses = 0
 
     def enable_strip_suffix(self):
         self.perform_strip_suffix = True
@@ -51,6 +64,27 @@ class FuzzyMatcher(object):
             distances = distances_
         return distances[-1]
 
+    def score_bounded_levenshtein_distance(self, s1, s2, max_distance):
+        # Same as score_levenshtein_distance, but stops as soon as the distance is known
+        # to be larger than max_distance. In that case, it returns max_distance + 1.
+        if len(s1) > len(s2):
+            s1, s2 = s2, s1
+        if len(s2) - len(s1) > max_distance:
+            return max_distance + 1
+        distances = range(len(s1) + 1)
+        for i2, c2 in enumerate(s2):
+            distances_ = [i2+1]
+            for i1, c1 in enumerate(s1):
+                if c1 == c2:
+                    distances_.append(distances[i1])
+                else:
+                    distances_.append(1 + min((distances[i1], distances[i1 + 1], distances_[-1])))
+            # distances never decrease from one row to the next
+            if min(distances_) > max_distance:
+                return max_distance + 1
+            distances = distances_
+        return min(distances[-1], max_distance + 1)
+
     def score_char_overlap(self, term1, term2):
         num_char_matches = 0
         for char in term2:
@@ -60,72 +94,132 @@ class FuzzyMatcher(object):
         return num_char_matches
 
     def score_ngram_overlap(self, term1, term2, ngram_size):
-        term1_ngrams = self.make_ngrams(term1, ngram_size)
-        term2_ngrams = self.make_ngrams(term2, ngram_size)
-        overlap = 0
-        for ngram in term1_ngrams:
-            if ngram in term2_ngrams:
-                term2_ngrams.pop(term2_ngrams.index(ngram))
-                overlap += 1
-        return overlap
+        # number of ngrams the terms have in common, counting repeated ngrams
+        term1_ngrams = get_ngram_counts(term1, ngram_size)
+        term2_ngrams = get_ngram_counts(term2, ngram_size)
+        return sum([min(count, term2_ngrams[ngram]) for ngram, count in term1_ngrams.items() if ngram in term2_ngrams])
 
     def score_char_overlap_ratio(self, term1, term2):
+        # cheap to compute, so only looked up, it's stored by the char match filter
+        scores = self.pair_scores.get((term1, term2))
+        if scores and "char" in scores:
+            return scores["char"]
         max_overlap = len(term1)
         overlap = self.score_char_overlap(term1, term2)
         return overlap / max_overlap
 
     def score_ngram_overlap_ratio(self, term1, term2, ngram_size):
-        max_overlap = len(self.make_ngrams(term1, ngram_size))
-        overlap = self.score_ngram_overlap(term1, term2, ngram_size)
-        return overlap / max_overlap
+        scores = self.get_pair_scores(term1, term2)
+        if ("ngram", ngram_size) not in scores:
+            max_overlap = max(len(term1) + 3 - ngram_size, 0)
+            overlap = self.score_ngram_overlap(term1, term2, ngram_size)
+            scores[("ngram", ngram_size)] = overlap / max_overlap
+        return scores[("ngram", ngram_size)]
 
     def score_levenshtein_distance_ratio(self, term1, term2):
-        max_distance = max(len(term1), len(term2))
-        distance = self.score_levenshtein_distance(term1, term2)
-        return 1 - distance / max_distance
+        scores = self.get_pair_scores(term1, term2)
+        if "levenshtein" not in scores:
+            max_distance = max(len(term1), len(term2))
+            distance = self.score_levenshtein_distance(term1, term2)
+            scores["levenshtein"] = 1 - distance / max_distance
+        return scores["levenshtein"]
+
+    def meets_levenshtein_threshold(self, term1, term2):
+        # Checks the levenshtein ratio against the threshold, without computing
+        # the full distance for pairs that are clearly too far apart.
+        scores = self.get_pair_scores(term1, term2)
+        if "levenshtein" in scores:
+            return scores["levenshtein"] >= self.levenshtein_threshold
+        max_length = max(len(term1), len(term2))
+        if max_length == 0:
+            return self.score_levenshtein_distance_ratio(term1, term2) >= self.levenshtein_threshold
+        max_distance = self.get_max_levenshtein_distance(max_length)
+        if max_distance < 0:
+            return False
+        distance = self.score_bounded_levenshtein_distance(term1, term2, max_distance)
+        if distance > max_distance:
+            return False
+        # within the bound, the distance is exact
+        scores["levenshtein"] = 1 - distance / max_length
+        return scores["levenshtein"] >= self.levenshtein_threshold
+
+    def get_max_levenshtein_distance(self, max_length):
+        # largest distance for which the levenshtein ratio still meets the threshold
+        max_distance = int((1 - self.levenshtein_threshold) * max_length)
+        while max_distance >= 0 and 1 - max_distance / max_length < self.levenshtein_threshold:
+            max_distance -= 1
+        while max_distance < max_length and 1 - (max_distance + 1) / max_length >= self.levenshtein_threshold:
+            max_distance += 1
+        return max_distance
+
+    ##########################
+    # Pair score memoisation #
+    ##########################
+
+    def get_pair_scores(self, match_string, keyword):
+        key = (match_string, keyword)
+        if key in self.pair_scores:
+            self.pair_scores.move_to_end(key)
+            self.pair_score_hits += 1
+            return self.pair_scores[key]
+        self.pair_score_misses += 1
+        scores = {}
+        self.pair_scores[key] = scores
+        if len(self.pair_scores) > self.max_cached_scores:
+            self.pair_scores.popitem(last=False)
+        return scores
+
+    def clear_score_cache(self):
+        self.pair_scores = OrderedDict()
+        self.pair_score_hits = 0
+        self.pair_score_misses = 0
+
+    def get_score_cache_stats(self):
+        return {
+            "size": len(self.pair_scores),
+            "hits": self.pair_score_hits,
+            "misses": self.pair_score_misses,
+        }
 
     #################################
     # Candidate filtering functions #
     #################################
 
     def filter_char_match_candidates(self, candidates, match_term):
-        if len(candidates) == 0:
-            return candidates
-        if isinstance(candidates[0], str):
-            return [candidate for candidate in candidates if self.score_char_overlap_ratio(candidate, match_term) >= self.char_match_threshold]
-        elif isinstance(candidates[0], object):
-            return [candidate for candidate in candidates if self.score_char_overlap_ratio(candidate["match_string"], match_term) >= self.char_match_threshold]
+        match_strings = [get_match_string(candidate) for candidate in candidates]
+        char_scores = [self.score_char_overlap(match_string, match_term) / len(match_string) for match_string in match_strings]
+        filtered_candidates = []
+        for candidate, match_string, char_score in zip(candidates, match_strings, char_scores):
+            if char_score >= self.char_match_threshold:
+                # keep the score for candidates that go on to the other filters and ranking
+                self.get_pair_scores(match_string, match_term)["char"] = char_score
+                filtered_candidates.append(candidate)
+        return filtered_candidates
 
     def filter_ngram_candidates(self, candidates, match_term, ngram_size):
-        if len(candidates) == 0:
-            return candidates
-        if isinstance(candidates[0], str):
-            return [candidate for candidate in candidates if self.score_ngram_overlap_ratio(candidate, match_term, ngram_size) >= self.ngram_threshold]
-        elif isinstance(candidates[0], object):
-            return [candidate for candidate in candidates if self.score_ngram_overlap_ratio(candidate["match_string"], match_term, ngram_size) >= self.ngram_threshold]
+        return [candidate for candidate in candidates
+                if self.score_ngram_overlap_ratio(get_match_string(candidate), match_term, ngram_size) >= self.ngram_threshold]
 
     def filter_levenshtein_candidates(self, candidates, match_term):
-        if len(candidates) == 0:
-            return candidates
-        if isinstance(candidates[0], str):
-            return [candidate for candidate in candidates if self.score_levenshtein_distance_ratio(candidate, match_term) >= self.levenshtein_threshold]
-        elif isinstance(candidates[0], object):
-            return [candidate for candidate in candidates if self.score_levenshtein_distance_ratio(candidate["match_string"], match_term) >= self.levenshtein_threshold]
+        return [candidate for candidate in candidates
+                if self.meets_levenshtein_threshold(get_match_string(candidate), match_term)]
 
     def filter_candidates(self, candidates, keyword, ngram_size=2):
         if len(candidates) == 0:
             return candidates
         char_match_candidates = self.filter_char_match_candidates(candidates, keyword)
         ngram_candidates = self.filter_ngram_candidates(char_match_candidates, keyword, ngram_size)
-        return self.filter_levenshtein_candidates(ngram_candidates, keyword)
+        filtered_candidates = self.filter_levenshtein_candidates(ngram_candidates, keyword)
+        pipeline_stats.count("filter_candidates_checked", len(candidates))
+        pipeline_stats.count("filter_candidates_verified", len(filtered_candidates))
+        return filtered_candidates
 
-    def rank_candidates(self, candidates, keyword, ngram_size=2):
+    def score_candidates(self, candidates, keyword, ngram_size=2):
+        # Batch mode: score one keyword against many candidates, reusing
+        # any scores that were computed before, e.g. while filtering.
         total_scores = []
         for candidate in candidates:
-            if isinstance(candidate, str):
-                match_string = candidate
-            elif isinstance(candidate, object):
-                match_string = candidate["match_string"]
+            match_string = get_match_string(candidate)
             score = {
                 "candidate": candidate,
                 "char": self.score_char_overlap_ratio(match_string, keyword),
@@ -134,6 +228,10 @@ class FuzzyMatcher(object):
             }
             score["total"] = score["char"] + score["ngram"] + score["levenshtein"]
             total_scores += [score]
+        return total_scores
+
+    def rank_candidates(self, candidates, keyword, ngram_size=2):
+        total_scores = self.score_candidates(candidates, keyword, ngram_size)
         return sorted(total_scores, key=lambda x: x["total"], reverse=True)
 
     ##########################################
@@ -167,10 +265,61 @@ class FuzzyMatcher(object):
 
     def find_candidates(self, text, keyword, ngram_size=2):
         candidates = self.find_start_candidates(text, keyword)
+        pipeline_stats.count("find_candidates_generated", len(candidates))
         candidates = self.filter_char_match_candidates(candidates, keyword)
         candidates = self.filter_ngram_candidates(candidates, keyword, ngram_size)
         candidates = self.filter_levenshtein_candidates(candidates, keyword)
+        pipeline_stats.count("find_candidates_verified", len(candidates))
         return candidates
+
+    def find_candidates_for_keywords(self, text, keywords, ngram_size=2):
+        """
+        Batch version of find_candidates: returns a dict with the candidates in the text for each of
+        the keywords, the same as find_candidates(text, keyword) for each keyword separately.
+        The text is scanned once for the positions of the keyword initials. Keywords with the same
+        initial and length window share the same candidate spans, and each distinct span string
+        is passed through the char, ngram and levenshtein filters once per keyword.
+        """
+        keyword_groups = {}
+        keyword_candidates = {}
+        for keyword in keywords:
+            span_window = self.get_span_window(keyword)
+            if span_window:
+                keyword_groups.setdefault(span_window, []).append(keyword)
+            else:
+                # initials that are regex special characters are left to the regex scan
+                keyword_candidates[keyword] = self.find_candidates(text, keyword, ngram_size)
+        initial_offsets = get_char_offsets(text, set([initial for initial, min_length, max_length in keyword_groups]))
+        for (initial, min_length, max_length), group_keywords in keyword_groups.items():
+            spans = get_term_spans(text, initial_offsets[initial], min_length, max_length)
+            if self.perform_strip_suffix:
+                spans = [(offset, self.strip_suffix(span)) for offset, span in spans]
+            # the filters only depend on the span string, so each distinct span is checked once per keyword
+            distinct_spans = list(OrderedDict.fromkeys([span for offset, span in spans]))
+            for keyword in group_keywords:
+                matching_spans = self.filter_char_match_candidates(distinct_spans, keyword)
+                matching_spans = self.filter_ngram_candidates(matching_spans, keyword, ngram_size)
+                matching_spans = set(self.filter_levenshtein_candidates(matching_spans, keyword))
+                keyword_candidates[keyword] = [{"match_term": keyword, "match_string": span, "match_offset": offset}
+                                               for offset, span in spans if span in matching_spans]
+                pipeline_stats.count("find_candidates_generated", len(spans))
+                pipeline_stats.count("find_candidates_verified", len(keyword_candidates[keyword]))
+        return keyword_candidates
+
+    def get_span_window(self, keyword, max_length_variance=None):
+        # The initial and the minimum and maximum number of characters following it, as in the pattern
+        # of find_term_matches, or None if the pattern can't be scanned as a literal initial.
+        if not max_length_variance:
+            max_length_variance = self.max_length_variance
+        if len(keyword) == 0:
+            return None
+        initial = keyword[0]
+        if re.escape(initial) != initial and initial not in ["[","]", "*", "(",")", "."]:
+            return None
+        min_length = len(keyword) - 1 - max_length_variance
+        if min_length < 0:
+            return None
+        return initial, min_length, len(keyword) - 1 + max_length_variance
         
 
 def create_term_match(re_match, term):
@@ -180,6 +329,64 @@ def create_term_match(re_match, term):
         "match_offset": re_match.start()
     }
 
+def get_match_string(candidate):
+    # candidates are either strings or term matches (see create_term_match)
+    if isinstance(candidate, str):
+        return candidate
+    return candidate["match_string"]
+
+def benchmark_keyword_scanning(text, keywords, keyword_counts=(1, 10, 100, 1000), **matcher_kwargs):
+    """
+    benchmark_keyword_scanning times finding the candidates for the first N keywords in the text,
+    for each N in keyword_counts, with find_candidates per keyword and with find_candidates_for_keywords.
+    Each measurement uses a new FuzzyMatcher (with matcher_kwargs), so no scores are memoised beforehand.
+    Reports the seconds for both approaches per N, and whether they found the same candidates.
+    """
+    report = []
+    for keyword_count in keyword_counts:
+        selected_keywords = list(OrderedDict.fromkeys(keywords))[:keyword_count]
+        fuzzy_matcher = FuzzyMatcher(**matcher_kwargs)
+        start = time.time()
+        keyword_candidates = {keyword: fuzzy_matcher.find_candidates(text, keyword) for keyword in selected_keywords}
+        per_keyword_seconds = time.time() - start
+        fuzzy_matcher = FuzzyMatcher(**matcher_kwargs)
+        start = time.time()
+        batch_candidates = fuzzy_matcher.find_candidates_for_keywords(text, selected_keywords)
+        batch_seconds = time.time() - start
+        report += [{
+            "keywords": len(selected_keywords),
+            "per_keyword_seconds": per_keyword_seconds,
+            "batch_seconds": batch_seconds,
+            "same_candidates": keyword_candidates == batch_candidates,
+        }]
+    return report
 
+def get_char_offsets(text, chars):
+    # the offsets of each of the given characters in the text, in a single pass
+    char_offsets = {char: [] for char in chars}
+    for offset, char in enumerate(text):
+        if char in char_offsets:
+            char_offsets[char].append(offset)
+    return char_offsets
 
+def get_term_spans(text, initial_offsets, min_length, max_length):
+    # Same spans as re.finditer(initial + ".{min,max}", text): greedy and non-overlapping,
+    # so initials within a previous span are skipped. A span doesn't cross a newline.
+    spans = []
+    scan_offset = 0
+    for offset in initial_offsets:
+        if offset < scan_offset:
+            continue
+        line_end = text.find("\n", offset + 1, offset + 1 + max_length)
+        span_end = offset + 1 + max_length if line_end == -1 else line_end
+        span_end = min(span_end, len(text))
+        if span_end - offset - 1 < min_length:
+            continue
+        spans.append((offset, text[offset:span_end]))
+        scan_offset = span_end
+    return spans
 
+@lru_cache(maxsize=100000)
+def get_ngram_counts(term, ngram_size):
+    term = "#{t}#".format(t=term)
+    return Counter([term[start:start+ngram_size] for start in range(0, len(term) - ngram_size + 1)])
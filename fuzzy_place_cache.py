@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+
+# Increase when the way candidate places are selected changes, to invalidate persisted caches.
+CACHE_VERSION = 2
+
+
+def make_fingerprint(is_variant_of, fuzzy_matcher):
+    """
+    Returns a hash of everything that determines the candidate places of a token:
+    the placename variants with their preferred placenames, and the fuzzy matcher thresholds.
+    """
+    fingerprint_data = {
+        "version": CACHE_VERSION,
+        "variants": sorted([[variant, sorted(preferred_placenames.keys())]
+                            for variant, preferred_placenames in is_variant_of.items()]),
+        "char_match_threshold": fuzzy_matcher.char_match_threshold,
+        "ngram_threshold": fuzzy_matcher.ngram_threshold,
+        "levenshtein_threshold": fuzzy_matcher.levenshtein_threshold,
+        "max_length_variance": fuzzy_matcher.max_length_variance,
+        "perform_strip_suffix": fuzzy_matcher.perform_strip_suffix,
+    }
+    return hashlib.sha1(json.dumps(fingerprint_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class FuzzyPlaceCache(object):
+
+    def __init__(self, fingerprint, max_size=100000):
+        """
+        Action: corpus-wide cache of the candidate places of fuzzy placename tokens
+        Input: the fingerprint of the gazetteer and fuzzy matcher (see make_fingerprint),
+        and the maximum number of cached tokens
+        Output: a FuzzyPlaceCache object
+
+        Both positive (a list of candidate placenames) and negative (an empty list) results
+        are cached. When the cache is full, the least recently used token is evicted.
+        A persisted cache is only loaded if it was made with the same fingerprint,
+        so a changed gazetteer or changed thresholds never give stale candidates.
+        """
+        self.fingerprint = fingerprint
+        self.max_size = max_size
+        self.token_places = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, token):
+        # returns None if the token is not in the cache
+        if token not in self.token_places:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.token_places.move_to_end(token)
+        return self.token_places[token]
+
+    def put(self, token, candidate_places):
+        self.token_places[token] = list(candidate_places)
+        self.token_places.move_to_end(token)
+        while len(self.token_places) > self.max_size:
+            self.token_places.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.token_places = OrderedDict()
+
+    def save(self, cache_file):
+        cache_data = {
+            "fingerprint": self.fingerprint,
+            "token_places": list(self.token_places.items()),
+        }
+        # write to a temporary file first, so an interrupted save never leaves a partial cache
+        tmp_file = "{f}.{p}.tmp".format(f=cache_file, p=os.getpid())
+        with open(tmp_file, 'wt') as fh:
+            json.dump(cache_data, fh)
+        os.replace(tmp_file, cache_file)
+
+    def load(self, cache_file):
+        """
+        Loads the tokens of a persisted cache, if it exists and has the same fingerprint.
+        Returns True if the cache was loaded.
+        """
+        if not os.path.exists(cache_file):
+            return False
+        with open(cache_file, 'rt') as fh:
+            cache_data = json.load(fh)
+        if cache_data["fingerprint"] != self.fingerprint:
+            return False
+        for token, candidate_places in cache_data["token_places"]:
+            self.put(token, candidate_places)
+        return True
+
+    def get_stats(self):
+        return {
+            "size": len(self.token_places),
+            "positive": len([token for token in self.token_places if len(self.token_places[token]) > 0]),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,535 @@
+import bisect
+import datetime
+import hashlib
+import json
+import mmap
+import os
+import struct
+from array import array
+from collections.abc import Mapping, Sequence
+
+import ngram_index
+
+
+# file format identifier, followed by the length of the JSON header
+MAGIC = b"OHZGS001"
+HEADER_STRUCT = struct.Struct("<8sI")
+# columns are aligned to this number of bytes
+ALIGNMENT = 8
+# Increase when the way the gazetteer is indexed changes, to rebuild existing snapshots.
+SNAPSHOT_VERSION = 2
+# as in the notebook's index_row, shorter placenames are not indexed for fuzzy lookup
+MIN_NGRAM_PLACENAME_LENGTH = 4
+
+# name -> typecode of the columns. As in the corpus store, columns ending in _end hold the
+# cumulative end offsets of variable length rows in another column or text buffer.
+# Strings (placenames) are interned: each unique string is stored once, sorted by their UTF-8
+# bytes, and referred to by its row in the string table. Cell values (IDs, countries and notes)
+# are interned separately as JSON, as they aren't necessarily strings. Date and time cells are
+# stored as a tagged ISO string, e.g. {"datetime.date": "2020-01-02"}, and restored on load.
+COLUMNS = [
+    ("string_end", "q"), ("string_place", "i"), ("string_variant", "i"),
+    ("value_end", "q"),
+    ("place_string", "i"), ("place_id", "i"), ("place_country", "i"), ("place_note", "i"),
+    ("place_variant_end", "q"), ("place_variants", "i"), ("place_variant_ids", "i"),
+    ("variant_string", "i"), ("variant_preferred_end", "q"), ("variant_preferred", "i"), ("variant_preferred_ids", "i"),
+    ("trigram_end", "q"), ("trigram_placename_end", "q"), ("trigram_placenames", "i"),
+    ("term_string", "i"),
+    ("posting_key_end", "q"), ("posting_term_end", "q"), ("posting_terms", "i"),
+]
+TEXT_BUFFERS = ["string_text", "value_text", "trigram_text", "posting_key_text"]
+
+
+def get_row_range(end_column, row):
+    return (end_column[row-1] if row > 0 else 0), end_column[row]
+
+def get_ngrams(term, ngram_size=3):
+    # same as get_ngrams in the notebook
+    for start_index in range(0, len(term) - (ngram_size-1)):
+        yield term.lower()[start_index:start_index+ngram_size]
+
+def make_posting_key(ngram, occurrence, length, initial):
+    # NgramIndex posting keys as strings, so they can be sorted and bisected like the other strings
+    return "{n}\0{o}\0{l}\0{i}".format(n=ngram, o=occurrence, l=length, i=initial)
+
+# tag -> type of the date and time cell values, datetime before date as it is a subclass of date
+TEMPORAL_TYPES = [("datetime.datetime", datetime.datetime), ("datetime.date", datetime.date),
+                  ("datetime.time", datetime.time)]
+
+def tag_temporal_value(value):
+    for tag, temporal_type in TEMPORAL_TYPES:
+        if isinstance(value, temporal_type):
+            return {tag: value.isoformat()}
+    # other cell values that JSON can't represent are stored as strings
+    return str(value)
+
+def restore_temporal_value(tagged_value):
+    if len(tagged_value) == 1:
+        for tag, temporal_type in TEMPORAL_TYPES:
+            if tag in tagged_value:
+                return temporal_type.fromisoformat(tagged_value[tag])
+    return tagged_value
+
+def encode_value(value):
+    return json.dumps(value, default=tag_temporal_value)
+
+def decode_value(encoded_value):
+    return json.loads(encoded_value, object_hook=restore_temporal_value)
+
+def get_source_key(placename_excel_file):
+    with open(placename_excel_file, 'rb') as fh:
+        content_hash = hashlib.sha1(fh.read()).hexdigest()
+    return "{h}-v{v}".format(h=content_hash, v=SNAPSHOT_VERSION)
+
+
+###############################
+# Compiling the gazetteer     #
+###############################
+
+def read_gazetteer_rows(placename_excel_file):
+    # openpyxl is only needed to compile a snapshot, so it is not imported when loading one
+    from openpyxl import load_workbook
+    workbook = load_workbook(placename_excel_file, read_only=True)
+    rows = [tuple(row[:4]) for row in workbook.active.iter_rows(values_only=True)]
+    workbook.close()
+    return rows
+
+def index_gazetteer_rows(gazetteer_rows):
+    """
+    Indexes (ID, placename, country, note) rows in the same way as index_row in the notebook,
+    and returns the placename_info, has_variants, is_variant_of, placename_ngram_index and
+    placename_fuzzy_index that PlaceIndex would have.
+    """
+    indexes = {
+        "placename_info": {},
+        "has_variants": {},
+        "is_variant_of": {},
+        "placename_ngram_index": {},
+        "placename_fuzzy_index": ngram_index.NgramIndex(ngram_size=2),
+    }
+    preferred_placename = None
+    for row in gazetteer_rows:
+        placename_id, placename, country, note = (tuple(row) + (None,) * 4)[:4]
+        if placename == "Plaatsnaam" or not placename:
+            preferred_placename = None
+            continue
+        placename_string = str(placename).strip()
+        if not preferred_placename:
+            preferred_placename = placename_string
+            indexes["placename_info"][preferred_placename] = {
+                "placename": preferred_placename,
+                "placename_id": placename_id,
+                "country": country,
+                "note": note
+            }
+        indexes["has_variants"].setdefault(preferred_placename, {})[placename_string] = placename_id
+        indexes["is_variant_of"].setdefault(placename_string, {})[preferred_placename] = placename_id
+        if len(placename_string) >= MIN_NGRAM_PLACENAME_LENGTH:
+            for ngram in get_ngrams(placename_string):
+                indexes["placename_ngram_index"].setdefault(ngram, {})[placename_string] = True
+            indexes["placename_fuzzy_index"].add_term(placename_string)
+    return indexes
+
+def make_string_table(strings, texts, text_buffer, end_column):
+    # sorts the strings on their UTF-8 bytes and returns the row of each string
+    encoded_strings = sorted(set([string.encode("utf-8") for string in strings]))
+    text = bytearray()
+    for encoded_string in encoded_strings:
+        text += encoded_string
+        end_column.append(len(text))
+    texts[text_buffer] = text
+    return {str(encoded_string, "utf-8"): row for row, encoded_string in enumerate(encoded_strings)}
+
+def make_snapshot_columns(indexes):
+    columns = {column: array(typecode) for column, typecode in COLUMNS}
+    texts = {}
+    string_rows = make_string_table(list(indexes["is_variant_of"].keys()) + list(indexes["placename_info"].keys()),
+                                    texts, "string_text", columns["string_end"])
+    value_rows = {}
+    value_text = bytearray()
+
+    def add_value(value):
+        encoded_value = encode_value(value)
+        if encoded_value not in value_rows:
+            value_rows[encoded_value] = len(value_rows)
+            value_text.extend(encoded_value.encode("utf-8"))
+            columns["value_end"].append(len(value_text))
+        return value_rows[encoded_value]
+
+    # -1 for strings that aren't a preferred placename or a variant
+    columns["string_place"].extend([-1] * len(string_rows))
+    columns["string_variant"].extend([-1] * len(string_rows))
+    for place_row, (placename, info) in enumerate(indexes["placename_info"].items()):
+        columns["string_place"][string_rows[placename]] = place_row
+        columns["place_string"].append(string_rows[placename])
+        columns["place_id"].append(add_value(info["placename_id"]))
+        columns["place_country"].append(add_value(info["country"]))
+        columns["place_note"].append(add_value(info["note"]))
+        for variant, variant_id in indexes["has_variants"][placename].items():
+            columns["place_variants"].append(string_rows[variant])
+            columns["place_variant_ids"].append(add_value(variant_id))
+        columns["place_variant_end"].append(len(columns["place_variants"]))
+    for variant_row, (variant, preferred_placenames) in enumerate(indexes["is_variant_of"].items()):
+        columns["string_variant"][string_rows[variant]] = variant_row
+        columns["variant_string"].append(string_rows[variant])
+        for preferred_placename, variant_id in preferred_placenames.items():
+            columns["variant_preferred"].append(string_rows[preferred_placename])
+            columns["variant_preferred_ids"].append(add_value(variant_id))
+        columns["variant_preferred_end"].append(len(columns["variant_preferred"]))
+    texts["value_text"] = value_text
+    trigram_rows = make_string_table(indexes["placename_ngram_index"].keys(), texts, "trigram_text", columns["trigram_end"])
+    for trigram, trigram_row in sorted(trigram_rows.items(), key=lambda item: item[1]):
+        columns["trigram_placenames"].extend([string_rows[placename] for placename in indexes["placename_ngram_index"][trigram]])
+        columns["trigram_placename_end"].append(len(columns["trigram_placenames"]))
+    fuzzy_index = indexes["placename_fuzzy_index"]
+    columns["term_string"].extend([string_rows[term] for term in fuzzy_index.terms])
+    posting_keys = {make_posting_key(*posting_key): posting for posting_key, posting in fuzzy_index.postings.items()}
+    posting_rows = make_string_table(posting_keys.keys(), texts, "posting_key_text", columns["posting_key_end"])
+    for posting_key, posting_row in sorted(posting_rows.items(), key=lambda item: item[1]):
+        columns["posting_terms"].extend(posting_keys[posting_key])
+        columns["posting_term_end"].append(len(columns["posting_terms"]))
+    fuzzy_info = {
+        "ngram_size": fuzzy_index.ngram_size,
+        "initials": sorted(fuzzy_index.initials),
+        "max_term_length": fuzzy_index.max_term_length,
+    }
+    return columns, texts, fuzzy_info
+
+def write_snapshot(snapshot_file, columns, texts, fuzzy_info, source_key):
+    header = {"source_key": source_key, "fuzzy_index": fuzzy_info, "columns": {}, "texts": {}}
+    offset = 0
+    for column, typecode in COLUMNS:
+        header["columns"][column] = [offset, len(columns[column]), typecode]
+        offset += len(columns[column]) * columns[column].itemsize
+        offset += -offset % ALIGNMENT
+    for text_buffer in TEXT_BUFFERS:
+        header["texts"][text_buffer] = [offset, len(texts[text_buffer])]
+        offset += len(texts[text_buffer])
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = HEADER_STRUCT.size + len(header_bytes)
+    data_start += -data_start % ALIGNMENT
+    # write to a temporary file first, so a loading process never sees a partial snapshot
+    tmp_file = "{f}.{p}.tmp".format(f=snapshot_file, p=os.getpid())
+    with open(tmp_file, 'wb') as fh:
+        fh.write(HEADER_STRUCT.pack(MAGIC, len(header_bytes)))
+        fh.write(header_bytes)
+        fh.write(b"\0" * (data_start - fh.tell()))
+        for column, typecode in COLUMNS:
+            fh.write(columns[column].tobytes())
+            fh.write(b"\0" * (-fh.tell() % ALIGNMENT))
+        for text_buffer in TEXT_BUFFERS:
+            fh.write(texts[text_buffer])
+    os.replace(tmp_file, snapshot_file)
+
+def compile_gazetteer(gazetteer_rows, snapshot_file, source_key=None):
+    """
+    Action: compiles the rows of the placename gazetteer into a snapshot file
+    Input: the (ID, placename, country, note) rows, e.g. from read_gazetteer_rows,
+    the file to write the snapshot to and the key of the source the rows were read from
+    Output: the snapshot file, which GazetteerSnapshot can open
+    """
+    columns, texts, fuzzy_info = make_snapshot_columns(index_gazetteer_rows(gazetteer_rows))
+    write_snapshot(snapshot_file, columns, texts, fuzzy_info, source_key)
+
+def read_header(data):
+    magic, header_length = HEADER_STRUCT.unpack_from(data, 0)
+    if magic != MAGIC:
+        return None, None
+    header = json.loads(bytes(data[HEADER_STRUCT.size:HEADER_STRUCT.size + header_length]).decode("utf-8"))
+    data_start = HEADER_STRUCT.size + header_length
+    return header, data_start + -data_start % ALIGNMENT
+
+def get_snapshot_source_key(snapshot_file):
+    # returns None if there is no (valid) snapshot
+    if not os.path.exists(snapshot_file):
+        return None
+    with open(snapshot_file, 'rb') as fh:
+        data = fh.read(HEADER_STRUCT.size)
+        if len(data) < HEADER_STRUCT.size:
+            return None
+        magic, header_length = HEADER_STRUCT.unpack(data)
+        if magic != MAGIC:
+            return None
+        header, data_start = read_header(data + fh.read(header_length))
+    return header["source_key"]
+
+def load_placename_index(placename_excel_file, snapshot_file=None):
+    """
+    Action: opens the compiled snapshot of the placename Excel file, which replaces create_placename_index
+    Input: the placename Excel file, and the snapshot file (by default next to the Excel file)
+    Output: a GazetteerSnapshot
+
+    The snapshot is compiled again if the content of the Excel file has changed since it
+    was compiled, which needs openpyxl. If the Excel file is not there, an existing snapshot
+    is used as it is, so a snapshot can be used without the Excel file and without openpyxl.
+    Cell values are the same as in create_placename_index, including date and time cells.
+    Other values that JSON can't represent come back as strings.
+    """
+    if snapshot_file is None:
+        snapshot_file = placename_excel_file + ".snapshot"
+    if os.path.exists(placename_excel_file):
+        source_key = get_source_key(placename_excel_file)
+        if get_snapshot_source_key(snapshot_file) != source_key:
+            compile_gazetteer(read_gazetteer_rows(placename_excel_file), snapshot_file, source_key)
+    return GazetteerSnapshot(snapshot_file)
+
+
+###############################
+# Loading the snapshot        #
+###############################
+
+class StringColumn(Sequence):
+
+    def __init__(self, text, end_column):
+        # the UTF-8 encoded strings of a text buffer, as bytes, e.g. to bisect
+        self.text = text
+        self.end_column = end_column
+
+    def __len__(self):
+        return len(self.end_column)
+
+    def __getitem__(self, row):
+        start, end = get_row_range(self.end_column, row)
+        return self.text[start:end].tobytes()
+
+    def find_row(self, string):
+        # returns None if the string is not in the column
+        encoded_string = string.encode("utf-8")
+        row = bisect.bisect_left(self, encoded_string)
+        if row < len(self) and self[row] == encoded_string:
+            return row
+        return None
+
+    def get_string(self, row):
+        start, end = get_row_range(self.end_column, row)
+        return str(self.text[start:end], "utf-8")
+
+
+class RowMapping(Mapping):
+
+    def __init__(self, num_rows, find_row, get_key, get_value, missing_value=None):
+        """
+        Read-only dict view on the rows of a snapshot table, in row order. As the defaultdicts
+        of PlaceIndex, a missing key gives missing_value (if it is not None) instead of a KeyError,
+        but the key is not added.
+        """
+        self.num_rows = num_rows
+        self.find_row = find_row
+        self.get_key = get_key
+        self.get_value = get_value
+        self.missing_value = missing_value
+
+    def __len__(self):
+        return self.num_rows
+
+    def __iter__(self):
+        for row in range(self.num_rows):
+            yield self.get_key(row)
+
+    def __contains__(self, key):
+        return isinstance(key, str) and self.find_row(key) is not None
+
+    def __getitem__(self, key):
+        row = self.find_row(key) if isinstance(key, str) else None
+        if row is None:
+            if self.missing_value is None:
+                raise KeyError(key)
+            return self.missing_value()
+        return self.get_value(row)
+
+    def get(self, key, default=None):
+        row = self.find_row(key) if isinstance(key, str) else None
+        return default if row is None else self.get_value(row)
+
+
+class PostingMapping(object):
+
+    def __init__(self, posting_keys, posting_term_end, posting_terms):
+        # the posting lists of the fuzzy index in the snapshot
+        self.posting_keys = posting_keys
+        self.posting_term_end = posting_term_end
+        self.posting_terms = posting_terms
+        # A lookup tries many posting keys that aren't in the index, so the posting lists (or None)
+        # of the keys that were looked up are kept, which is at most one entry per indexed key
+        # and lookup bucket.
+        self.looked_up = {}
+
+    def get(self, posting_key, default=None):
+        if posting_key not in self.looked_up:
+            row = self.posting_keys.find_row(make_posting_key(*posting_key))
+            if row is None:
+                self.looked_up[posting_key] = None
+            else:
+                # copied, so the snapshot can be closed while the posting lists are kept
+                start, end = get_row_range(self.posting_term_end, row)
+                self.looked_up[posting_key] = array("i", self.posting_terms[start:end].tobytes())
+        posting = self.looked_up[posting_key]
+        return default if posting is None else posting
+
+
+class TermSequence(Sequence):
+
+    def __init__(self, strings, term_string):
+        self.strings = strings
+        self.term_string = term_string
+        # lookups get the terms of all candidates with some ngram overlap, so decoded terms are kept
+        self.decoded_terms = [None] * len(term_string)
+
+    def __len__(self):
+        return len(self.term_string)
+
+    def __getitem__(self, term_id):
+        if self.decoded_terms[term_id] is None:
+            self.decoded_terms[term_id] = self.strings.get_string(self.term_string[term_id])
+        return self.decoded_terms[term_id]
+
+
+class SnapshotNgramIndex(ngram_index.NgramIndex):
+
+    def __init__(self, terms, postings, ngram_size, initials, max_term_length):
+        """
+        The fuzzy placename index of a snapshot. Lookups work as those of NgramIndex,
+        on the posting lists in the snapshot, but no terms can be added.
+        """
+        self.ngram_size = ngram_size
+        self.terms = terms
+        self.initials = set(initials)
+        self.max_term_length = max_term_length
+        self.postings = postings
+
+    def add_term(self, term):
+        raise TypeError("Terms can't be added to the index of a gazetteer snapshot")
+
+
+class GazetteerSnapshot(object):
+
+    def __init__(self, snapshot_file):
+        """
+        Action: memory-mapped reader of a gazetteer snapshot written by compile_gazetteer
+        Input: the snapshot file
+        Output: a GazetteerSnapshot object with the same attributes and lookups as the
+        PlaceIndex made by create_placename_index
+
+        has_variants, is_variant_of, placename_info and placename_ngram_index are read-only
+        dict views, and placename_fuzzy_index is an NgramIndex on the snapshot's posting
+        lists, so opening a snapshot reads nothing but the header. Strings are only decoded
+        when they are accessed. The non-placenames that are found during matching are kept
+        in memory, as with PlaceIndex. Close the snapshot (or use it as a context manager)
+        to release the file.
+        """
+        self.snapshot_file = snapshot_file
+        self.fh = open(snapshot_file, 'rb')
+        self.mmap = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = memoryview(self.mmap)
+        header, data_start = read_header(self.data)
+        if header is None:
+            raise ValueError("Invalid gazetteer snapshot file: {f}".format(f=snapshot_file))
+        self.source_key = header["source_key"]
+        self.columns = {}
+        for column, (offset, length, typecode) in header["columns"].items():
+            start = data_start + offset
+            self.columns[column] = self.data[start:start + length * struct.calcsize(typecode)].cast(typecode)
+        self.texts = {}
+        for text_buffer, (offset, length) in header["texts"].items():
+            self.texts[text_buffer] = self.data[data_start + offset:data_start + offset + length]
+        self.strings = StringColumn(self.texts["string_text"], self.columns["string_end"])
+        self.values = StringColumn(self.texts["value_text"], self.columns["value_end"])
+        self.trigrams = StringColumn(self.texts["trigram_text"], self.columns["trigram_end"])
+        self.placename_info = RowMapping(len(self.columns["place_string"]), self.find_place_row,
+                                         self.get_place_name, self.get_place_info)
+        self.has_variants = RowMapping(len(self.columns["place_string"]), self.find_place_row,
+                                       self.get_place_name, self.get_place_variants, missing_value=dict)
+        self.is_variant_of = RowMapping(len(self.columns["variant_string"]), self.find_variant_row,
+                                        self.get_variant_name, self.get_variant_preferred, missing_value=dict)
+        self.placename_ngram_index = RowMapping(len(self.trigrams), self.trigrams.find_row,
+                                                self.trigrams.get_string, self.get_trigram_placenames, missing_value=dict)
+        fuzzy_info = header["fuzzy_index"]
+        postings = PostingMapping(StringColumn(self.texts["posting_key_text"], self.columns["posting_key_end"]),
+                                  self.columns["posting_term_end"], self.columns["posting_terms"])
+        self.placename_fuzzy_index = SnapshotNgramIndex(TermSequence(self.strings, self.columns["term_string"]), postings,
+                                                        fuzzy_info["ngram_size"], fuzzy_info["initials"],
+                                                        fuzzy_info["max_term_length"])
+        self.non_placename = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        # all views on the memory map have to be released before it can be closed
+        for view in list(self.columns.values()) + list(self.texts.values()):
+            view.release()
+        self.columns, self.texts = {}, {}
+        self.data.release()
+        self.mmap.close()
+        self.fh.close()
+
+    def get_value(self, value_row):
+        return decode_value(self.values.get_string(value_row))
+
+    def find_place_row(self, placename):
+        string_row = self.strings.find_row(placename)
+        if string_row is None or self.columns["string_place"][string_row] < 0:
+            return None
+        return self.columns["string_place"][string_row]
+
+    def find_variant_row(self, placename):
+        string_row = self.strings.find_row(placename)
+        if string_row is None or self.columns["string_variant"][string_row] < 0:
+            return None
+        return self.columns["string_variant"][string_row]
+
+    def get_place_name(self, place_row):
+        return self.strings.get_string(self.columns["place_string"][place_row])
+
+    def get_place_info(self, place_row):
+        return {
+            "placename": self.get_place_name(place_row),
+            "placename_id": self.get_value(self.columns["place_id"][place_row]),
+            "country": self.get_value(self.columns["place_country"][place_row]),
+            "note": self.get_value(self.columns["place_note"][place_row])
+        }
+
+    def get_place_variants(self, place_row):
+        start, end = get_row_range(self.columns["place_variant_end"], place_row)
+        return {self.strings.get_string(self.columns["place_variants"][row]): self.get_value(self.columns["place_variant_ids"][row])
+                for row in range(start, end)}
+
+    def get_variant_name(self, variant_row):
+        return self.strings.get_string(self.columns["variant_string"][variant_row])
+
+    def get_variant_preferred(self, variant_row):
+        start, end = get_row_range(self.columns["variant_preferred_end"], variant_row)
+        return {self.strings.get_string(self.columns["variant_preferred"][row]): self.get_value(self.columns["variant_preferred_ids"][row])
+                for row in range(start, end)}
+
+    def get_trigram_placenames(self, trigram_row):
+        start, end = get_row_range(self.columns["trigram_placename_end"], trigram_row)
+        return {self.strings.get_string(string_row): True for string_row in self.columns["trigram_placenames"][start:end]}
+
+    ####################
+    # PlaceIndex       #
+    ####################
+
+    def get_preferred_placename(self, variant_placename):
+        if variant_placename not in self.is_variant_of:
+            return None
+        preferred_placenames = list(self.is_variant_of[variant_placename].keys())
+        if len(preferred_placenames) == 1:
+            return preferred_placenames[0]
+        else:
+            return preferred_placenames
+
+    def add_non_placename(self, non_placename):
+        self.non_placename[non_placename] = 1
+
+    def remove_non_placename(self, non_placename):
+        del self.non_placename[non_placename]
+
+    def is_non_placename(self, non_placename):
+        return non_placename in self.non_placename
+
+    def is_placename(self, non_placename):
+        return non_placename in self.is_variant_of
@@ -0,0 +1,322 @@
+import time
+import tracemalloc
+
+import parse_hocr_files
+import hocr_layout_index
+import hocr_page_cache
+import pipeline_stats
+
+
+class PageGeometry(object):
+
+    def __init__(self, columns, text):
+        """
+        Action: compact store of the line and word geometry of a page
+        Input: the int32 columns and text buffer of a page, as made by hocr_page_cache.make_page_columns
+               or read from a HOCRPageCache
+        Output: a PageGeometry object
+
+        Coordinates are kept in flat arrays with four values (left, top, right, bottom) per
+        line or word. All line and word texts are kept in one string, in page order (each
+        line text followed by the texts of its words), with end offsets per line and word.
+        """
+        self.line_bbox = columns["line_bbox"]
+        self.line_word_end = columns["line_word_end"]
+        self.line_text_end = columns["line_text_end"]
+        self.word_bbox = columns["word_bbox"]
+        self.word_conf = columns["word_conf"]
+        self.word_text_end = columns["word_text_end"]
+        self.text = text
+        self.num_lines = len(self.line_word_end)
+        self.num_words = len(self.word_conf)
+        # derived text representations, set per line by the layout steps
+        self.spaced_line_text = [None] * self.num_lines
+        self.clean_line_text = [None] * self.num_lines
+
+    def get_line_word_start(self, line_index):
+        return self.line_word_end[line_index-1] if line_index > 0 else 0
+
+    def get_line_text(self, line_index):
+        text_end = self.line_text_end[line_index]
+        if line_index == 0:
+            return self.text[:text_end]
+        if self.line_word_end[line_index-1] > 0:
+            return self.text[self.word_text_end[self.line_word_end[line_index-1]-1]:text_end]
+        return self.text[self.line_text_end[line_index-1]:text_end]
+
+    def get_word_text(self, line_index, word_index):
+        if word_index == self.get_line_word_start(line_index):
+            return self.text[self.line_text_end[line_index]:self.word_text_end[word_index]]
+        return self.text[self.word_text_end[word_index-1]:self.word_text_end[word_index]]
+
+    def get_word_texts(self):
+        # the texts of all words on the page, in a single pass over the text buffer
+        word_texts = []
+        for line_index in range(self.num_lines):
+            text_start = self.line_text_end[line_index]
+            for word_index in range(self.get_line_word_start(line_index), self.line_word_end[line_index]):
+                word_texts.append(self.text[text_start:self.word_text_end[word_index]])
+                text_start = self.word_text_end[word_index]
+        return word_texts
+
+
+class WordView(object):
+
+    __slots__ = ["geometry", "line_index", "index"]
+
+    keys_ = ["bbox", "width", "height", "left", "right", "top", "bottom", "word_text", "word_conf"]
+
+    def __init__(self, geometry, line_index, index):
+        # dict-like, read-only view of a word in a PageGeometry
+        self.geometry = geometry
+        self.line_index = line_index
+        self.index = index
+
+    def __getitem__(self, key):
+        bbox = self.geometry.word_bbox
+        offset = self.index * 4
+        if key == "left":
+            return bbox[offset]
+        elif key == "top":
+            return bbox[offset+1]
+        elif key == "right":
+            return bbox[offset+2]
+        elif key == "bottom":
+            return bbox[offset+3]
+        elif key == "bbox":
+            return list(bbox[offset:offset+4])
+        elif key == "width":
+            return bbox[offset+2] - bbox[offset]
+        elif key == "height":
+            return bbox[offset+3] - bbox[offset+1]
+        elif key == "word_text":
+            return self.geometry.get_word_text(self.line_index, self.index)
+        elif key == "word_conf":
+            word_conf = self.geometry.word_conf[self.index]
+            return None if word_conf == -1 else word_conf
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.keys_
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def keys(self):
+        return list(self.keys_)
+
+    def get(self, key, default=None):
+        return self[key] if key in self.keys_ else default
+
+    def to_dict(self):
+        return {key: self[key] for key in self.keys_}
+
+
+class LineView(object):
+
+    __slots__ = ["geometry", "index"]
+
+    box_keys = ["bbox", "width", "height", "left", "right", "top", "bottom"]
+    # layout dependent keys, the only ones that can be set
+    text_keys = ["spaced_line_text", "clean_line_text"]
+
+    def __init__(self, geometry, index):
+        # dict-like view of a line in a PageGeometry
+        self.geometry = geometry
+        self.index = index
+
+    def __getitem__(self, key):
+        bbox = self.geometry.line_bbox
+        offset = self.index * 4
+        if key == "left":
+            return bbox[offset]
+        elif key == "top":
+            return bbox[offset+1]
+        elif key == "right":
+            return bbox[offset+2]
+        elif key == "bottom":
+            return bbox[offset+3]
+        elif key == "bbox":
+            return list(bbox[offset:offset+4])
+        elif key == "width":
+            return bbox[offset+2] - bbox[offset]
+        elif key == "height":
+            return bbox[offset+3] - bbox[offset+1]
+        elif key == "line_text":
+            return self.geometry.get_line_text(self.index)
+        elif key == "words":
+            word_start = self.geometry.get_line_word_start(self.index)
+            word_end = self.geometry.line_word_end[self.index]
+            return [WordView(self.geometry, self.index, word_index) for word_index in range(word_start, word_end)]
+        elif key in self.text_keys:
+            value = getattr(self.geometry, key)[self.index]
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.text_keys:
+            raise KeyError("Line geometry is read-only, cannot set {k}".format(k=key))
+        getattr(self.geometry, key)[self.index] = value
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        keys = self.box_keys + ["line_text", "words"]
+        return keys + [key for key in self.text_keys if getattr(self.geometry, key)[self.index] is not None]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def to_dict(self):
+        line = {key: self[key] for key in self.keys()}
+        line["words"] = [word.to_dict() for word in line["words"]]
+        return line
+
+
+class ArrayHOCRPage(parse_hocr_files.HOCRPage):
+
+    def __init__(self, hocr_page_element, geometry, carea, page_num=None, minimum_paragraph_gap=10, avg_char_width=20):
+        """
+        Action: a HOCRPage with its line and word geometry in a PageGeometry instead of dicts
+        Input: the page element (a Beautiful Soup tag or HOCRElement), a PageGeometry and the text area box
+        Output: an ArrayHOCRPage object, with the same lines and paragraphs as a HOCRPage
+
+        The lines are LineViews, which support the dict-style access of the notebook code.
+        Use to_dict on a line to get a plain (JSON serialisable) dict. The spacing of all
+        lines is computed for the whole page in one pass over the coordinate arrays, and the
+        layout index used by the line number heuristics is made directly from the arrays.
+        """
+        super().__init__(hocr_page_element, page_num, minimum_paragraph_gap=minimum_paragraph_gap,
+                         avg_char_width=avg_char_width)
+        self.geometry = geometry
+        self.carea = carea
+        self.lines = [LineView(geometry, line_index) for line_index in range(geometry.num_lines)]
+        self.word_spaces = None
+        self.set_spaced_line_texts()
+
+    def set_word_spaces(self):
+        # white spacing between each word and the next word on the page
+        word_lefts = self.geometry.word_bbox[4::4]
+        word_rights = self.geometry.word_bbox[2::4]
+        self.word_spaces = [int(round((left - right) / self.avg_char_width)) or 1
+                            for right, left in zip(word_rights, word_lefts)]
+
+    def set_spaced_line_texts(self):
+        self.set_word_spaces()
+        word_texts = self.geometry.get_word_texts()
+        word_lefts = self.geometry.word_bbox[0::4]
+        carea_left = self.carea["left"]
+        for line_index in range(self.geometry.num_lines):
+            word_start = self.geometry.get_line_word_start(line_index)
+            word_end = self.geometry.line_word_end[line_index]
+            self.geometry.spaced_line_text[line_index] = self.get_spaced_word_range_text(word_start, word_end,
+                                                                                        word_texts, word_lefts,
+                                                                                        carea_left)
+
+    def get_spaced_word_range_text(self, word_start, word_end, word_texts, word_lefts, carea_left):
+        if word_start == word_end:
+            return ""
+        parts = [" " * int(round((word_lefts[word_start] - carea_left) / self.avg_char_width))]
+        for word_index in range(word_start, word_end - 1):
+            parts.append(word_texts[word_index])
+            parts.append(" " * self.word_spaces[word_index])
+        parts.append(word_texts[word_end - 1])
+        return "".join(parts)
+
+    def get_spaced_line_text(self, words):
+        # words are consecutive WordViews of a line
+        if len(words) == 0:
+            return ""
+        word_start = words[0].index
+        word_end = words[-1].index + 1
+        word_texts = {word.index: word["word_text"] for word in words}
+        word_lefts = {word_start: words[0]["left"]}
+        return self.get_spaced_word_range_text(word_start, word_end, word_texts, word_lefts, self.carea["left"])
+
+    def get_spaces(self, word1, word2):
+        if word2.index == word1.index + 1:
+            return " " * self.word_spaces[word1.index]
+        return super().get_spaces(word1, word2)
+
+    def make_layout_index(self):
+        return hocr_layout_index.PageLayoutIndex(self.geometry.line_bbox, self.carea["bbox"], self.get_word_arrays)
+
+    def get_word_arrays(self):
+        word_lengths = [len(word_text) for word_text in self.geometry.get_word_texts()]
+        return self.geometry.word_bbox, self.geometry.line_word_end, word_lengths
+
+
+def make_page_geometry(hocr_page):
+    header, columns, text = hocr_page_cache.make_page_columns(hocr_page)
+    return PageGeometry(columns, text)
+
+def make_array_hocr_page(filepath, page_num=None, remove_line_numbers=False, minimum_paragraph_gap=10, avg_char_width=20,
+                         parser="bsoup", cache=None, estimate_layout=False):
+    """
+    make_array_hocr_page is the counterpart of parse_hocr_files.make_hocr_page that returns an
+    ArrayHOCRPage. With a cache (see hocr_page_cache.HOCRPageCache), the geometry arrays are read
+    directly from the cached columns, without creating any dicts for lines and words.
+    """
+    page_columns = None
+    if cache:
+        with pipeline_stats.timer("page_cache_load"):
+            page_columns = cache.load_page_columns(filepath)
+        pipeline_stats.count("page_cache_hits" if page_columns else "page_cache_misses")
+    if page_columns:
+        header, columns, text = page_columns
+    else:
+        hocr_page = parse_hocr_files.parse_hocr_page(filepath, page_num, parser=parser)
+        if cache:
+            cache.store_hocr_page(filepath, hocr_page)
+        header, columns, text = hocr_page_cache.make_page_columns(hocr_page)
+    hocr_page_element = hocr_page_cache.make_page_element(header)
+    carea = parse_hocr_files.make_hocr_box(header["carea_bbox"])
+    hocr_page = ArrayHOCRPage(hocr_page_element, PageGeometry(columns, text), carea, page_num,
+                              minimum_paragraph_gap=minimum_paragraph_gap, avg_char_width=avg_char_width)
+    if estimate_layout:
+        hocr_page.apply_layout_estimates()
+    if remove_line_numbers:
+        with pipeline_stats.timer("remove_line_numbers"):
+            hocr_page.remove_line_numbers()
+    with pipeline_stats.timer("paragraphs"):
+        hocr_page.set_paragraphs()
+        hocr_page.merge_paragraph_lines()
+    pipeline_stats.count("pages")
+    return hocr_page
+
+def benchmark_geometry(hocr_files, **kwargs):
+    """
+    benchmark_geometry compares the dict-based HOCRPage with the array-based ArrayHOCRPage on
+    all given (filepath, page_num) pairs, e.g. all pages of a book from get_hocr_files.
+    Additional keyword arguments are passed on to make_hocr_page and make_array_hocr_page.
+    Reports the time to make all pages, the memory used to hold all pages and a list of
+    pages for which the two representations differ.
+    """
+    hocr_files = list(hocr_files)
+    make_functions = {
+        "dict": parse_hocr_files.make_hocr_page,
+        "array": make_array_hocr_page,
+    }
+    report = {"pages": len(hocr_files), "mismatches": [], "seconds": {}, "memory_bytes": {}}
+    hocr_pages = {}
+    for representation, make_function in make_functions.items():
+        start = time.time()
+        hocr_pages[representation] = [make_function(filepath, page_num, **kwargs) for filepath, page_num in hocr_files]
+        report["seconds"][representation] = time.time() - start
+        # measure memory separately, as tracing allocations slows down the timed run
+        hocr_pages[representation] = None
+        tracemalloc.start()
+        hocr_pages[representation] = [make_function(filepath, page_num, **kwargs) for filepath, page_num in hocr_files]
+        report["memory_bytes"][representation] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    for dict_page, array_page in zip(hocr_pages["dict"], hocr_pages["array"]):
+        array_page_state = parse_hocr_files.get_hocr_page_state(array_page)
+        array_page_state["lines"] = [line.to_dict() for line in array_page.lines]
+        if parse_hocr_files.get_hocr_page_state(dict_page) != array_page_state:
+            report["mismatches"].append(dict_page.page_num)
+    return report
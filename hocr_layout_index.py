@@ -0,0 +1,277 @@
+import bisect
+import functools
+from array import array
+
+
+# the sides of the text area, e.g. the side of the margin with line numbers
+LEFT = "left"
+RIGHT = "right"
+# offset of a missing neighbour line
+NO_NEIGHBOUR = float("-inf")
+
+
+def get_median(values):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 == 1 else (values[middle-1] + values[middle]) / 2
+
+def get_sorted_order(values):
+    # indexes of the values in sorted order, ties in their original order
+    return sorted(range(len(values)), key=values.__getitem__)
+
+
+class PageLayoutIndex(object):
+
+    def __init__(self, line_bbox, carea_bbox, load_words):
+        """
+        Action: geometry index of the lines and words of a page, for layout queries
+        Input: a flat (left, top, right, bottom) array of the line boxes, the box of the text area,
+        and a function that returns a flat array of the word boxes, the cumulative end offset of
+        the words of each line and the number of characters of each word
+        Output: a PageLayoutIndex object
+
+        Lines are sorted by top and words by left and by top (on first use), so lines in a vertical
+        band and words in a horizontal or vertical band are found by bisecting the sorted coordinates.
+        Boxes overlap a band if they start before its end and end after its start, so the
+        search starts the maximum box size before the band.
+
+        The words are only loaded when a query needs them. Per line values that the line number
+        heuristics of HOCRPage need, like the distance to
+        the text area edges and how far a line sticks out from its neighbours, are computed for
+        all lines at once on first use. Columns and gutters are detected from the horizontal
+        projection of all words. The average character width and the paragraph gap can be
+        estimated from the page itself, for books with a different layout than the OHZ books.
+        """
+        self.line_bbox = array("i", line_bbox)
+        self.carea_bbox = list(carea_bbox)
+        self.num_lines = len(self.line_bbox) // 4
+        self.load_words = load_words
+        self.word_bbox = None
+        # the sorted lines and words, made on first use, as the line number heuristics don't need them
+        self.line_y_order = None
+        self.word_x_order = None
+        self.word_line = None
+        # per side and k, and per gutter width
+        self.stick_out = {}
+        self.columns = {}
+
+    def sort_lines(self):
+        if self.line_y_order is not None:
+            return
+        line_tops = self.line_bbox[1::4]
+        self.line_y_order = get_sorted_order(line_tops)
+        self.line_y_tops = [line_tops[line_index] for line_index in self.line_y_order]
+        # position of each line in the y order
+        self.line_y_rank = [0] * self.num_lines
+        for rank, line_index in enumerate(self.line_y_order):
+            self.line_y_rank[line_index] = rank
+        self.max_line_height = max([bottom - top for top, bottom in zip(line_tops, self.line_bbox[3::4])], default=0)
+
+    def set_words(self):
+        if self.word_bbox is not None:
+            return
+        word_bbox, line_word_end, word_lengths = self.load_words()
+        self.word_bbox = array("i", word_bbox)
+        self.line_word_end = array("i", line_word_end)
+        self.word_lengths = array("i", word_lengths)
+        self.num_words = len(self.word_lengths)
+
+    def sort_words(self):
+        if self.word_x_order is not None:
+            return
+        self.set_words()
+        word_lefts = self.word_bbox[0::4]
+        word_tops = self.word_bbox[1::4]
+        self.word_x_order = get_sorted_order(word_lefts)
+        self.word_x_lefts = [word_lefts[word_index] for word_index in self.word_x_order]
+        self.word_y_order = get_sorted_order(word_tops)
+        self.word_y_tops = [word_tops[word_index] for word_index in self.word_y_order]
+        self.max_word_width = max([right - left for left, right in zip(word_lefts, self.word_bbox[2::4])], default=0)
+        self.max_word_height = max([bottom - top for top, bottom in zip(word_tops, self.word_bbox[3::4])], default=0)
+        # the line of each word
+        self.word_line = array("i")
+        word_start = 0
+        for line_index, word_end in enumerate(self.line_word_end):
+            self.word_line.extend([line_index] * (word_end - word_start))
+            word_start = word_end
+
+    ####################
+    # Band queries     #
+    ####################
+
+    def get_lines_in_y_band(self, top, bottom):
+        # indexes of the lines that overlap the vertical band, in order of their top
+        self.sort_lines()
+        start = bisect.bisect_left(self.line_y_tops, top - self.max_line_height)
+        end = bisect.bisect_right(self.line_y_tops, bottom)
+        return [line_index for line_index in self.line_y_order[start:end] if self.line_bbox[line_index*4+3] >= top]
+
+    def get_words_in_x_band(self, left, right, top=None, bottom=None):
+        # indexes of the words that overlap the horizontal band, in order of their left, optionally within a vertical band
+        self.sort_words()
+        start = bisect.bisect_left(self.word_x_lefts, left - self.max_word_width)
+        end = bisect.bisect_right(self.word_x_lefts, right)
+        word_indexes = [word_index for word_index in self.word_x_order[start:end] if self.word_bbox[word_index*4+2] >= left]
+        if top is not None and bottom is not None:
+            word_indexes = [word_index for word_index in word_indexes
+                            if self.word_bbox[word_index*4+1] <= bottom and self.word_bbox[word_index*4+3] >= top]
+        return word_indexes
+
+    def get_words_in_y_band(self, top, bottom):
+        # indexes of the words that overlap the vertical band, in order of their top
+        self.sort_words()
+        start = bisect.bisect_left(self.word_y_tops, top - self.max_word_height)
+        end = bisect.bisect_right(self.word_y_tops, bottom)
+        return [word_index for word_index in self.word_y_order[start:end] if self.word_bbox[word_index*4+3] >= top]
+
+    def get_neighbour_lines(self, line_index, k=2):
+        # the (at most) k lines above and k lines below a line, in order of their top
+        self.sort_lines()
+        rank = self.line_y_rank[line_index]
+        return self.line_y_order[max(0, rank - k):rank] + self.line_y_order[rank + 1:rank + k + 1]
+
+    def get_word_line(self, word_index):
+        self.sort_words()
+        return self.word_line[word_index]
+
+    ####################
+    # Margins          #
+    ####################
+
+    def get_carea_distance(self, line_index, side):
+        # distance of the line to the left or right edge of the text area
+        if side == LEFT:
+            return self.line_bbox[line_index*4] - self.carea_bbox[0]
+        return self.carea_bbox[2] - self.line_bbox[line_index*4+2]
+
+    def get_side_offsets(self, side):
+        # line offsets towards the margin on the given side, so sticking out is a larger offset on both sides
+        if side == LEFT:
+            return [-left for left in self.line_bbox[0::4]]
+        return list(self.line_bbox[2::4])
+
+    def get_stick_out(self, line_index, k=2, side=LEFT):
+        """
+        Returns how far a line sticks out to the margin on the given side from the k lines before
+        and after it in page order, as in HOCRPage.sticks_out, or None for a line without neighbours.
+        All lines are computed in one pass per side and k.
+        """
+        if (side, k) not in self.stick_out:
+            offsets = self.get_side_offsets(side)
+            # the largest offset of the neighbours, from the offsets shifted by 1 to k lines in both directions
+            neighbour_max = [NO_NEIGHBOUR] * len(offsets)
+            for shift in range(1, k + 1):
+                after = offsets[shift:] + [NO_NEIGHBOUR] * shift
+                before = [NO_NEIGHBOUR] * shift + offsets[:-shift]
+                neighbour_max = list(map(max, neighbour_max, after, before))
+            self.stick_out[(side, k)] = [None if neighbour == NO_NEIGHBOUR else offset - neighbour
+                                         for offset, neighbour in zip(offsets, neighbour_max)]
+        return self.stick_out[(side, k)][line_index]
+
+    ####################
+    # Columns          #
+    ####################
+
+    def get_columns(self, min_gutter_width=None):
+        """
+        Returns the columns of text on the page as dicts with left, right and the number of lines
+        with words in the column, from left to right. Columns are separated by gutters: vertical
+        strips without any word that are at least min_gutter_width wide (by default three
+        times the estimated character width). Line numbers and notes in the margin form columns
+        with few lines.
+        """
+        if min_gutter_width is None:
+            min_gutter_width = 3 * (self.estimate_avg_char_width() or 20)
+        if min_gutter_width in self.columns:
+            return self.columns[min_gutter_width]
+        self.sort_words()
+        columns = []
+        # sweep over the words from left to right, starting a new column after each wide enough gap
+        column_right = None
+        for word_index in self.word_x_order:
+            left, right = self.word_bbox[word_index*4], self.word_bbox[word_index*4+2]
+            if column_right is None or left - column_right >= min_gutter_width:
+                columns.append({"left": left, "right": right, "lines": set()})
+            columns[-1]["right"] = max(columns[-1]["right"], right)
+            columns[-1]["lines"].add(self.word_line[word_index])
+            column_right = columns[-1]["right"]
+        columns = [{"left": column["left"], "right": column["right"], "num_lines": len(column["lines"])}
+                   for column in columns]
+        self.columns[min_gutter_width] = columns
+        return columns
+
+    def get_gutters(self, min_gutter_width=None):
+        # the (left, right) strips between the columns
+        columns = self.get_columns(min_gutter_width)
+        return [(column["right"], next_column["left"]) for column, next_column in zip(columns, columns[1:])]
+
+    def get_column(self, x, min_gutter_width=None):
+        # index of the column that contains the x position, or None if it is in a gutter or margin
+        columns = self.get_columns(min_gutter_width)
+        column_index = bisect.bisect_right([column["left"] for column in columns], x) - 1
+        if column_index >= 0 and x <= columns[column_index]["right"]:
+            return column_index
+        return None
+
+    ####################
+    # Estimates        #
+    ####################
+
+    def estimate_avg_char_width(self, min_word_length=2):
+        """
+        Estimates the average character width from the width and number of characters of all
+        words of at least min_word_length characters, in one pass over the word boxes.
+        Returns None for a page without such words.
+        """
+        self.set_words()
+        total_width = 0
+        total_chars = 0
+        for left, right, word_length in zip(self.word_bbox[0::4], self.word_bbox[2::4], self.word_lengths):
+            if word_length >= min_word_length:
+                total_width += right - left
+                total_chars += word_length
+        return total_width / total_chars if total_chars > 0 else None
+
+    def estimate_paragraph_gap(self):
+        """
+        Estimates the minimum_paragraph_gap of HOCRPage.set_paragraphs from the gaps between
+        successive lines: most gaps are between lines of the same paragraph, so a gap larger than
+        the median gap plus half the median line height is taken as a paragraph boundary.
+        Returns None for a page with fewer than three lines.
+        """
+        if self.num_lines < 3:
+            return None
+        line_tops = self.line_bbox[1::4]
+        line_bottoms = self.line_bbox[3::4]
+        gaps = [next_top - bottom for bottom, next_top in zip(line_bottoms, line_tops[1:])]
+        heights = [bottom - top for top, bottom in zip(line_tops, line_bottoms)]
+        return int(get_median(gaps) + get_median(heights) / 2)
+
+    def get_center_columns(self, avg_char_width, band_chars=14):
+        """
+        Returns the (start, end) character columns of the centre of the text area in spaced
+        line texts, band_chars wide, for detecting centred charter numbers in books with a
+        different text area width than the OHZ books (see charter_titles.CENTER_COLUMNS).
+        """
+        center = int(round((self.carea_bbox[2] - self.carea_bbox[0]) / 2 / avg_char_width))
+        return center - band_chars // 2, center + band_chars - band_chars // 2
+
+
+def get_word_arrays(lines):
+    # the word boxes, end offsets and lengths of lines with words as dicts
+    word_bbox = array("i")
+    line_word_end = array("i")
+    word_lengths = array("i")
+    for line in lines:
+        for word in line["words"]:
+            word_bbox.extend(word["bbox"])
+            word_lengths.append(len(word["word_text"]))
+        line_word_end.append(len(word_lengths))
+    return word_bbox, line_word_end, word_lengths
+
+def make_layout_index(hocr_page):
+    # a PageLayoutIndex of a HOCRPage with lines and words as dicts
+    line_bbox = array("i", [coordinate for line in hocr_page.lines for coordinate in line["bbox"]])
+    return PageLayoutIndex(line_bbox, hocr_page.carea["bbox"], functools.partial(get_word_arrays, hocr_page.lines))
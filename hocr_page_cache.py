@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import struct
+from array import array
+
+import parse_hocr_files
+
+
+class HOCRPageCache(object):
+
+    # file format identifier, followed by the length of the JSON header
+    magic = b"HOCRPC01"
+    header_struct = struct.Struct("<8sI")
+    # column arrays stored after the header, in this order
+    columns = ["line_bbox", "line_word_end", "line_text_end", "word_bbox", "word_conf", "word_text_end"]
+
+    def __init__(self, cache_dir):
+        """
+        Action: on-disk cache of the word and line geometry of parsed hOCR pages
+        Input: the directory to store cached pages in
+        Output: a HOCRPageCache object that make_hocr_page can use to skip parsing
+
+        Cached pages are keyed on a hash of the hOCR file content and the parser version
+        (parse_hocr_files.PARSER_VERSION), so a changed file or a changed parser never
+        gives a stale page. Each page is stored in a compact columnar format: the
+        coordinates and confidences in int32 columns and all text in one UTF-8 buffer
+        with end offsets per line and word.
+
+        Only the geometry is cached. The layout dependent steps, which depend on
+        avg_char_width and minimum_paragraph_gap, are recomputed when a page is loaded.
+
+        Cached pages are never removed automatically. Use evict, prune or clear.
+        """
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_key(self, filepath):
+        with open(filepath, 'rb') as fh:
+            content_hash = hashlib.sha1(fh.read()).hexdigest()
+        return "{h}-v{v}".format(h=content_hash, v=parse_hocr_files.PARSER_VERSION)
+
+    def get_cache_file(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".hpc")
+
+    def load_hocr_page(self, filepath, page_num=None, minimum_paragraph_gap=10, avg_char_width=20):
+        # returns None if the page is not in the cache
+        page_columns = self.load_page_columns(filepath)
+        if not page_columns:
+            return None
+        header, columns, text = page_columns
+        return make_hocr_page_from_columns(header, columns, text, page_num, minimum_paragraph_gap, avg_char_width)
+
+    def load_page_columns(self, filepath):
+        # returns the header, columns and text of a cached page, or None if the page is not in the cache
+        cache_file = self.get_cache_file(self.get_key(filepath))
+        if not os.path.exists(cache_file):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return read_page_columns(cache_file)
+
+    def store_hocr_page(self, filepath, hocr_page):
+        cache_file = self.get_cache_file(self.get_key(filepath))
+        if not os.path.exists(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        header, columns, text = make_page_columns(hocr_page)
+        # write to a temporary file first, so concurrent readers never see a partial page
+        tmp_file = "{f}.{p}.tmp".format(f=cache_file, p=os.getpid())
+        write_page_columns(tmp_file, header, columns, text)
+        os.replace(tmp_file, cache_file)
+
+    def has_hocr_page(self, filepath):
+        return os.path.exists(self.get_cache_file(self.get_key(filepath)))
+
+    def evict(self, filepath):
+        # remove the cached page of a hOCR file, returns True if there was one
+        cache_file = self.get_cache_file(self.get_key(filepath))
+        if not os.path.exists(cache_file):
+            return False
+        os.remove(cache_file)
+        return True
+
+    def prune(self, keep_filepaths=None):
+        """
+        Remove all cached pages of other parser versions. If keep_filepaths is given,
+        also remove all cached pages that do not belong to the current content of one
+        of these hOCR files. Returns the number of removed pages.
+        """
+        keep_keys = None
+        if keep_filepaths is not None:
+            keep_keys = set([self.get_key(filepath) for filepath in keep_filepaths])
+        version_suffix = "-v{v}".format(v=parse_hocr_files.PARSER_VERSION)
+        removed = 0
+        for cache_file in self.get_cache_files():
+            key = os.path.basename(cache_file)[:-len(".hpc")]
+            if not key.endswith(version_suffix) or (keep_keys is not None and key not in keep_keys):
+                os.remove(cache_file)
+                removed += 1
+        return removed
+
+    def clear(self):
+        removed = 0
+        for cache_file in self.get_cache_files():
+            os.remove(cache_file)
+            removed += 1
+        return removed
+
+    def get_cache_files(self):
+        for root, dirs, files in os.walk(self.cache_dir):
+            for fname in sorted(files):
+                if fname.endswith(".hpc"):
+                    yield os.path.join(root, fname)
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def make_page_columns(hocr_page):
+    # Split the parsed geometry of a page in a small JSON header with the page level
+    # information and int32 columns for the lines and words.
+    header = {
+        "tag": hocr_page.tag,
+        "class": hocr_page.class_,
+        "attributes": hocr_page.attributes,
+        "carea_bbox": hocr_page.carea["bbox"],
+    }
+    columns = {column: array("i") for column in HOCRPageCache.columns}
+    texts = []
+    text_length = 0
+    num_words = 0
+    for line in hocr_page.lines:
+        columns["line_bbox"].extend(line["bbox"])
+        texts.append(line["line_text"])
+        text_length += len(line["line_text"])
+        columns["line_text_end"].append(text_length)
+        for word in line["words"]:
+            columns["word_bbox"].extend(word["bbox"])
+            # -1 for words without a confidence score
+            columns["word_conf"].append(-1 if word["word_conf"] is None else word["word_conf"])
+            texts.append(word["word_text"])
+            text_length += len(word["word_text"])
+            columns["word_text_end"].append(text_length)
+        num_words += len(line["words"])
+        columns["line_word_end"].append(num_words)
+    return header, columns, "".join(texts)
+
+def write_page_columns(cache_file, header, columns, text):
+    header = dict(header)
+    header["column_lengths"] = [len(columns[column]) for column in HOCRPageCache.columns]
+    text_bytes = text.encode("utf-8")
+    header["text_bytes"] = len(text_bytes)
+    header_bytes = json.dumps(header).encode("utf-8")
+    with open(cache_file, 'wb') as fh:
+        fh.write(HOCRPageCache.header_struct.pack(HOCRPageCache.magic, len(header_bytes)))
+        fh.write(header_bytes)
+        for column in HOCRPageCache.columns:
+            fh.write(columns[column].tobytes())
+        fh.write(text_bytes)
+
+def read_page_columns(cache_file):
+    with open(cache_file, 'rb') as fh:
+        data = fh.read()
+    magic, header_length = HOCRPageCache.header_struct.unpack_from(data, 0)
+    if magic != HOCRPageCache.magic:
+        raise ValueError("Invalid hOCR page cache file: {f}".format(f=cache_file))
+    offset = HOCRPageCache.header_struct.size
+    header = json.loads(data[offset:offset+header_length].decode("utf-8"))
+    offset += header_length
+    columns = {}
+    for column, column_length in zip(HOCRPageCache.columns, header["column_lengths"]):
+        columns[column] = array("i")
+        columns[column].frombytes(data[offset:offset + column_length * columns[column].itemsize])
+        offset += column_length * columns[column].itemsize
+    text = data[offset:offset+header["text_bytes"]].decode("utf-8")
+    return header, columns, text
+
+def make_page_element(header):
+    # recreate the page element from the cached page level information
+    return parse_hocr_files.HOCRElement(header["tag"], {
+        "class": " ".join(header["class"]),
+        "title": "; ".join([key + " " + value for key, value in header["attributes"].items()]),
+    })
+
+def make_hocr_page_from_columns(header, columns, text, page_num=None, minimum_paragraph_gap=10, avg_char_width=20):
+    hocr_page_element = make_page_element(header)
+    hocr_page = parse_hocr_files.HOCRPage(hocr_page_element, page_num, minimum_paragraph_gap=minimum_paragraph_gap,
+                                          avg_char_width=avg_char_width)
+    hocr_page.carea = parse_hocr_files.make_hocr_box(header["carea_bbox"])
+    word_index = 0
+    text_offset = 0
+    line_bbox = columns["line_bbox"]
+    word_bbox = columns["word_bbox"]
+    for line_index, line_word_end in enumerate(columns["line_word_end"]):
+        line = parse_hocr_files.make_hocr_box(list(line_bbox[line_index*4:line_index*4+4]))
+        line_text_end = columns["line_text_end"][line_index]
+        line["line_text"] = text[text_offset:line_text_end]
+        text_offset = line_text_end
+        line["words"] = []
+        while word_index < line_word_end:
+            word = parse_hocr_files.make_hocr_box(list(word_bbox[word_index*4:word_index*4+4]))
+            word_text_end = columns["word_text_end"][word_index]
+            word["word_text"] = text[text_offset:word_text_end]
+            text_offset = word_text_end
+            word_conf = columns["word_conf"][word_index]
+            word["word_conf"] = None if word_conf == -1 else word_conf
+            line["words"].append(word)
+            word_index += 1
+        hocr_page.add_line(line)
+    return hocr_page
@@ -0,0 +1,199 @@
+import datetime
+import json
+import os
+import sqlite3
+import time
+
+import pipeline_stats
+
+
+def serialise_value(value):
+    # like the Elasticsearch client serializer, dates are indexed as ISO strings
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError("Object of type {t} is not JSON serializable".format(t=type(value).__name__))
+
+def serialise_document(body):
+    return json.dumps(body, default=serialise_value)
+
+
+class ElasticsearchBackend(object):
+
+    def __init__(self, es):
+        # es is an elasticsearch.Elasticsearch client
+        self.es = es
+
+    def bulk(self, actions):
+        # Returns the actions that failed, with the error reported by Elasticsearch
+        lines = []
+        for action in actions:
+            lines += [
+                json.dumps({"index": {"_index": action["index"], "_type": action["doc_type"], "_id": action["id"]}}),
+                action["body"]
+            ]
+        response = self.es.bulk(body="\n".join(lines) + "\n")
+        if not response.get("errors"):
+            return []
+        failed = []
+        for action, item in zip(actions, response["items"]):
+            result = item.get("index", {})
+            if result.get("status", 200) >= 300:
+                failed += [(action, result.get("error", result.get("status")))]
+        return failed
+
+    def close(self):
+        pass
+
+
+class JSONLinesBackend(object):
+
+    def __init__(self, jsonl_file):
+        """
+        Local stand-in for Elasticsearch that appends each document to a JSON lines file.
+        Documents that are indexed again with the same ID are appended again, get_documents
+        returns the last version.
+        """
+        self.jsonl_file = jsonl_file
+        self.fh = open(jsonl_file, 'a')
+
+    def bulk(self, actions):
+        for action in actions:
+            self.fh.write(json.dumps({
+                "index": action["index"],
+                "doc_type": action["doc_type"],
+                "id": action["id"],
+                "body": json.loads(action["body"])
+            }) + "\n")
+        self.fh.flush()
+        return []
+
+    def get_documents(self, index, doc_type=None):
+        documents = {}
+        if not os.path.exists(self.jsonl_file):
+            return []
+        with open(self.jsonl_file, 'rt') as fh:
+            for line in fh:
+                action = json.loads(line)
+                if action["index"] == index and (doc_type is None or action["doc_type"] == doc_type):
+                    documents[action["id"]] = action["body"]
+        return list(documents.values())
+
+    def close(self):
+        self.fh.close()
+
+
+class SQLiteBackend(object):
+
+    def __init__(self, db_file):
+        """
+        Local stand-in for Elasticsearch that stores documents in a SQLite table.
+        As in Elasticsearch, a document that is indexed again with the same ID replaces the old one.
+        """
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS documents (index_name TEXT, doc_type TEXT, doc_id TEXT, "
+                          "body TEXT, PRIMARY KEY (index_name, doc_id))")
+
+    def bulk(self, actions):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)",
+                                  [(action["index"], action["doc_type"], action["id"], action["body"])
+                                   for action in actions])
+        return []
+
+    def get_document(self, index, doc_id):
+        row = self.conn.execute("SELECT body FROM documents WHERE index_name = ? AND doc_id = ?",
+                                (index, doc_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_documents(self, index, doc_type=None):
+        if doc_type is None:
+            rows = self.conn.execute("SELECT body FROM documents WHERE index_name = ? ORDER BY rowid", (index,))
+        else:
+            rows = self.conn.execute("SELECT body FROM documents WHERE index_name = ? AND doc_type = ? ORDER BY rowid",
+                                     (index, doc_type))
+        return [json.loads(row[0]) for row in rows]
+
+    def close(self):
+        self.conn.close()
+
+
+class IndexSink(object):
+
+    def __init__(self, backend, batch_size=500, flush_interval=5.0, max_retries=3, retry_delay=1.0):
+        """
+        Action: collects documents to be indexed and sends them to the backend in bulk requests
+        Input: a backend (ElasticsearchBackend, JSONLinesBackend or SQLiteBackend), the number
+        of documents per bulk request, the maximum number of seconds documents are kept before
+        they are sent, and the number of retries and delay in seconds between retries of
+        failed requests.
+        Output: an IndexSink object
+
+        The flush interval is checked whenever a document is added, there is no background thread.
+        Documents are serialised when they are added, so later changes to a document dict
+        are not indexed, as with a direct es.index call. Call close (or use the sink as a
+        context manager) to send the remaining documents.
+        """
+        self.backend = backend
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.actions = []
+        self.last_flush = time.time()
+        self.stats = {"documents": 0, "requests": 0, "retries": 0, "failed": 0}
+        self.errors = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def index(self, index, doc_type, doc_id, body):
+        pipeline_stats.count("documents_indexed")
+        self.actions += [{"index": index, "doc_type": doc_type, "id": doc_id, "body": serialise_document(body)}]
+        if len(self.actions) >= self.batch_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        actions = self.actions
+        self.actions = []
+        self.last_flush = time.time()
+        if len(actions) > 0:
+            self.send(actions)
+
+    def send(self, actions):
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self.stats["retries"] += 1
+                time.sleep(self.retry_delay * attempt)
+            self.stats["requests"] += 1
+            try:
+                with pipeline_stats.timer("indexing"):
+                    failed = self.backend.bulk(actions)
+            except Exception as error:
+                # e.g. a connection error, retry the whole request
+                if attempt == self.max_retries:
+                    # the actions are no longer queued, so record them as failed before giving up
+                    self.stats["failed"] += len(actions)
+                    self.errors += [{"id": action["id"], "error": str(error)} for action in actions]
+                    raise
+                print("Bulk request failed, retrying:", error)
+                continue
+            self.stats["documents"] += len(actions) - len(failed)
+            if len(failed) == 0:
+                return
+            actions = [action for action, error in failed]
+            if attempt == self.max_retries:
+                self.stats["failed"] += len(failed)
+                self.errors += [{"id": action["id"], "error": error} for action, error in failed]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.backend.close()
+
+    def get_stats(self):
+        return dict(self.stats, queued=len(self.actions))
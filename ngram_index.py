@@ -0,0 +1,179 @@
+import math
+import time
+from array import array
+from collections import Counter
+
+
+class NgramIndex(object):
+
+    def __init__(self, ngram_size=2):
+        """
+        Action: inverted ngram index for fuzzy lookup of terms, e.g. the place names of a gazetteer
+        Input: the ngram size, which should be the ngram size used in FuzzyMatcher.filter_candidates
+        Output: a NgramIndex object
+
+        Each term gets an integer ID. Terms are split in ngrams in the same way as FuzzyMatcher
+        (padded with #), and each occurrence of an ngram in a term is indexed separately,
+        so that counting matching postings gives the exact ngram overlap of FuzzyMatcher.
+        Posting lists are sorted arrays of term IDs, bucketed by term length and (lower case)
+        initial, so a lookup only touches terms of lengths that can still meet the ngram
+        threshold and, if required, that start with the same initial.
+        """
+        self.ngram_size = ngram_size
+        self.terms = []
+        self.term_ids = {}
+        self.initials = set()
+        self.max_term_length = 0
+        # (ngram, occurrence, term length, term initial) -> sorted array of term IDs
+        self.postings = {}
+
+    def get_term_ngrams(self, term):
+        # padded ngrams of a term, numbered per occurrence, e.g. ("an", 1), ("an", 2)
+        term = "#{t}#".format(t=term)
+        occurrences = {}
+        term_ngrams = []
+        for start in range(0, len(term) - self.ngram_size + 1):
+            ngram = term[start:start+self.ngram_size]
+            occurrences[ngram] = occurrences.get(ngram, 0) + 1
+            term_ngrams.append((ngram, occurrences[ngram]))
+        return term_ngrams
+
+    def add_term(self, term):
+        if term in self.term_ids:
+            return self.term_ids[term]
+        term_id = len(self.terms)
+        self.terms.append(term)
+        self.term_ids[term] = term_id
+        initial = term[:1].lower()
+        self.initials.add(initial)
+        self.max_term_length = max(self.max_term_length, len(term))
+        for ngram, occurrence in self.get_term_ngrams(term):
+            posting_key = (ngram, occurrence, len(term), initial)
+            if posting_key not in self.postings:
+                self.postings[posting_key] = array("i")
+            # term IDs are increasing, so posting lists stay sorted
+            self.postings[posting_key].append(term_id)
+        return term_id
+
+    def get_length_range(self, term, ngram_threshold, max_length_difference=None):
+        # Range of indexed term lengths that can meet the ngram threshold:
+        # the overlap is at most the number of ngrams of the lookup term, and
+        # an indexed term of length L has L + 3 - ngram_size ngrams.
+        min_length = 0
+        max_length = self.max_term_length
+        if ngram_threshold > 0:
+            num_ngrams = len(term) + 3 - self.ngram_size
+            max_length = min(max_length, int(math.floor(num_ngrams / ngram_threshold)) - 3 + self.ngram_size)
+        if max_length_difference is not None:
+            min_length = max(min_length, len(term) - max_length_difference)
+            max_length = min(max_length, len(term) + max_length_difference)
+        return range(min_length, max_length + 1)
+
+    def count_overlap(self, term, lengths, initials):
+        # T-occurrence counting: the number of postings of a term ID is its ngram overlap with the lookup term
+        overlap = Counter()
+        buckets = [(length, initial) for length in lengths for initial in initials]
+        for ngram, occurrence in self.get_term_ngrams(term):
+            for length, initial in buckets:
+                posting = self.postings.get((ngram, occurrence, length, initial))
+                if posting:
+                    overlap.update(posting)
+        return overlap
+
+    def lookup(self, term, ngram_threshold, max_length_difference=None, same_initial=False, shared_ngram_size=None):
+        """
+        Returns the indexed terms of which the ngram overlap ratio with the given term
+        (as in FuzzyMatcher.score_ngram_overlap_ratio(indexed_term, term, ngram_size)) meets
+        the ngram threshold, in order of indexing. Optionally, only terms that differ at most
+        max_length_difference in length and that start with the same (case-insensitive) initial
+        are returned. With shared_ngram_size, only terms that share at least one (lower case,
+        unpadded) ngram of that size with the given term are returned, e.g. 3 for the same
+        candidates as the trigram index of the notebook's PlaceIndex.
+        """
+        lengths = self.get_length_range(term, ngram_threshold, max_length_difference)
+        initials = [term[:1].lower()] if same_initial else self.initials
+        if ngram_threshold <= 0:
+            # terms without any overlap also meet the threshold
+            terms = [indexed_term for indexed_term in self.terms
+                     if len(indexed_term) in lengths and indexed_term[:1].lower() in initials]
+        else:
+            overlap = self.count_overlap(term, lengths, initials)
+            term_ids = sorted([term_id for term_id, term_overlap in overlap.items()
+                               if term_overlap / (len(self.terms[term_id]) + 3 - self.ngram_size) >= ngram_threshold])
+            terms = [self.terms[term_id] for term_id in term_ids]
+        if shared_ngram_size is not None:
+            terms = select_shared_ngram_terms(term, terms, shared_ngram_size)
+        return terms
+
+
+def get_lower_ngrams(term, ngram_size):
+    # unpadded lower case ngrams, as get_ngrams in the notebook
+    term = term.lower()
+    return set([term[start:start+ngram_size] for start in range(0, len(term) - ngram_size + 1)])
+
+def select_shared_ngram_terms(term, terms, ngram_size):
+    # the terms that share at least one ngram with the given term, checked on the few terms that
+    # meet the ngram threshold instead of looking up every term that shares an ngram
+    term_ngrams = get_lower_ngrams(term, ngram_size)
+    return [indexed_term for indexed_term in terms if not term_ngrams.isdisjoint(get_lower_ngrams(indexed_term, ngram_size))]
+
+
+def make_trigram_index(terms):
+    # Index as in the notebook's PlaceIndex.placename_ngram_index, only used for comparison.
+    trigram_index = {}
+    for term in terms:
+        for start_index in range(0, len(term) - 2):
+            trigram_index.setdefault(term.lower()[start_index:start_index+3], {})[term] = True
+    return trigram_index
+
+def select_trigram_candidates(term, trigram_index, max_length_difference=2):
+    # all terms that share a trigram with the given term, then pruned on length and initial
+    candidates = set()
+    for start_index in range(0, len(term) - 2):
+        ngram = term.lower()[start_index:start_index+3]
+        if ngram in trigram_index:
+            candidates.update(trigram_index[ngram].keys())
+    return [candidate for candidate in candidates
+            if abs(len(candidate) - len(term)) <= max_length_difference and candidate[0].lower() == term[0].lower()]
+
+def benchmark_ngram_lookup(tokens, terms, fuzzy_matcher, ngram_size=2, max_length_difference=2):
+    """
+    benchmark_ngram_lookup compares the candidate selection of the notebook (every term that
+    shares a trigram with the token, pruned on length and initial) with a NgramIndex lookup,
+    for the given tokens (e.g. capitalised words from OCR text) and terms (e.g. gazetteer names).
+    In both cases, the selected candidates are verified with fuzzy_matcher.filter_candidates.
+    Reports the number of candidates checked and the time per token for both approaches,
+    and the tokens for which the verified matches differ. As the index lookup also requires
+    a shared trigram (shared_ngram_size=3), both should give the same matches.
+    """
+    trigram_index = make_trigram_index(terms)
+    ngram_index = NgramIndex(ngram_size)
+    for term in terms:
+        ngram_index.add_term(term)
+    report = {
+        "tokens": len(tokens),
+        "candidates_checked": {"trigram": 0, "ngram_index": 0},
+        "seconds_per_token": {},
+        "differences": [],
+    }
+    matches = {"trigram": [], "ngram_index": []}
+    # start both approaches without memoised scores
+    fuzzy_matcher.clear_score_cache()
+    start = time.time()
+    for token in tokens:
+        candidates = select_trigram_candidates(token, trigram_index, max_length_difference)
+        report["candidates_checked"]["trigram"] += len(candidates)
+        matches["trigram"].append(sorted(fuzzy_matcher.filter_candidates(candidates, token, ngram_size)))
+    report["seconds_per_token"]["trigram"] = (time.time() - start) / max(len(tokens), 1)
+    fuzzy_matcher.clear_score_cache()
+    start = time.time()
+    for token in tokens:
+        candidates = ngram_index.lookup(token, fuzzy_matcher.ngram_threshold, max_length_difference=max_length_difference,
+                                        same_initial=True, shared_ngram_size=3)
+        report["candidates_checked"]["ngram_index"] += len(candidates)
+        matches["ngram_index"].append(sorted(fuzzy_matcher.filter_candidates(candidates, token, ngram_size)))
+    report["seconds_per_token"]["ngram_index"] = (time.time() - start) / max(len(tokens), 1)
+    for token, trigram_matches, ngram_index_matches in zip(tokens, matches["trigram"], matches["ngram_index"]):
+        if trigram_matches != ngram_index_matches:
+            report["differences"].append({"token": token, "trigram": trigram_matches, "ngram_index": ngram_index_matches})
+    return report
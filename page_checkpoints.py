@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+
+import parse_hocr_files
+
+
+# Increase when the way charter titles are numbered changes, to invalidate stored checkpoints.
+CHECKPOINT_VERSION = 1
+
+
+def get_numbering_state(numbers):
+    # the part of the numbers dict that is carried from one page to the next
+    return {
+        "current_charter": list(numbers["current_charter"]),
+        "next_charter": numbers["next_charter"],
+    }
+
+def set_numbering_state(numbers, numbering_state):
+    numbers["current_charter"] = list(numbering_state["current_charter"])
+    numbers["next_charter"] = numbering_state["next_charter"]
+
+def get_paragraph_classes(hocr_page):
+    # the paragraph type and charter number(s) of each paragraph, as set by process_page
+    return [[paragraph.get("type"), paragraph.get("charter_number")] for paragraph in hocr_page.paragraphs]
+
+def get_class_charters(paragraph_classes):
+    return set([charter_num for paragraph_type, charter_numbers in paragraph_classes
+                for charter_num in charter_numbers or []])
+
+
+class PageCheckpoints(object):
+
+    def __init__(self, checkpoint_dir, known_ocr_errors, missing_numbers):
+        """
+        Action: stores the charter numbering state and paragraph classification after each page
+        Input: the directory to store checkpoints in, and the known OCR errors and missing
+        charter numbers that charter title detection depends on
+        Output: a PageCheckpoints object that process_books can use for incremental runs
+
+        A checkpoint records which inputs the page depends on: the content of the hOCR file
+        with the parser version and page options, and the entries of known_ocr_errors and
+        missing_numbers for the charter numbers that were checked on the page. A page is
+        skipped in a re-run if its inputs are unchanged and the numbering state at the start
+        of the page is the same as in its checkpoint. So a re-run starts at the first page
+        with changed inputs and stops re-processing pages once the numbering state is the
+        same as the stored state again.
+
+        Checkpoints are appended to a file per book after each page, so an interrupted run
+        also resumes where it stopped. The file is rewritten at the end of each book.
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.known_ocr_errors = known_ocr_errors
+        self.missing_numbers = set(missing_numbers)
+        # book_num -> page_num -> checkpoint
+        self.book_checkpoints = {}
+        # (book_num, page_num) of the pages that were processed and passed on in this run
+        self.changed_pages = set()
+        self.changed_charters = set()
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+    def clear(self):
+        # remove all stored checkpoints, so that all pages are processed again
+        self.book_checkpoints = {}
+        for checkpoint_file in os.listdir(self.checkpoint_dir):
+            if checkpoint_file.endswith(".jsonl"):
+                os.remove(os.path.join(self.checkpoint_dir, checkpoint_file))
+        self.changed_pages = set()
+        self.changed_charters = set()
+
+    def get_checkpoint_file(self, book_num):
+        return os.path.join(self.checkpoint_dir, "book-{b}.jsonl".format(b=book_num))
+
+    def get_input_key(self, filepath, page_num, page_options):
+        with open(filepath, 'rb') as fh:
+            content_hash = hashlib.sha1(fh.read()).hexdigest()
+        # the page cache has no effect on the parsed page
+        options = {option: value for option, value in page_options.items() if option != "cache"}
+        input_data = [CHECKPOINT_VERSION, parse_hocr_files.PARSER_VERSION, content_hash, page_num, options]
+        return hashlib.sha1(json.dumps(input_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get_config_key(self, first_number, last_number):
+        # hash of the known OCR errors and missing numbers of the charter numbers checked on a page
+        config_data = [[number, self.known_ocr_errors.get(number), number in self.missing_numbers]
+                       for number in range(first_number, last_number + 1)]
+        return hashlib.sha1(json.dumps(config_data).encode("utf-8")).hexdigest()
+
+    def load_book(self, book_num):
+        # later checkpoints of a page replace earlier ones
+        checkpoints = {}
+        checkpoint_file = self.get_checkpoint_file(book_num)
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file, 'rt') as fh:
+                for line in fh:
+                    try:
+                        checkpoint = json.loads(line)
+                    except ValueError:
+                        # a partially written last line of an interrupted run
+                        continue
+                    checkpoints[checkpoint["page_num"]] = checkpoint
+        self.book_checkpoints[book_num] = checkpoints
+        return checkpoints
+
+    def save_book(self, book_num):
+        checkpoint_file = self.get_checkpoint_file(book_num)
+        # write to a temporary file first, so an interrupted save never leaves partial checkpoints
+        tmp_file = "{f}.{p}.tmp".format(f=checkpoint_file, p=os.getpid())
+        with open(tmp_file, 'wt') as fh:
+            for page_num, checkpoint in sorted(self.book_checkpoints[book_num].items()):
+                fh.write(json.dumps(checkpoint) + "\n")
+        os.replace(tmp_file, checkpoint_file)
+
+    def is_page_unchanged(self, checkpoint, input_key):
+        if not checkpoint or checkpoint["input_key"] != input_key:
+            return False
+        return checkpoint["config_key"] == self.get_config_key(*checkpoint["checked_numbers"])
+
+    def add_checkpoint(self, book_num, filepath, page_num, input_key, numbering_state, numbers, hocr_page):
+        """
+        Stores the checkpoint of a processed page. Returns True if the page has changed
+        compared to its previous checkpoint, i.e. it has changed inputs or a different
+        paragraph classification, in which case it should be passed on downstream.
+        """
+        previous = self.book_checkpoints[book_num].get(page_num)
+        checkpoint = {
+            "page_num": page_num,
+            "filepath": filepath,
+            "input_key": input_key,
+            "numbers_in": numbering_state,
+            "numbers_out": get_numbering_state(numbers),
+            # the charter numbers that can have been checked on this page
+            "checked_numbers": [numbering_state["next_charter"], numbers["next_charter"]],
+            "paragraphs": get_paragraph_classes(hocr_page),
+        }
+        checkpoint["config_key"] = self.get_config_key(*checkpoint["checked_numbers"])
+        self.book_checkpoints[book_num][page_num] = checkpoint
+        with open(self.get_checkpoint_file(book_num), 'a') as fh:
+            fh.write(json.dumps(checkpoint) + "\n")
+        if previous and previous["input_key"] == input_key and previous["paragraphs"] == checkpoint["paragraphs"]:
+            return False
+        self.changed_pages.add((book_num, page_num))
+        # charters that lost paragraphs of this page have changed as well as the ones that got them
+        self.changed_charters.update(get_class_charters(checkpoint["paragraphs"]))
+        if previous:
+            self.changed_charters.update(get_class_charters(previous["paragraphs"]))
+        return True
+
+    def get_changed_charters(self):
+        return sorted(self.changed_charters)
+
+    def get_unchanged_charter_pages(self):
+        """
+        Returns (book_num, page_num, filepath) of the pages that were not passed on but have
+        paragraphs of changed charters, so that the paragraphs of changed charters can be completed.
+        """
+        charter_pages = []
+        for book_num, checkpoints in sorted(self.book_checkpoints.items()):
+            for page_num, checkpoint in sorted(checkpoints.items()):
+                if (book_num, page_num) in self.changed_pages:
+                    continue
+                if get_class_charters(checkpoint["paragraphs"]) & self.changed_charters:
+                    charter_pages += [(book_num, page_num, checkpoint["filepath"])]
+        return charter_pages
+
+    def restore_paragraphs(self, book_num, hocr_page):
+        # set the stored paragraph type and charter number(s) on the paragraphs of a re-parsed page
+        checkpoint = self.book_checkpoints[book_num][hocr_page.page_num]
+        for paragraph, (paragraph_type, charter_numbers) in zip(hocr_page.paragraphs, checkpoint["paragraphs"]):
+            paragraph["type"] = paragraph_type
+            if charter_numbers is not None:
+                paragraph["charter_number"] = charter_numbers
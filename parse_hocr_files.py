@@ -3,8 +3,31 @@
 # Context: parsing digitized charter books to extract geographic attestations and dates
 
 
+import os
 import re
-from bs4 import BeautifulSoup as bsoup
+import tempfile
+import time
+from html.entities import name2codepoint
+from html.parser import HTMLParser
+from xml.parsers import expat
+
+import hocr_layout_index
+import pipeline_stats
+
+try:
+    from bs4 import BeautifulSoup as bsoup
+except ImportError:
+    # the streaming parser backend only needs the standard library
+    bsoup = None
+
+# Parser backends that make_hocr_page can use to read hOCR files:
+# bsoup:  builds a full Beautiful Soup tree with lxml (original backend)
+# stream: single streaming pass that only keeps the hOCR elements
+PARSER_BACKENDS = ["bsoup", "stream"]
+
+# Version of the extracted page, line and word geometry. Increase this whenever a change
+# to the parsing changes the geometry, so that cached pages are no longer used.
+PARSER_VERSION = 2
 
 
 class HOCRPage(object):
@@ -39,6 +62,9 @@ class HOCRPage(object):
         self.paragraphs = []
         self.minimum_paragraph_gap = minimum_paragraph_gap
         self.avg_char_width = avg_char_width 
+        self.layout_index = None
+        # character columns of the centre of a title line, only set by the layout estimates
+        self.center_columns = None
 
         
     def set_carea(self, hocr_page_soup):
@@ -98,15 +124,49 @@ class HOCRPage(object):
         else:
             return False
         
+    def get_margin_side(self):
+        # line numbers are in the right margin of even numbered pages and in the left margin of the others
+        return hocr_layout_index.RIGHT if self.is_even_side() else hocr_layout_index.LEFT
+
+    def make_layout_index(self):
+        return hocr_layout_index.make_layout_index(self)
+
+    def __getstate__(self):
+        # pages are sent from the worker processes of process_books, the layout index is made again on first use
+        state = self.__dict__.copy()
+        state["layout_index"] = None
+        return state
+
+    def get_layout_index(self):
+        # the geometry index of the lines and words, made on first use once the lines are set
+        if self.layout_index is None:
+            self.layout_index = self.make_layout_index()
+        return self.layout_index
+
+    def apply_layout_estimates(self):
+        # Use the average character width and paragraph gap estimated from the page itself
+        # instead of the OHZ defaults, and restore the spacing of the lines with them.
+        # The centre columns of a title line follow from the estimated character width.
+        layout_index = self.get_layout_index()
+        avg_char_width = layout_index.estimate_avg_char_width()
+        if avg_char_width:
+            self.avg_char_width = avg_char_width
+        minimum_paragraph_gap = layout_index.estimate_paragraph_gap()
+        if minimum_paragraph_gap is not None:
+            self.minimum_paragraph_gap = minimum_paragraph_gap
+        self.center_columns = layout_index.get_center_columns(self.avg_char_width)
+        self.set_spaced_line_texts()
+
+    def set_spaced_line_texts(self):
+        for line in self.lines:
+            line["spaced_line_text"] = self.get_spaced_line_text(line["words"])
+
     def close_to_carea_edge(self, line_index):
         # Determine if a line has text close to the left/right margin.
         # This is used for a.o. determining whether there is a line number in the line text.
-        if self.is_even_side():
-            # for even numbered pages look at distance to right edge of text area
-            distance_from_margin = self.carea["right"] - self.lines[line_index]["right"]
-        else: 
-            # for uneven numbered pages look at distance to left edge of text area
-            distance_from_margin =  self.lines[line_index]["left"] - self.carea["left"]
+        # For even numbered pages look at distance to right edge of text area,
+        # for uneven numbered pages look at distance to left edge of text area.
+        distance_from_margin = self.get_layout_index().get_carea_distance(line_index, self.get_margin_side())
         # From eyeballing and testing, line numbers are no more than distance 70 from margin
         return True if distance_from_margin < 70 else False
         
@@ -120,15 +180,9 @@ class HOCRPage(object):
         min_stick_out = 40
         if line_index < 7:
             min_stick_out = 30
-        surrounding_lines =  self.lines[line_index-2:line_index] + self.lines[line_index+1:line_index+3]
-        for neighbour_line in surrounding_lines:
-            if self.is_even_side():
-                if self.lines[line_index]["right"] - neighbour_line["right"] < min_stick_out:
-                    return False
-            else:
-                if neighbour_line["left"] - self.lines[line_index]["left"] < min_stick_out:
-                    return False
-        return True
+        # how far the line sticks out from the two lines before and after it, computed for all lines at once
+        stick_out = self.get_layout_index().get_stick_out(line_index, k=2, side=self.get_margin_side())
+        return stick_out is None or stick_out >= min_stick_out
         
     def has_line_number(self, line_index, line_number):
         # check if line text contains a line number:
@@ -192,12 +246,16 @@ class HOCRPage(object):
             line = get_hocr_box(hocr_line_soup)
             line["line_text"] = hocr_line_soup.get_text()
             line["words"] = get_words(hocr_line_soup)
-            line["spaced_line_text"] = self.get_spaced_line_text(line["words"])
-            # occasionally, lines only contain a pipe char based on edge shading in scan
-            # skip those lines. 
-            if line["line_text"].strip() == "|" or line["line_text"].strip() == "|" or len(line["line_text"]) == 1:
-                continue
-            self.lines.append(line)
+            self.add_line(line)
+
+    def add_line(self, line):
+        # add a line with its box, line_text and words, and restore its spacing
+        line["spaced_line_text"] = self.get_spaced_line_text(line["words"])
+        # occasionally, lines only contain a pipe char based on edge shading in scan
+        # skip those lines. 
+        if line["line_text"].strip() == "|" or line["line_text"].strip() == "|" or len(line["line_text"]) == 1:
+            return
+        self.lines.append(line)
 
     def get_spaced_line_text(self, words):
         # use word coordinates to reconstruct spacing between words
@@ -222,6 +280,178 @@ class HOCRPage(object):
         return " " * spaces
 
 
+class HOCRElement(object):
+
+    def __init__(self, name, attrs):
+        """
+        Action: lightweight stand-in for a Beautiful Soup tag, created by the HOCRStreamParser
+        Input: tag name and attribute dictionary of an hOCR element
+        Output: a HOCRElement that supports the subset of the Beautiful Soup interface
+                that is used in this module: name, element['attr'], get_text(), find() and find_all()
+        """
+        self.name = name
+        self.attrs = attrs
+        self.children = []
+        self.text_parts = []
+
+    def __getitem__(self, attr):
+        if attr == "class":
+            # Beautiful Soup treats class as a multi-valued attribute
+            return self.attrs["class"].split()
+        return self.attrs[attr]
+
+    def has_class(self, class_):
+        return "class" in self.attrs and class_ in self.attrs["class"].split()
+
+    def get_text(self):
+        return "".join(self.text_parts)
+
+    def find(self, name, class_=None):
+        for element in self.find_all(name, class_):
+            return element
+        return None
+
+    def find_all(self, name, class_=None):
+        # depth-first, so elements are returned in document order
+        elements = []
+        for child in self.children:
+            if child.name == name and (class_ is None or child.has_class(class_)):
+                elements.append(child)
+            elements += child.find_all(name, class_)
+        return elements
+
+
+class HOCRStreamParser(object):
+
+    # elements that have no end tag in HTML
+    void_elements = ["area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source"]
+    ascii_spaces = "\x20\x0a\x09\x0c\x0d"
+
+    def __init__(self):
+        """
+        Action: parses a hOCR document in a single streaming pass, using incremental parse events
+        from expat or, for hOCR files that are not well-formed XML, from the standard library HTML parser.
+        Only elements with an hOCR class (ocr_page, ocr_carea, ocr_par, ocr_line, ocrx_word, ...)
+        are kept, in a tree of HOCRElements below self.document. All text within a kept element
+        is collected, so get_text() returns the same text as Beautiful Soup.
+        """
+        self.reset()
+
+    def reset(self):
+        self.document = HOCRElement("[document]", {})
+        # stack of open tags with the HOCRElement they created (or None)
+        self.open_tags = []
+        # stack of open HOCRElements, to collect text and attach children
+        self.open_elements = [self.document]
+        # text since the last tag, data can arrive in several parts
+        self.text_parts = []
+
+    def parse(self, hocr_file, chunk_size=65536):
+        try:
+            self.parse_xml(hocr_file, chunk_size)
+        except expat.ExpatError:
+            # Older Tesseract versions write hOCR that is HTML but not XML, e.g. unclosed meta tags
+            self.reset()
+            self.parse_html(hocr_file, chunk_size)
+        return self.document
+
+    def parse_xml(self, hocr_file, chunk_size):
+        xml_parser = expat.ParserCreate()
+        xml_parser.buffer_text = True
+        xml_parser.StartElementHandler = self.start_element
+        xml_parser.EndElementHandler = self.end_element
+        xml_parser.CharacterDataHandler = self.character_data
+        xml_parser.CommentHandler = self.comment
+        # named HTML entities are not defined for expat (the XHTML DTD is external), so they are skipped
+        xml_parser.SkippedEntityHandler = self.skipped_entity
+        with open(hocr_file, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(chunk_size), b""):
+                xml_parser.Parse(chunk, False)
+        xml_parser.Parse(b"", True)
+        self.flush_text()
+
+    def parse_html(self, hocr_file, chunk_size):
+        html_parser = HOCRHTMLParser(self)
+        with open(hocr_file, 'rt') as fh:
+            for chunk in iter(lambda: fh.read(chunk_size), ""):
+                html_parser.feed(chunk)
+        html_parser.close()
+        self.flush_text()
+
+    def flush_text(self):
+        if not self.text_parts:
+            return
+        text = "".join(self.text_parts)
+        self.text_parts = []
+        # Beautiful Soup collapses text that consists only of whitespace
+        # to a single newline or space, so do the same.
+        if text.strip(self.ascii_spaces) == "":
+            text = "\n" if "\n" in text else " "
+        for element in self.open_elements[1:]:
+            element.text_parts.append(text)
+
+    def start_element(self, tag, attrs):
+        self.flush_text()
+        if tag in self.void_elements:
+            return
+        element = None
+        if "class" in attrs and attrs["class"] and attrs["class"].startswith("ocr"):
+            element = HOCRElement(tag, attrs)
+            self.open_elements[-1].children.append(element)
+            self.open_elements.append(element)
+        self.open_tags.append((tag, element))
+
+    def end_element(self, tag):
+        self.flush_text()
+        # like the HTML parser in lxml, an end tag closes any unclosed tags it contains
+        if tag not in [open_tag for open_tag, _ in self.open_tags]:
+            return
+        while self.open_tags:
+            open_tag, element = self.open_tags.pop()
+            if element:
+                self.open_elements.pop()
+            if open_tag == tag:
+                break
+
+    def character_data(self, data):
+        self.text_parts.append(data)
+
+    def comment(self, data):
+        # comments are not part of the text, but they do separate text parts
+        self.flush_text()
+
+    def skipped_entity(self, entity_name, is_parameter_entity):
+        # resolve named HTML entities like &nbsp; and &eacute; as the HTML parser of lxml does
+        if entity_name in name2codepoint:
+            self.character_data(chr(name2codepoint[entity_name]))
+        else:
+            self.character_data("&{e};".format(e=entity_name))
+
+
+class HOCRHTMLParser(HTMLParser):
+
+    def __init__(self, stream_parser):
+        # passes the parse events of the standard library HTML parser on to a HOCRStreamParser
+        super().__init__(convert_charrefs=True)
+        self.stream_parser = stream_parser
+
+    def handle_starttag(self, tag, attrs):
+        self.stream_parser.start_element(tag, dict(attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in self.stream_parser.void_elements:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        self.stream_parser.end_element(tag)
+
+    def handle_data(self, data):
+        self.stream_parser.character_data(data)
+
+    def handle_comment(self, data):
+        self.stream_parser.comment(data)
+
 
 def make_empty_paragraph():
     return {
@@ -232,7 +462,9 @@ def make_empty_paragraph():
         
 def get_hocr_box(hocr_soup):
     # extract hocr bounding box, compute size and explicate offsets
-    element_bbox = get_hocr_bbox(hocr_soup)
+    return make_hocr_box(get_hocr_bbox(hocr_soup))
+
+def make_hocr_box(element_bbox):
     box_size = get_bbox_size(element_bbox)
     return {
         "bbox": element_bbox,
@@ -247,6 +479,11 @@ def get_hocr_box(hocr_soup):
 def get_hocr_content(hocr_file):
     with open(hocr_file, 'rt') as fh:
         return bsoup(fh, 'lxml')
+
+def get_hocr_stream_content(hocr_file):
+    # Single pass over the file with incremental parse events. Only elements with an
+    # hOCR class (ocr_page, ocr_carea, ocr_line, ocrx_word, ...) are kept.
+    return HOCRStreamParser().parse(hocr_file)
         
 def get_hocr_page_soup(hocr_soup):
     return hocr_soup.find("div", class_="ocr_page")
@@ -268,7 +505,11 @@ def get_hocr_bbox(hocr_element):
     return [int(coord) for coord in attributes["bbox"].split(" ")]
         
 def get_hocr_title_attributes(hocr_element):
-    return {part.split(" ", 1)[0]: part.split(" ", 1)[1] for part in hocr_element['title'].split("; ")}
+    attributes = {}
+    for part in hocr_element['title'].split("; "):
+        key, _, value = part.partition(" ")
+        attributes[key] = value
+    return attributes
 
 def get_bbox_size(hocr_bbox):
     return hocr_bbox[2] - hocr_bbox[0], hocr_bbox[3] - hocr_bbox[1]
@@ -285,26 +526,140 @@ def get_words(hocr_line):
 
 def get_word(hocr_word_soup):
     # Extract all word information, including bounding box and confidence
-    word_bbox = get_hocr_bbox(hocr_word_soup)
     word = get_hocr_box(hocr_word_soup)
     word["word_text"] = hocr_word_soup.get_text()
     word["word_conf"] = get_word_conf(hocr_word_soup)
-    bbox_size = get_bbox_size(word_bbox)
     return word
 
-def make_hocr_page(filepath, page_num=None, remove_line_numbers=False, minimum_paragraph_gap=10, avg_char_width=20):
+def make_hocr_page(filepath, page_num=None, remove_line_numbers=False, minimum_paragraph_gap=10, avg_char_width=20,
+                   parser="bsoup", cache=None, estimate_layout=False):
     """
     make_hocr_page takes as input a filepath to a hOCR file and generates various textual representations of
     the hOCR data. For explanation of the optional arguments, see the HOCRPAGE class above. 
+    
+    The parser argument selects the backend for reading the hOCR file, either "bsoup" (Beautiful Soup
+    with lxml) or "stream" (single streaming pass, see HOCRStreamParser). Both give the same HOCRPage.
+    
+    With a cache (see hocr_page_cache.HOCRPageCache), the parsed word and line geometry is read from
+    the cache if the file was parsed before, and only the layout dependent steps are recomputed.
+    
+    With estimate_layout, the average character width and the minimum paragraph gap are estimated
+    from the page itself (see hocr_layout_index.PageLayoutIndex) instead of the given values, e.g.
+    for charter books with a different layout than OHZ. The page's center_columns are then set
+    for charter title detection as well.
     """
-    hocr_soup = get_hocr_content(filepath)
-    hocr_page_soup = get_hocr_page_soup(hocr_soup)
-    hocr_page = HOCRPage(hocr_page_soup, page_num, minimum_paragraph_gap=minimum_paragraph_gap, avg_char_width=avg_char_width)
-    hocr_page.set_carea(hocr_page_soup)
-    hocr_page.set_lines(hocr_page_soup)
+    hocr_page = None
+    if cache:
+        with pipeline_stats.timer("page_cache_load"):
+            hocr_page = cache.load_hocr_page(filepath, page_num, minimum_paragraph_gap=minimum_paragraph_gap,
+                                             avg_char_width=avg_char_width)
+        pipeline_stats.count("page_cache_hits" if hocr_page else "page_cache_misses")
+    if not hocr_page:
+        hocr_page = parse_hocr_page(filepath, page_num, minimum_paragraph_gap=minimum_paragraph_gap,
+                                    avg_char_width=avg_char_width, parser=parser)
+        if cache:
+            with pipeline_stats.timer("page_cache_store"):
+                cache.store_hocr_page(filepath, hocr_page)
+    if estimate_layout:
+        hocr_page.apply_layout_estimates()
     if remove_line_numbers:
-        hocr_page.remove_line_numbers()
-    hocr_page.set_paragraphs()
-    hocr_page.merge_paragraph_lines()
+        with pipeline_stats.timer("remove_line_numbers"):
+            hocr_page.remove_line_numbers()
+    with pipeline_stats.timer("paragraphs"):
+        hocr_page.set_paragraphs()
+        hocr_page.merge_paragraph_lines()
+    pipeline_stats.count("pages")
+    return hocr_page
+
+def parse_hocr_page(filepath, page_num=None, minimum_paragraph_gap=10, avg_char_width=20, parser="bsoup"):
+    # read the page, its text area and its lines with words from a hOCR file
+    with pipeline_stats.timer("parse_hocr"):
+        if parser == "bsoup":
+            hocr_soup = get_hocr_content(filepath)
+        elif parser == "stream":
+            hocr_soup = get_hocr_stream_content(filepath)
+        else:
+            raise ValueError("Invalid parser backend: {p}".format(p=parser))
+    with pipeline_stats.timer("set_lines"):
+        hocr_page_soup = get_hocr_page_soup(hocr_soup)
+        hocr_page = HOCRPage(hocr_page_soup, page_num, minimum_paragraph_gap=minimum_paragraph_gap, avg_char_width=avg_char_width)
+        hocr_page.set_carea(hocr_page_soup)
+        hocr_page.set_lines(hocr_page_soup)
     return hocr_page
 
+def get_hocr_files(hocr_dir):
+    for root, dirs, files in os.walk(hocr_dir):
+        for fname in sorted(files):
+            filepath = os.path.join(root, fname)
+            parts = fname.replace(".hocr","").split("_")
+            try:
+                page_num = int(parts[-1])
+                yield filepath, page_num
+            except ValueError:
+                continue
+
+# An XHTML hOCR page with named and numeric entities in the word texts, which the
+# parser backends must resolve in the same way (see compare_parser_backends).
+ENTITY_CHECK_HOCR = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+<head><title></title></head>
+<body>
+  <div class='ocr_page' id='page_1' title='image "page_1.png"; bbox 0 0 2000 3000; ppageno 0'>
+   <div class='ocr_carea' id='block_1_1' title="bbox 100 100 1800 2800">
+    <p class='ocr_par' id='par_1_1' lang='lat' title="bbox 100 100 1800 200">
+     <span class='ocr_line' id='line_1_1' title="bbox 100 100 900 140; baseline 0 -6; x_size 30">
+      <span class='ocrx_word' id='word_1_1' title='bbox 100 100 300 140; x_wconf 90'>A&nbsp;B</span>
+      <span class='ocrx_word' id='word_1_2' title='bbox 320 100 500 140; x_wconf 90'>C&eacute;</span>
+      <span class='ocrx_word' id='word_1_3' title='bbox 520 100 900 140; x_wconf 90'>&euml;&amp;&#233;&#x00e8;</span>
+     </span>
+    </p>
+   </div>
+  </div>
+ </body>
+</html>
+"""
+
+def compare_parser_backends(hocr_files, check_entities=True, **kwargs):
+    """
+    compare_parser_backends parses each of the given hOCR files with both parser backends
+    and checks that they produce the same HOCRPage. The hOCR files are (filepath, page_num) pairs
+    as generated by get_hocr_files. Additional keyword arguments are passed on to make_hocr_page.
+    Returns a timing report with the total parse time per backend and a list of files for which
+    the backends disagree. With check_entities, the ENTITY_CHECK_HOCR page is compared as well,
+    reported as "entity check" if the backends disagree.
+    """
+    report = {"pages": 0, "mismatches": [], "seconds": {parser: 0.0 for parser in PARSER_BACKENDS}}
+    if check_entities:
+        with tempfile.TemporaryDirectory() as check_dir:
+            check_file = os.path.join(check_dir, "entity-check_1.hocr")
+            with open(check_file, 'wt', encoding='utf-8') as fh:
+                fh.write(ENTITY_CHECK_HOCR)
+            check_pages = [make_hocr_page(check_file, 1, parser=parser, **kwargs) for parser in PARSER_BACKENDS]
+        if get_hocr_page_state(check_pages[0]) != get_hocr_page_state(check_pages[1]):
+            report["mismatches"].append("entity check")
+    for filepath, page_num in hocr_files:
+        hocr_pages = {}
+        for parser in PARSER_BACKENDS:
+            start = time.time()
+            hocr_pages[parser] = make_hocr_page(filepath, page_num, parser=parser, **kwargs)
+            report["seconds"][parser] += time.time() - start
+        if get_hocr_page_state(hocr_pages["bsoup"]) != get_hocr_page_state(hocr_pages["stream"]):
+            report["mismatches"].append(filepath)
+        report["pages"] += 1
+    if report["seconds"]["stream"] > 0:
+        report["speedup"] = report["seconds"]["bsoup"] / report["seconds"]["stream"]
+    return report
+
+def get_hocr_page_state(hocr_page):
+    # all parsed information of a page, for comparing the output of different parser backends
+    return {
+        "tag": hocr_page.tag,
+        "page_num": hocr_page.page_num,
+        "class": hocr_page.class_,
+        "attributes": hocr_page.attributes,
+        "box": hocr_page.box,
+        "carea": hocr_page.carea,
+        "lines": hocr_page.lines,
+        "paragraphs": hocr_page.paragraphs,
+    }
@@ -0,0 +1,168 @@
+import json
+import threading
+import time
+
+
+# Timers and counters for the stages of the charter pipeline. Instrumentation is
+# disabled by default. When disabled, timer returns a shared no-op context manager
+# and count returns immediately, so instrumented code runs at nearly the same speed.
+# Call enable() at the start of a run and get_report() or save_report() at the end.
+enabled = False
+started = None
+# stage name -> [number of calls, total seconds]
+stage_times = {}
+# counter name -> count
+counters = {}
+# cache name -> function returning a dict with at least hits and misses
+cache_stats = {}
+# counts and times are added from the book threads of process_books, so updates hold this lock
+stats_lock = threading.Lock()
+
+
+class NoTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class StageTimer(object):
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        add_time(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+no_timer = NoTimer()
+
+
+def enable():
+    global enabled, started
+    enabled = True
+    if started is None:
+        started = time.time()
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    global started
+    with stats_lock:
+        stage_times.clear()
+        counters.clear()
+    started = time.time() if enabled else None
+
+def init_worker(worker_enabled):
+    # initializer for worker processes, which start with empty stats
+    global enabled
+    enabled = worker_enabled
+    reset()
+
+def timer(stage):
+    # usage: with pipeline_stats.timer("stage name"): ...
+    if not enabled:
+        return no_timer
+    return StageTimer(stage)
+
+def timed(stage):
+    # decorator to time every call of a function as the given stage
+    def decorator(func):
+        def timed_func(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with StageTimer(stage):
+                return func(*args, **kwargs)
+        timed_func.__name__ = func.__name__
+        timed_func.__doc__ = func.__doc__
+        return timed_func
+    return decorator
+
+def add_time(stage, seconds, calls=1):
+    with stats_lock:
+        if stage not in stage_times:
+            stage_times[stage] = [0, 0.0]
+        stage_times[stage][0] += calls
+        stage_times[stage][1] += seconds
+
+def count(counter, increment=1):
+    if not enabled:
+        return
+    with stats_lock:
+        counters[counter] = counters.get(counter, 0) + increment
+
+def register_cache(cache_name, get_stats):
+    cache_stats[cache_name] = get_stats
+
+def get_stats():
+    with stats_lock:
+        return {
+            "stages": {stage: list(stage_time) for stage, stage_time in stage_times.items()},
+            "counters": dict(counters),
+        }
+
+def pop_stats():
+    # returns the stats collected so far and starts over, e.g. to send them from a worker process
+    with stats_lock:
+        stats = {"stages": dict(stage_times), "counters": dict(counters)}
+        stage_times.clear()
+        counters.clear()
+    return stats
+
+def merge_stats(stats):
+    # add stats collected elsewhere, e.g. in a worker process
+    for stage, (calls, seconds) in stats["stages"].items():
+        add_time(stage, seconds, calls)
+    with stats_lock:
+        for counter, increment in stats["counters"].items():
+            counters[counter] = counters.get(counter, 0) + increment
+
+def get_hit_rate(hits, misses):
+    return hits / (hits + misses) if hits + misses > 0 else None
+
+def get_report():
+    """
+    Returns a JSON serialisable summary: time per stage (stages running in worker processes
+    are summed over all workers), counters, pages per second over the wall clock time since
+    enable() or reset(), and the hit rates of the registered caches and the hOCR page cache.
+    """
+    elapsed = time.time() - started if started else 0.0
+    # a snapshot taken under the lock, as book threads may still be counting
+    snapshot = get_stats()
+    snapshot_counters = snapshot["counters"]
+    report = {
+        "elapsed_seconds": elapsed,
+        "pages": snapshot_counters.get("pages", 0),
+        "pages_per_second": snapshot_counters.get("pages", 0) / elapsed if elapsed > 0 else None,
+        "stages": {},
+        "counters": snapshot_counters,
+        "caches": {},
+    }
+    for stage, (calls, seconds) in sorted(snapshot["stages"].items()):
+        report["stages"][stage] = {
+            "calls": calls,
+            "seconds": seconds,
+            "seconds_per_call": seconds / calls if calls > 0 else None,
+        }
+    if "page_cache_hits" in snapshot_counters or "page_cache_misses" in snapshot_counters:
+        hits, misses = snapshot_counters.get("page_cache_hits", 0), snapshot_counters.get("page_cache_misses", 0)
+        report["caches"]["hocr_page_cache"] = {"hits": hits, "misses": misses, "hit_rate": get_hit_rate(hits, misses)}
+    for cache_name, get_cache_stats in sorted(cache_stats.items()):
+        stats = dict(get_cache_stats())
+        stats["hit_rate"] = get_hit_rate(stats["hits"], stats["misses"])
+        report["caches"][cache_name] = stats
+    return report
+
+def save_report(report_file):
+    with open(report_file, 'wt') as fh:
+        json.dump(get_report(), fh, indent=4)
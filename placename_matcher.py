@@ -0,0 +1,116 @@
+def is_word_char(char):
+    # same as the \w character class of the re module for str patterns
+    return char.isalnum() or char == "_"
+
+
+class PlacenameMatcher(object):
+
+    # key in a trie node that holds the ID of the placename ending at that node
+    end_key = None
+
+    def __init__(self, placenames, min_length=3):
+        """
+        Action: exact matcher for a list of placenames, built once from the gazetteer
+        Input: the placenames (e.g. is_variant_of), and the minimum length of placenames to match
+        Output: a PlacenameMatcher object
+
+        The placenames are stored in a character trie. A text is scanned in a single pass,
+        walking the trie from each position that starts a word, so all placenames that
+        occur in the text as separate terms (i.e. bounded by a non-word character or the
+        start or end of the text, as in term_in_text) are found at once. As in term_in_text,
+        a placename is not matched if it is the whole text. Placenames shorter
+        than min_length, like A and Le, are skipped as they give mostly incorrect matches.
+        """
+        self.min_length = min_length
+        self.placenames = []
+        self.placename_ids = {}
+        self.trie = {}
+        for placename in placenames:
+            self.add_placename(placename)
+
+    def add_placename(self, placename):
+        if len(placename) < self.min_length or placename in self.placename_ids:
+            return None
+        placename_id = len(self.placenames)
+        self.placenames.append(placename)
+        self.placename_ids[placename] = placename_id
+        node = self.trie
+        for char in placename:
+            node = node.setdefault(char, {})
+        node[self.end_key] = placename_id
+        return placename_id
+
+    def find_placename_ids(self, text):
+        # returns the set of IDs of all placenames that occur in the text as separate terms
+        found = set()
+        text_length = len(text)
+        for start in range(text_length):
+            if start > 0 and is_word_char(text[start-1]):
+                continue
+            node = self.trie.get(text[start])
+            index = start
+            while node:
+                if self.end_key in node and (index + 1 == text_length or not is_word_char(text[index+1])) \
+                        and (start > 0 or index + 1 < text_length):
+                    found.add(node[self.end_key])
+                index += 1
+                if index == text_length:
+                    break
+                node = node.get(text[index])
+        return found
+
+    def find_placenames(self, text):
+        return [self.placenames[placename_id] for placename_id in sorted(self.find_placename_ids(text))]
+
+    def match_paragraph(self, paragraph):
+        """
+        Returns (placename_id, line_index, match_info) tuples for all placenames in the lines
+        of the paragraph, with the same match_info as lookup_placename_in_single_line and
+        lookup_placename_in_merged_line. A placename that is split over two lines with a
+        hyphen is a cross_line match, unless it also occurs in the first or the next line.
+        """
+        lines = paragraph["lines"]
+        line_matches = [self.find_placename_ids(line) for line in lines]
+        paragraph_matches = []
+        for line_index, line in enumerate(lines):
+            if len(line) == 0:
+                continue
+            for placename_id in line_matches[line_index]:
+                match_info = {
+                    "match_type": "single_line",
+                    "line_number": paragraph["line_numbers"][line_index],
+                }
+                paragraph_matches.append((placename_id, line_index, match_info))
+            if line[-1] != "-" or len(lines) <= line_index+1:
+                continue
+            merged_line = line[:-1] + lines[line_index+1].strip()
+            for placename_id in self.find_placename_ids(merged_line):
+                if placename_id in line_matches[line_index] or placename_id in line_matches[line_index+1]:
+                    continue
+                placename = self.placenames[placename_id]
+                offset = merged_line.index(placename)
+                curr_line_part = line[offset:]
+                next_line_part = placename[(len(curr_line_part)-1):]
+                match_info = {
+                    "match_type": "cross_line",
+                    "line_number": [paragraph["line_numbers"][line_index], paragraph["line_numbers"][line_index+1]],
+                    "match_parts": [curr_line_part, next_line_part]
+                }
+                paragraph_matches.append((placename_id, line_index, match_info))
+        return paragraph_matches
+
+    def match_charter(self, charter, charter_text):
+        """
+        Returns (placename_string, paragraph, match_info) tuples for all placenames in the
+        paragraphs of the charter that also occur as string in the charter text, in the
+        order of the placenames, then paragraphs, then lines.
+        """
+        charter_matches = []
+        for paragraph_index, paragraph in enumerate(charter["paragraphs"]):
+            for placename_id, line_index, match_info in self.match_paragraph(paragraph):
+                if self.placenames[placename_id] not in charter_text:
+                    continue
+                charter_matches.append(((placename_id, paragraph_index, line_index), paragraph, match_info))
+        charter_matches.sort(key=lambda charter_match: charter_match[0])
+        return [(self.placenames[match_key[0]], paragraph, match_info)
+                for match_key, paragraph, match_info in charter_matches]
@@ -0,0 +1,456 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import fuzzy_place_cache
+import gazetteer_snapshot
+from fuzzy_matcher import FuzzyMatcher
+
+
+# same candidate patterns as get_fuzzy_candidates in the notebook
+single_term_pattern = re.compile(r"\b[A-Z]\w+")
+multi_term_pattern = re.compile(r"\b([A-Z]\w+([ -][A-Z]\w+)*)")
+
+# number of most recent requests and batches that latency percentiles are computed over
+LATENCY_WINDOW = 10000
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+def get_fuzzy_candidates(text):
+    candidates = single_term_pattern.findall(text)
+    candidates += [match[0] for match in multi_term_pattern.findall(text) if match[0] not in candidates]
+    return candidates
+
+def is_valid_request(request):
+    # a dict with texts as a list of strings, or paragraphs as a list of lists of strings
+    if not isinstance(request, dict):
+        return False
+    if "texts" in request:
+        return isinstance(request["texts"], list) and all(isinstance(text, str) for text in request["texts"])
+    return isinstance(request.get("paragraphs"), list) and all(
+        isinstance(paragraph, list) and all(isinstance(line, str) for line in paragraph)
+        for paragraph in request["paragraphs"])
+
+def get_percentile(sorted_values, percentile):
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100))]
+
+
+class PlacenameResolver(object):
+
+    def __init__(self, placename_index, fuzzy_matcher, fuzzy_candidate_cache=None, min_fuzzy_length=4):
+        """
+        Action: resolves OCR strings to gazetteer places, as find_fuzzy_placename_matches in the notebook
+        Input: the placename index (a PlaceIndex or GazetteerSnapshot), the fuzzy matcher, optionally a
+        FuzzyPlaceCache and the minimum length of strings to match fuzzily
+        Output: a PlacenameResolver object
+
+        Candidate strings that are a known placename are returned as exact matches, which
+        find_fuzzy_placename_matches skips. The candidates of all texts in a batch are resolved
+        once, so a string that occurs in several texts or requests is only looked up once.
+        The resolver is not thread-safe: the placename service runs all batches in one thread.
+        """
+        self.placename_index = placename_index
+        self.fuzzy_matcher = fuzzy_matcher
+        if fuzzy_candidate_cache is None:
+            fingerprint = fuzzy_place_cache.make_fingerprint(placename_index.is_variant_of, fuzzy_matcher)
+            fuzzy_candidate_cache = fuzzy_place_cache.FuzzyPlaceCache(fingerprint)
+        self.fuzzy_candidate_cache = fuzzy_candidate_cache
+        self.min_fuzzy_length = min_fuzzy_length
+
+    def select_best_ranked_candidates(self, ranked_candidates):
+        # Multiple variants of the same place may be fuzzy matches.
+        # In that case, select only the best matching one.
+        ranked_preferred_placenames = []
+        selected_candidates = []
+        for ranked_candidate in ranked_candidates:
+            if ranked_candidate["total"] < 2:
+                continue
+            preferred_placenames = self.placename_index.is_variant_of[ranked_candidate["candidate"]].keys()
+            new_placenames = [placename for placename in preferred_placenames if placename not in ranked_preferred_placenames]
+            if len(new_placenames) == 0:
+                continue
+            selected_candidates += [ranked_candidate["candidate"]]
+            ranked_preferred_placenames += new_placenames
+        return selected_candidates
+
+    def find_fuzzy_placename_candidates(self, candidate_name):
+        # as select_ngram_candidate_placenames and find_fuzzy_placename_candidates in the notebook
+        placenames = self.placename_index.placename_fuzzy_index.lookup(candidate_name, self.fuzzy_matcher.ngram_threshold,
+                                                                       max_length_difference=2, same_initial=True,
+                                                                       shared_ngram_size=3)
+        placenames = self.fuzzy_matcher.filter_candidates(placenames, candidate_name, 2)
+        placenames = [placename for placename in placenames if abs(len(placename) - len(candidate_name)) < 3
+                      and placename[0].lower() == candidate_name[0].lower()]
+        ranked_candidates = self.fuzzy_matcher.rank_candidates(placenames, candidate_name, ngram_size=2)
+        return self.select_best_ranked_candidates(ranked_candidates)
+
+    def get_fuzzy_candidate_places(self, fuzzy_candidate):
+        candidate_places = self.fuzzy_candidate_cache.get(fuzzy_candidate)
+        if candidate_places is None:
+            candidate_places = self.find_fuzzy_placename_candidates(fuzzy_candidate)
+            self.fuzzy_candidate_cache.put(fuzzy_candidate, candidate_places)
+        return candidate_places
+
+    def make_candidate_places(self, placenames):
+        return [{"placename_variant": placename, "preferred_placename": self.placename_index.get_preferred_placename(placename)}
+                for placename in placenames]
+
+    def resolve_candidate(self, candidate):
+        # returns the match of a candidate string, or None if it doesn't match a placename
+        if self.placename_index.is_placename(candidate):
+            return {"place_string": candidate, "match_type": "exact",
+                    "candidate_places": self.make_candidate_places([candidate])}
+        if len(candidate) < self.min_fuzzy_length or self.placename_index.is_non_placename(candidate):
+            return None
+        # Unlike the notebook, candidates without any match are not registered as non placenames,
+        # as that would grow without bound in a long-lived service. The bounded fuzzy candidate
+        # cache keeps these negative results instead.
+        candidate_places = self.get_fuzzy_candidate_places(candidate)
+        if len(candidate_places) == 0:
+            return None
+        return {"place_string": candidate, "match_type": "fuzzy",
+                "candidate_places": self.make_candidate_places(candidate_places)}
+
+    def resolve_batch(self, requests):
+        """
+        Resolves a batch of requests, each a dict with either texts (a list of strings) or
+        paragraphs (a list of paragraphs, each a list of lines). Returns a result per request:
+        the matches per text, or per line of each paragraph, in order of occurrence, or the
+        exception raised for that request, so one bad request doesn't fail the others.
+        Also returns the number of unique candidate strings in the batch.
+        """
+        request_candidates = []
+        for request in requests:
+            try:
+                if "texts" in request:
+                    request_candidates += [[get_fuzzy_candidates(text) for text in request["texts"]]]
+                else:
+                    request_candidates += [[[get_fuzzy_candidates(line) for line in paragraph]
+                                            for paragraph in request["paragraphs"]]]
+            except Exception as error:
+                request_candidates += [error]
+        candidate_matches = {}
+
+        def get_matches(candidates):
+            matches = []
+            # the candidates of a text can contain the same string more than once
+            for candidate in dict.fromkeys(candidates):
+                if candidate not in candidate_matches:
+                    candidate_matches[candidate] = self.resolve_candidate(candidate)
+                if candidate_matches[candidate] is not None:
+                    matches += [candidate_matches[candidate]]
+            return matches
+
+        results = []
+        for request, candidates in zip(requests, request_candidates):
+            if isinstance(candidates, Exception):
+                results += [candidates]
+                continue
+            try:
+                if "texts" in request:
+                    results += [[get_matches(text_candidates) for text_candidates in candidates]]
+                else:
+                    results += [[[get_matches(line_candidates) for line_candidates in paragraph_candidates]
+                                 for paragraph_candidates in candidates]]
+            except Exception as error:
+                results += [error]
+        return results, len(candidate_matches)
+
+    def find_fuzzy_placename_matches(self, text):
+        # same result format as find_fuzzy_placename_matches in the notebook
+        results, num_candidates = self.resolve_batch([{"texts": [text]}])
+        if isinstance(results[0], Exception):
+            raise results[0]
+        return [{"fuzzy_place_string": match["place_string"], "candidate_places": match["candidate_places"]}
+                for match in results[0][0] if match["match_type"] == "fuzzy"]
+
+
+class ServiceMetrics(object):
+
+    def __init__(self):
+        # throughput since the service started and latencies of the most recent requests and batches
+        self.started = time.time()
+        self.requests = 0
+        self.items = 0
+        self.errors = 0
+        self.batches = 0
+        self.batch_requests = 0
+        self.batch_candidates = 0
+        self.request_latencies = deque(maxlen=LATENCY_WINDOW)
+        self.batch_seconds = deque(maxlen=LATENCY_WINDOW)
+
+    def add_request(self, num_items, latency):
+        self.requests += 1
+        self.items += num_items
+        self.request_latencies.append(latency)
+
+    def add_batch(self, num_requests, num_candidates, seconds):
+        self.batches += 1
+        self.batch_requests += num_requests
+        self.batch_candidates += num_candidates
+        self.batch_seconds.append(seconds)
+
+    def get_latency_stats(self, latencies):
+        latencies = sorted(latencies)
+        return {
+            "p50_ms": None if not latencies else get_percentile(latencies, 50) * 1000,
+            "p90_ms": None if not latencies else get_percentile(latencies, 90) * 1000,
+            "p99_ms": None if not latencies else get_percentile(latencies, 99) * 1000,
+            "max_ms": None if not latencies else latencies[-1] * 1000,
+        }
+
+    def get_metrics(self):
+        uptime = time.time() - self.started
+        return {
+            "uptime_seconds": uptime,
+            "requests": self.requests,
+            "items": self.items,
+            "errors": self.errors,
+            "requests_per_second": self.requests / uptime if uptime > 0 else 0,
+            "items_per_second": self.items / uptime if uptime > 0 else 0,
+            "batches": self.batches,
+            "requests_per_batch": self.batch_requests / self.batches if self.batches else 0,
+            "candidates_per_batch": self.batch_candidates / self.batches if self.batches else 0,
+            "request_latency": self.get_latency_stats(self.request_latencies),
+            "batch_latency": self.get_latency_stats(self.batch_seconds),
+        }
+
+
+class PlacenameService(object):
+
+    def __init__(self, resolver, max_batch_size=1000, max_batch_delay=0.002):
+        """
+        Action: long-lived placename resolution service that keeps the gazetteer and matcher warm
+        Input: a PlacenameResolver, the maximum number of texts or paragraphs per batch and the
+        maximum number of seconds to wait for more requests before resolving a batch
+        Output: a PlacenameService object
+
+        Concurrent requests are coalesced into batches for PlacenameResolver.resolve_batch,
+        which runs in a single worker thread, so the event loop keeps accepting requests
+        while a batch is resolved. Requests that arrive during a batch are resolved together
+        in the next one. Use resolve_texts and resolve_paragraphs in-process, or serve_http
+        and serve_unix to serve JSON over a local socket.
+        """
+        self.resolver = resolver
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.metrics = ServiceMetrics()
+        self.executor = None
+        self.queue = None
+        self.batch_task = None
+
+    async def start(self):
+        if self.batch_task is None:
+            # a new executor, as stop shuts down the previous one
+            self.executor = ThreadPoolExecutor(max_workers=1)
+            self.queue = asyncio.Queue()
+            self.batch_task = asyncio.ensure_future(self.run_batches())
+
+    async def stop(self):
+        if self.batch_task is not None:
+            self.batch_task.cancel()
+            try:
+                await self.batch_task
+            except asyncio.CancelledError:
+                pass
+            self.batch_task = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    async def resolve(self, request):
+        await self.start()
+        num_items = len(request.get("texts", request.get("paragraphs", [])))
+        start = time.time()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, num_items, future))
+        result = await future
+        self.metrics.add_request(num_items, time.time() - start)
+        return result
+
+    async def resolve_texts(self, texts):
+        return await self.resolve({"texts": list(texts)})
+
+    async def resolve_paragraphs(self, paragraphs):
+        return await self.resolve({"paragraphs": [list(lines) for lines in paragraphs]})
+
+    async def get_batch(self):
+        # waits for a request, then adds the requests that arrive within max_batch_delay
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        num_items = batch[0][1]
+        deadline = loop.time() + self.max_batch_delay
+        while num_items < self.max_batch_size:
+            if self.queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch += [await asyncio.wait_for(self.queue.get(), timeout)]
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch += [self.queue.get_nowait()]
+            num_items += batch[-1][1]
+        return batch
+
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.get_batch()
+            start = time.time()
+            try:
+                results, num_candidates = await loop.run_in_executor(
+                    self.executor, self.resolver.resolve_batch, [request for request, num_items, future in batch])
+            except Exception as error:
+                self.metrics.errors += len(batch)
+                for request, num_items, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            self.metrics.add_batch(len(batch), num_candidates, time.time() - start)
+            for (request, num_items, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    self.metrics.errors += 1
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def get_metrics(self):
+        metrics = self.metrics.get_metrics()
+        metrics["queued_requests"] = self.queue.qsize() if self.queue else 0
+        metrics["caches"] = {
+            "fuzzy_place_cache": self.resolver.fuzzy_candidate_cache.get_stats(),
+            "fuzzy_score_cache": self.resolver.fuzzy_matcher.get_score_cache_stats(),
+        }
+        return metrics
+
+    ####################
+    # HTTP interface   #
+    ####################
+
+    async def handle_request(self, method, path, body):
+        # returns the status and the JSON response of a request
+        if path == "/metrics" or path == "/health":
+            if method != "GET":
+                return 405, {"error": "use GET"}
+            return 200, self.get_metrics() if path == "/metrics" else {"status": "ok"}
+        if path != "/resolve":
+            return 404, {"error": "unknown path {p}".format(p=path)}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+        try:
+            request = json.loads(body.decode("utf-8"))
+        except ValueError:
+            return 400, {"error": "request body is not valid JSON"}
+        if not is_valid_request(request):
+            return 400, {"error": "request should have texts as a list of strings or paragraphs as a list of lists of strings"}
+        try:
+            if "texts" in request:
+                return 200, {"results": await self.resolve_texts(request["texts"])}
+            return 200, {"results": await self.resolve_paragraphs(request["paragraphs"])}
+        except Exception as error:
+            return 500, {"error": str(error)}
+
+    async def handle_connection(self, reader, writer):
+        # minimal HTTP/1.1 with keep-alive, enough for local clients and the load test
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    header_line = await reader.readline()
+                    if header_line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header_line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    method, path, version = request_line.decode("latin-1").split()
+                    body = await reader.readexactly(int(headers.get("content-length", 0)))
+                    status, response = await self.handle_request(method, path, body)
+                except ValueError:
+                    status, response, version = 400, {"error": "malformed request"}, "HTTP/1.0"
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                response_body = json.dumps(response).encode("utf-8")
+                writer.write("HTTP/1.1 {s} {r}\r\nContent-Type: application/json\r\nContent-Length: {l}\r\n"
+                             "Connection: {c}\r\n\r\n".format(s=status, r=HTTP_REASONS[status], l=len(response_body),
+                                                            c="keep-alive" if keep_alive else "close").encode("latin-1"))
+                writer.write(response_body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_http(self, host="127.0.0.1", port=8765):
+        await self.start()
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def serve_unix(self, socket_file):
+        await self.start()
+        return await asyncio.start_unix_server(self.handle_connection, socket_file)
+
+
+def make_resolver(gazetteer_file, char_match_threshold=0.7, ngram_threshold=0.5, levenshtein_threshold=0.8,
+                  cache_file=None):
+    """
+    Returns a PlacenameResolver with the thresholds of the notebook, for the placename
+    Excel file or a compiled gazetteer snapshot (a file ending in .snapshot).
+    """
+    if gazetteer_file.endswith(".snapshot"):
+        placename_index = gazetteer_snapshot.GazetteerSnapshot(gazetteer_file)
+    else:
+        placename_index = gazetteer_snapshot.load_placename_index(gazetteer_file)
+    fuzzy_matcher = FuzzyMatcher(char_match_threshold=char_match_threshold, ngram_threshold=ngram_threshold,
+                                 levenshtein_threshold=levenshtein_threshold)
+    resolver = PlacenameResolver(placename_index, fuzzy_matcher)
+    if cache_file:
+        resolver.fuzzy_candidate_cache.load(cache_file)
+    return resolver
+
+async def run_service(service, host, port, socket_file=None):
+    if socket_file:
+        server = await service.serve_unix(socket_file)
+        print("Serving on", socket_file)
+    else:
+        server = await service.serve_http(host, port)
+        print("Serving on http://{h}:{p}".format(h=host, p=server.sockets[0].getsockname()[1]))
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="Serve placename resolution over local HTTP")
+    argument_parser.add_argument("gazetteer_file", help="placename Excel file or compiled gazetteer snapshot")
+    argument_parser.add_argument("--host", default="127.0.0.1")
+    argument_parser.add_argument("--port", type=int, default=8765)
+    argument_parser.add_argument("--unix-socket", help="serve on a Unix socket instead of a TCP port")
+    argument_parser.add_argument("--cache-file", help="persisted fuzzy place cache, loaded at start and saved at exit")
+    argument_parser.add_argument("--max-batch-size", type=int, default=1000)
+    argument_parser.add_argument("--max-batch-delay", type=float, default=0.002, help="seconds")
+    args = argument_parser.parse_args()
+    placename_resolver = make_resolver(args.gazetteer_file, cache_file=args.cache_file)
+    placename_service = PlacenameService(placename_resolver, max_batch_size=args.max_batch_size,
+                                         max_batch_delay=args.max_batch_delay)
+    try:
+        asyncio.run(run_service(placename_service, args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.cache_file:
+            placename_resolver.fuzzy_candidate_cache.save(args.cache_file)
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
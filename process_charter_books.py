@@ -0,0 +1,213 @@
+import multiprocessing
+import queue
+import threading
+
+import page_checkpoints
+import parse_hocr_files
+import pipeline_stats
+
+
+def parse_page(page_job):
+    # Worker function: everything that can be done per page independently of other pages,
+    # i.e. parsing, line number removal and paragraph building (see make_hocr_page).
+    # Returns the page with the pipeline stats collected for it in the worker, if enabled.
+    filepath, page_num, page_options = page_job
+    hocr_page = parse_hocr_files.make_hocr_page(filepath, page_num, **page_options)
+    return hocr_page, pipeline_stats.pop_stats() if pipeline_stats.enabled else None
+
+def get_page_jobs(hocr_dir, last_page=None, **page_options):
+    for filepath, page_num in parse_hocr_files.get_hocr_files(hocr_dir):
+        yield filepath, page_num, page_options
+        if last_page and page_num > last_page:
+            # Skip pages beyond the last body matter page
+            break
+
+def make_book(book_num, hocr_dir, first_charter_num, last_page=None):
+    return {
+        "book_num": book_num,
+        "hocr_dir": hocr_dir,
+        "first_charter_num": first_charter_num,
+        "last_page": last_page,
+    }
+
+def make_numbers(first_charter_num):
+    return {
+        "current_charter": [0],
+        "next_charter": first_charter_num
+    }
+
+def process_book(pool, book, process_page, chunksize=4, **page_options):
+    """
+    process_book parses the pages of a book in parallel using the given process pool
+    and passes them in page order to process_page(hocr_page, numbers), which can carry
+    charter numbering state from one page to the next. Pages are generated after
+    process_page has handled them. Additional keyword arguments are passed on to
+    make_hocr_page, e.g. remove_line_numbers=True.
+    """
+    numbers = make_numbers(book["first_charter_num"])
+    page_jobs = get_page_jobs(book["hocr_dir"], book["last_page"], **page_options)
+    # imap hands out pages to the workers as they become available,
+    # but returns the parsed pages in the order of the page jobs.
+    for hocr_page, page_stats in pool.imap(parse_page, page_jobs, chunksize):
+        if page_stats:
+            pipeline_stats.merge_stats(page_stats)
+        numbers["page_num"] = hocr_page.page_num
+        process_page(hocr_page, numbers)
+        yield hocr_page
+
+def process_book_incremental(pool, book, process_page, checkpoints, chunksize=4, prefetch_pages=8, **page_options):
+    """
+    Same as process_book, but skips the pages that are unchanged since the stored checkpoints
+    (see PageCheckpoints) and only generates the pages that have changed. Pages with changed
+    inputs are parsed in parallel. Later pages are only parsed if the numbering state at their
+    start differs from their checkpoint, which stops once the numbering state converges.
+    While the numbering state differs, the next prefetch_pages unchanged pages are parsed
+    ahead in the pool, and those results are dropped once the state converges.
+    """
+    book_num = book["book_num"]
+    numbers = make_numbers(book["first_charter_num"])
+    book_checkpoints = checkpoints.load_book(book_num)
+    page_jobs = list(get_page_jobs(book["hocr_dir"], book["last_page"], **page_options))
+    input_keys = {}
+    changed_jobs = []
+    for page_job in page_jobs:
+        filepath, page_num, _ = page_job
+        input_keys[page_num] = checkpoints.get_input_key(filepath, page_num, page_options)
+        if not checkpoints.is_page_unchanged(book_checkpoints.get(page_num), input_keys[page_num]):
+            changed_jobs += [page_job]
+    changed_page_nums = set([page_num for filepath, page_num, _ in changed_jobs])
+    changed_pages = pool.imap(parse_page, changed_jobs, chunksize)
+    # unchanged pages parsed ahead while the numbering state differs, page_num -> AsyncResult
+    prefetched = {}
+    for job_index, page_job in enumerate(page_jobs):
+        filepath, page_num, _ = page_job
+        numbering_state = page_checkpoints.get_numbering_state(numbers)
+        if page_num in changed_page_nums:
+            hocr_page, page_stats = next(changed_pages)
+        elif book_checkpoints[page_num]["numbers_in"] == numbering_state:
+            # unchanged page with the same numbering state, continue with the state after the page
+            page_checkpoints.set_numbering_state(numbers, book_checkpoints[page_num]["numbers_out"])
+            pipeline_stats.count("pages_skipped")
+            # the state has converged, the pages parsed ahead are not needed (the pool can't cancel them)
+            prefetched.clear()
+            continue
+        else:
+            # unchanged page with a different numbering state, keep the next unchanged pages parsing in the pool
+            for next_job in page_jobs[job_index:job_index + prefetch_pages + 1]:
+                next_page_num = next_job[1]
+                if next_page_num not in changed_page_nums and next_page_num not in prefetched:
+                    prefetched[next_page_num] = pool.apply_async(parse_page, (next_job,))
+            hocr_page, page_stats = prefetched.pop(page_num).get()
+        if page_stats:
+            pipeline_stats.merge_stats(page_stats)
+        numbers["page_num"] = hocr_page.page_num
+        process_page(hocr_page, numbers)
+        if checkpoints.add_checkpoint(book_num, filepath, page_num, input_keys[page_num], numbering_state, numbers, hocr_page):
+            yield hocr_page
+    checkpoints.save_book(book_num)
+
+def check_pool_round_trip(hocr_files, processes=2, **page_options):
+    """
+    Parses the given (filepath, page_num) pairs in worker processes, as process_books does, and
+    in this process, and returns the files of which the page differs after it is sent back from
+    a worker. Raises an error if a page can't be sent back at all, e.g. when it holds an
+    attribute that can't be pickled. Keyword arguments are passed on to make_hocr_page.
+    """
+    page_jobs = [(filepath, page_num, page_options) for filepath, page_num in hocr_files]
+    with multiprocessing.Pool(processes) as pool:
+        worker_pages = pool.map(parse_page, page_jobs)
+    mismatches = []
+    for (filepath, page_num, _), (worker_page, page_stats) in zip(page_jobs, worker_pages):
+        hocr_page = parse_hocr_files.make_hocr_page(filepath, page_num, **page_options)
+        if parse_hocr_files.get_hocr_page_state(worker_page) != parse_hocr_files.get_hocr_page_state(hocr_page):
+            mismatches.append(filepath)
+    return mismatches
+
+def load_unchanged_pages(checkpoints, **page_options):
+    """
+    Generates (book_num, hocr_page) tuples for the pages that were skipped in an incremental run
+    but have paragraphs of changed charters, with the paragraph classification of their checkpoint.
+    Keyword arguments are passed on to make_hocr_page and should be the same as for process_books.
+    """
+    for book_num, page_num, filepath in checkpoints.get_unchanged_charter_pages():
+        hocr_page = parse_hocr_files.make_hocr_page(filepath, page_num, **page_options)
+        checkpoints.restore_paragraphs(book_num, hocr_page)
+        yield book_num, hocr_page
+
+def queue_book_pages(pool, book, process_page, page_queue, chunksize, page_options, checkpoints=None):
+    try:
+        if checkpoints:
+            book_pages = process_book_incremental(pool, book, process_page, checkpoints, chunksize, **page_options)
+        else:
+            book_pages = process_book(pool, book, process_page, chunksize, **page_options)
+        for hocr_page in book_pages:
+            page_queue.put((book["book_num"], hocr_page, None))
+    except Exception as error:
+        page_queue.put((book["book_num"], None, error))
+        return
+    # signal that this book is done
+    page_queue.put((book["book_num"], None, None))
+
+def process_books(books, process_page, processes=None, chunksize=4, max_queued_pages=100, checkpoints=None,
+                  **page_options):
+    """
+    process_books processes all given books (see make_book) concurrently, sharing one pool of
+    worker processes for parsing pages. Each book has its own charter numbering, which is done
+    by process_page in page order, in a separate thread per book. Generates (book_num, hocr_page)
+    tuples. Pages of a single book are generated in page order, pages of different books can be
+    interleaved. The number of worker processes defaults to the number of cores.
+    With checkpoints (a PageCheckpoints object), only pages that changed since the previous run
+    are processed and generated, see process_book_incremental.
+    """
+    page_queue = queue.Queue(maxsize=max_queued_pages)
+    # worker processes collect pipeline stats if they are enabled when the pool starts
+    with multiprocessing.Pool(processes, initializer=pipeline_stats.init_worker,
+                              initargs=(pipeline_stats.enabled,)) as pool:
+        threads = []
+        for book in books:
+            thread = threading.Thread(target=queue_book_pages,
+                                      args=(pool, book, process_page, page_queue, chunksize, page_options, checkpoints))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        books_done = 0
+        while books_done < len(books):
+            book_num, hocr_page, error = page_queue.get()
+            if error:
+                raise error
+            if not hocr_page:
+                books_done += 1
+                continue
+            yield book_num, hocr_page
+        for thread in threads:
+            thread.join()
+
+class CharterParagraphs(object):
+
+    def __init__(self):
+        """
+        Groups the paragraphs of processed pages by charter number while the pages are
+        streamed, as an alternative to querying the paragraphs of each charter back from
+        the index. Paragraphs of a charter are kept in book, page and paragraph order.
+        """
+        self.charter_paragraphs = {}
+
+    def add_page(self, hocr_page, book_num):
+        for paragraph in hocr_page.paragraphs:
+            self.add_paragraph(paragraph, book_num)
+
+    def add_paragraph(self, paragraph, book_num):
+        paragraph["book_num"] = book_num
+        # a paragraph can belong to multiple charters, e.g. a title for a range of charter numbers
+        for charter_num in paragraph.get("charter_number", []):
+            if charter_num not in self.charter_paragraphs:
+                self.charter_paragraphs[charter_num] = []
+            self.charter_paragraphs[charter_num] += [paragraph]
+
+    def get_paragraphs(self, charter_num):
+        # pages can be added out of order, e.g. the unchanged pages of an incremental run
+        return sorted(self.charter_paragraphs.get(charter_num, []),
+                      key=lambda paragraph: (paragraph["book_num"], paragraph["page_num"], paragraph["paragraph_num"]))
+
+    def get_charter_numbers(self):
+        return sorted(self.charter_paragraphs.keys())
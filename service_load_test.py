@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+import benchmark_suite
+import gazetteer_snapshot
+import placename_service
+from fuzzy_matcher import FuzzyMatcher
+
+
+def make_test_texts(placenames, num_texts, words_per_text=20, seed=0):
+    # lines of synthetic charter text with (partly OCR-damaged) placenames, as in the benchmark suite
+    rng = random.Random(seed)
+    return [" ".join(benchmark_suite.make_body_words(rng, placenames, words_per_text)) for _ in range(num_texts)]
+
+def make_synthetic_resolver(snapshot_dir, num_places=1000, seed=0):
+    # a resolver on a compiled synthetic gazetteer, with the thresholds of the notebook
+    gazetteer_rows = benchmark_suite.make_synthetic_gazetteer(num_places, seed=seed)
+    snapshot_file = os.path.join(snapshot_dir, "synthetic-gazetteer.snapshot")
+    gazetteer_snapshot.compile_gazetteer(gazetteer_rows, snapshot_file, "synthetic-{s}".format(s=seed))
+    placename_index = gazetteer_snapshot.GazetteerSnapshot(snapshot_file)
+    fuzzy_matcher = FuzzyMatcher(char_match_threshold=0.7, ngram_threshold=0.5, levenshtein_threshold=0.8)
+    placenames = [row[1] for row in gazetteer_rows[1:] if row[2] is not None]
+    return placename_service.PlacenameResolver(placename_index, fuzzy_matcher), placenames
+
+
+class HTTPClient(object):
+
+    def __init__(self, host=None, port=None, socket_file=None):
+        # a single keep-alive connection to the placename service
+        self.host = host
+        self.port = port
+        self.socket_file = socket_file
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        if self.socket_file:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.socket_file)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            await self.writer.wait_closed()
+
+    async def request(self, method, path, data=None):
+        # returns the status and the JSON response
+        if self.writer is None:
+            await self.connect()
+        body = b"" if data is None else json.dumps(data).encode("utf-8")
+        self.writer.write("{m} {p} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                          "Content-Length: {l}\r\n\r\n".format(m=method, p=path, l=len(body)).encode("latin-1"))
+        self.writer.write(body)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            header_line = await self.reader.readline()
+            if header_line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = header_line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        response = json.loads((await self.reader.readexactly(int(headers["content-length"]))).decode("utf-8"))
+        return status, response
+
+
+async def run_client(client, texts, num_requests, texts_per_request, latencies, rng):
+    for _ in range(num_requests):
+        start = time.time()
+        status, response = await client.request("POST", "/resolve", {"texts": rng.sample(texts, texts_per_request)})
+        if status != 200:
+            raise ValueError("Request failed with status {s}: {r}".format(s=status, r=response))
+        latencies.append(time.time() - start)
+
+async def run_load_test(texts, concurrency=8, requests_per_client=50, texts_per_request=10,
+                        host="127.0.0.1", port=8765, socket_file=None, seed=0):
+    """
+    Sends requests of texts_per_request texts from concurrency clients at the same time, each
+    on its own keep-alive connection, and returns the client-side throughput and latencies
+    together with the metrics of the service.
+    """
+    clients = [HTTPClient(host, port, socket_file) for _ in range(concurrency)]
+    latencies = []
+    start = time.time()
+    await asyncio.gather(*[run_client(client, texts, requests_per_client, texts_per_request, latencies,
+                                      random.Random(seed + client_index))
+                           for client_index, client in enumerate(clients)])
+    seconds = time.time() - start
+    status, service_metrics = await clients[0].request("GET", "/metrics")
+    for client in clients:
+        await client.close()
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "texts": len(latencies) * texts_per_request,
+        "seconds": seconds,
+        "requests_per_second": len(latencies) / seconds,
+        "texts_per_second": len(latencies) * texts_per_request / seconds,
+        "latency_ms": {
+            "p50": placename_service.get_percentile(latencies, 50) * 1000,
+            "p90": placename_service.get_percentile(latencies, 90) * 1000,
+            "p99": placename_service.get_percentile(latencies, 99) * 1000,
+            "max": latencies[-1] * 1000,
+        },
+        "service": service_metrics,
+    }
+
+async def run_local_load_test(args):
+    # starts the service in this process on a synthetic gazetteer, on a free port
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        resolver, placenames = make_synthetic_resolver(snapshot_dir, args.places, args.seed)
+        texts = make_test_texts(placenames, args.texts, seed=args.seed)
+        service = placename_service.PlacenameService(resolver, max_batch_delay=args.max_batch_delay)
+        server = await service.serve_http("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await run_load_test(texts, args.concurrency, args.requests, args.texts_per_request,
+                                       port=port, seed=args.seed)
+        finally:
+            server.close()
+            await server.wait_closed()
+            await service.stop()
+            resolver.placename_index.close()
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="Load test for the placename resolution service")
+    argument_parser.add_argument("--local", action="store_true",
+                                 help="start the service in this process on a synthetic gazetteer")
+    argument_parser.add_argument("--host", default="127.0.0.1")
+    argument_parser.add_argument("--port", type=int, default=8765)
+    argument_parser.add_argument("--unix-socket", help="connect to a service on a Unix socket")
+    argument_parser.add_argument("--places", type=int, default=1000, help="number of places in the synthetic gazetteer")
+    argument_parser.add_argument("--texts", type=int, default=2000, help="number of distinct test texts")
+    argument_parser.add_argument("--concurrency", type=int, default=8)
+    argument_parser.add_argument("--requests", type=int, default=50, help="requests per client")
+    argument_parser.add_argument("--texts-per-request", type=int, default=10)
+    argument_parser.add_argument("--max-batch-delay", type=float, default=0.002, help="seconds, with --local")
+    argument_parser.add_argument("--seed", type=int, default=0)
+    argument_parser.add_argument("--output", help="file to write the results to as JSON")
+    args = argument_parser.parse_args()
+    if args.local:
+        results = asyncio.run(run_local_load_test(args))
+    else:
+        placenames = [row[1] for row in benchmark_suite.make_synthetic_gazetteer(args.places, seed=args.seed)[1:] if row[2]]
+        results = asyncio.run(run_load_test(make_test_texts(placenames, args.texts, seed=args.seed), args.concurrency,
+                                            args.requests, args.texts_per_request, args.host, args.port,
+                                            args.unix_socket, args.seed))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'wt') as fh:
+            json.dump(results, fh, indent=2)